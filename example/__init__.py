@@ -21,7 +21,9 @@ async def initialize_db(conn):
     await iam.initialize_iam_db(conn)
 
 
-db = configure_asyncpg(app, str(DB_DSN), init_db=initialize_db)
+db = configure_asyncpg(
+    app, str(DB_DSN), init_db=initialize_db, init=iam.init_connection
+)
 iam.set_asyncpg(db)
 
 
@@ -1,11 +1,20 @@
 from . import auth
+from . import cache
+from . import context
+from . import events
 from . import interfaces
+from . import metrics
+from . import tasks
 from . import views
 from .initialize import initialize_db
+from .provider import BoundConnectionRoute
 from .provider import set_provider
+from .services import memory
 from .services import pg
+from .services import sqlite
 from .views import admin
 from fastapi import APIRouter
+from fastapi.routing import APIRoute
 from fastapi_asyncpg import configure_asyncpg
 from functools import partial
 
@@ -20,10 +29,30 @@ default_settings = {
     "jwt_expiration": 6 * 60 * 60,  # expiratoin in seconds
     "jwt_algorithm": "HS256",
     "jwt_secret_key": "XXXXX",
+    # asymmetric signing keys, a list of dicts with kid, algorithm and
+    # private_key (and/or public_key) PEMs, see auth.KeyRing.
+    # jwt_active_key is the kid signing new tokens (the first by default)
+    "jwt_keys": [],
+    "jwt_active_key": None,
+    "jwks_max_age": 5 * 60,
+    # JWTSecurityPolicy validates tokens from their claims, without db
+    # access. Tokens older than max age (seconds) are checked on the db
+    "jwt_claims_only": False,
+    "jwt_claims_max_age": None,
     "cookie_domain": None,
     "session_expiration": 60 * 60 * 24 * 360,  # one year
     "rotate_refresh_tokens": True,
     "db_pool": None,
+    # "pg", "memory" (single node, optionally snapshotted to a
+    # json file every interval seconds and on shutdown) or "sqlite"
+    # (a WAL database file, reads on sqlite_readers threads and writes
+    # committed in batches of up to sqlite_write_batch)
+    "storage": "pg",
+    "memory_snapshot": None,
+    "memory_snapshot_interval": 60,
+    "sqlite_path": None,
+    "sqlite_readers": 4,
+    "sqlite_write_batch": 100,
     "services": {
         interfaces.IUsersStorage: pg.UserStorage,
         interfaces.ISessionStorage: pg.SessionStorage,
@@ -32,6 +61,67 @@ default_settings = {
     "default_service_factory": pg.pg_service_factory,
     "admin_routes": True,
     "refresh_token_secret_key": "xxxxx",  # just in case using secure cookie tokens
+    # password hashing thread pool, workers defaults to cpu count,
+    # memory budget (bytes) caps workers to budget / argon2 memory cost
+    "hasher_workers": None,
+    "hasher_queue_size": 64,
+    "hasher_memory_budget": None,
+    # successful password verifications cache, 0 disables it
+    "credential_cache_size": 10000,
+    "credential_cache_ttl": 5 * 60,
+    # validated sessions cache (token -> user), 0 disables it
+    # ttl is the max staleness, entries never outlive the token
+    "session_cache_size": 0,
+    "session_cache_ttl": 30,
+    # propagate cache invalidations to all workers with LISTEN/NOTIFY
+    "invalidation_bus": False,
+    "invalidation_channel": "fastapi_iam",
+    # bind storage services to one connection per request on iam routes,
+    # None, "connection" or "transaction"
+    "request_connection": None,
+    # delete expired sessions in the background, in small batches
+    "session_reaper": False,
+    "session_reaper_interval": 60,
+    "session_reaper_batch_size": 500,
+    "session_reaper_batch_delay": 0.1,
+    # range partition users_session by refresh_token_expires (applied
+    # by initialize_db), and create/drop monthly partitions
+    "session_partitions": False,
+    "session_partitions_interval": 60 * 60,
+    # record auth stages, hashing and storage timings, True for the
+    # built in prometheus registry, or a metrics.MetricsSink instance
+    "metrics": False,
+    # serve the registry and stats() on /metrics, prometheus text format.
+    # The route is public, like /status, unless metrics_token is set:
+    # scrapers then send it as a bearer token
+    "metrics_route": False,
+    "metrics_token": None,
+    # add a Server-Timing header (extract, decode, encode, db, hash and
+    # total auth time) to login, renew and get_current_user responses
+    "server_timing": False,
+    # how events.notify runs subscribers: "sequential" (in the request,
+    # errors raised), "concurrent" (in the request, concurrently, with
+    # timeouts and isolated errors) or "queue" (bounded queue drained
+    # by background workers, overflow "drop" or "block")
+    "events_dispatcher": "sequential",
+    "events_timeout": 5,
+    "events_queue_size": 1000,
+    "events_workers": 4,
+    "events_overflow": "drop",
+    # write UserLogin/UserLogout to the users_outbox table (applied by
+    # initialize_db) in the statement storing or deleting the session,
+    # relayed in batches to the sinks added with iam.outbox.add_sink
+    "outbox": False,
+    "outbox_interval": 1,
+    "outbox_batch_size": 500,
+    # write behind user last_login, stamps are coalesced in memory and
+    # written with one statement every interval seconds, or once size
+    # are pending. With session_last_used, the last_used of sessions
+    # is also stamped on every token validation
+    "activity_buffer": False,
+    "activity_buffer_interval": 0.5,
+    "activity_buffer_size": 1000,
+    "session_last_used": False,
 }
 
 
@@ -45,12 +135,20 @@ def configure_iam(
         logger.warning("INSECURE SECRET KEY, provide a new one")
 
     defaults = default_settings.copy()
+    if settings.get("storage") == "memory":
+        defaults.update(memory.SETTINGS)
+    elif settings.get("storage") == "sqlite":
+        if not settings.get("sqlite_path"):
+            raise ValueError("sqlite storage requires sqlite_path")
+        defaults.update(sqlite.SETTINGS)
     defaults.update(settings)
     iam = IAM(
         defaults,
         fastapi_asyncpg=fastapi_asyncpg,
         security_policy=security_policy,
     )
+    # build the auth pipeline (policy, encoder, extractors) up front
+    iam.get_security_policy().get_extractors()
     set_provider(iam)
     return iam
 
@@ -64,40 +162,269 @@ class IAM:
         security_policy=None,
         api_router_cls=APIRouter,
     ):
-        self.router = api_router_cls()
+        if settings["request_connection"]:
+            self.router = api_router_cls(route_class=BoundConnectionRoute)
+        else:
+            self.router = api_router_cls()
         self.settings = settings
-        self.db = fastapi_asyncpg
+        self.db = None
         self.security_policy = security_policy
         self.services = settings["services"]
         self.services_factory = {}
         self.initialize_iam_db = partial(initialize_db, settings)
+        credential_cache = None
+        if settings["credential_cache_size"]:
+            credential_cache = auth.CredentialCache(
+                maxsize=settings["credential_cache_size"],
+                ttl=settings["credential_cache_ttl"],
+            )
+        self.hasher = auth.ArgonPasswordHasher(
+            executor=auth.HashingExecutor(
+                workers=settings["hasher_workers"],
+                queue_size=settings["hasher_queue_size"],
+                memory_budget=settings["hasher_memory_budget"],
+                memory_cost=auth.ArgonPasswordHasher.memory_cost,
+            ),
+            cache=credential_cache,
+        )
+        self.keys = auth.KeyRing.from_settings(settings)
+        self.metrics = None
+        if settings["metrics"] is True:
+            self.metrics = metrics.PrometheusMetrics()
+        elif settings["metrics"]:
+            self.metrics = settings["metrics"]
+        elif settings["metrics_route"]:
+            # /metrics serves the built in registry
+            self.metrics = metrics.PrometheusMetrics()
+        self.hasher.executor.metrics = self.metrics
+        self.pool_stats = context.PoolStats()
+        self.session_cache = None
+        if settings["session_cache_size"]:
+            self.session_cache = cache.TTLCache(
+                maxsize=settings["session_cache_size"],
+                ttl=settings["session_cache_ttl"],
+            )
+        self.tasks = []
+        self.store = None
+        self.snapshot = None
+        if settings["storage"] == "memory":
+            self.store = memory.MemoryStore()
+            if settings["memory_snapshot"]:
+                self.snapshot = memory.SnapshotTask(
+                    self.store,
+                    settings["memory_snapshot"],
+                    interval=settings["memory_snapshot_interval"],
+                )
+                self.add_task(self.snapshot)
+        self.sqlite = None
+        if settings["storage"] == "sqlite":
+            self.sqlite = sqlite.SQLiteDatabase(
+                settings["sqlite_path"],
+                readers=settings["sqlite_readers"],
+                batch_size=settings["sqlite_write_batch"],
+            )
+            # stopped last, after the tasks still writing on shutdown
+            self.add_task(self.sqlite)
+        if settings["storage"] in ("memory", "sqlite"):
+            # no asyncpg app to bind the lifespan to, the router
+            # handlers are added to the app including it
+            self.router.add_event_handler("startup", self.startup)
+            self.router.add_event_handler("shutdown", self.shutdown)
+        self.bus = None
+        if settings["invalidation_bus"]:
+            self.bus = pg.InvalidationBus(
+                self, channel=settings["invalidation_channel"]
+            )
+            self.add_task(self.bus)
+        self.reaper = None
+        if settings["session_reaper"]:
+            self.reaper = tasks.SessionReaper(
+                self,
+                interval=settings["session_reaper_interval"],
+                batch_size=settings["session_reaper_batch_size"],
+                batch_delay=settings["session_reaper_batch_delay"],
+            )
+            self.add_task(self.reaper)
+        self.partitions = None
+        if settings["session_partitions"]:
+            self.partitions = pg.SessionPartitionMaintainer(
+                self, interval=settings["session_partitions_interval"]
+            )
+            self.add_task(self.partitions)
+        self.outbox = None
+        if settings["outbox"]:
+            self.outbox = pg.OutboxRelay(
+                self,
+                interval=settings["outbox_interval"],
+                batch_size=settings["outbox_batch_size"],
+            )
+            self.add_task(self.outbox)
+        self.activity = None
+        if settings["activity_buffer"]:
+            self.activity = tasks.ActivityBuffer(
+                self,
+                interval=settings["activity_buffer_interval"],
+                max_entries=settings["activity_buffer_size"],
+            )
+            self.add_task(self.activity)
+        self.events = events.build_dispatcher(settings)
+        events.set_dispatcher(self.events)
+        if isinstance(self.events, tasks.BackgroundTask):
+            self.add_task(self.events)
         self.setup_routes()
+        if fastapi_asyncpg is not None:
+            self.set_asyncpg(fastapi_asyncpg)
 
     def set_asyncpg(self, db):
+        if self.db is None and hasattr(db, "app"):
+            # run after the pool is ready, and stop before it's closed:
+            # shutdown handlers run in order, and configure_asyncpg
+            # already registered the one closing the pool
+            db.app.router.add_event_handler("startup", self.startup)
+            db.app.router.on_shutdown.insert(0, self.shutdown)
         self.db = db
 
+    def add_task(self, task):
+        """Registers a BackgroundTask bound to the app lifespan"""
+        self.tasks.append(task)
+
+    async def startup(self):
+        if self.db is not None:
+            await self.reset_unprepared()
+        for task in self.tasks:
+            await task.start()
+
+    async def shutdown(self):
+        for task in reversed(self.tasks):
+            await task.stop()
+        self.hasher.executor.shutdown(wait=False)
+
     def setup_routes(self):
-        self.router.add_api_route("/status", views.status)
+        # no connection needed, never bound to one
+        unbound = {"route_class_override": APIRoute}
+        self.router.add_api_route("/status", views.status, **unbound)
         self.router.add_api_route("/login", views.login, methods=["POST"])
         self.router.add_api_route(
             "/logout", views.logout, methods=["POST", "GET"]
         )
         self.router.add_api_route("/renew", views.renew, methods=["POST"])
         self.router.add_api_route("/whoami", views.whoami)
+        self.router.add_api_route(
+            "/.well-known/jwks.json", views.jwks, **unbound
+        )
+        if self.settings["metrics_route"]:
+            self.router.add_api_route(
+                "/metrics", views.metrics, include_in_schema=False, **unbound
+            )
 
         if self.settings["admin_routes"] is True:
             admin.setup_routes(self.router)
 
     @property
     def pool(self):
-        return self.db.pool
+        return self.db.pool if self.db is not None else None
+
+    def connection(self, *, transaction=False):
+        """async context manager that acquires a pool connection,
+        tracking the time waited on the pool"""
+        return context.acquire(
+            self.pool, self.pool_stats, transaction=transaction
+        )
+
+    async def init_connection(self, conn):
+        """asyncpg pool init hook, prepares the storage statements
+        on every new connection:
+            configure_asyncpg(app, dsn, init=iam.init_connection)
+        """
+        await pg.get_statements(self.settings["db_schema"]).prepare(conn)
+
+    async def reset_unprepared(self):
+        """The pool connections are created (and init_connection run)
+        before init_db migrates a fresh db, so they couldn't prepare
+        the statements. They are expired, and prepare them when they
+        reconnect"""
+        statements = pg.get_statements(self.settings["db_schema"])
+        if statements.unprepared and hasattr(self.pool, "expire_connections"):
+            statements.unprepared = 0
+            await self.pool.expire_connections()
+
+    @property
+    def security_policy(self):
+        return self._security_policy
+
+    @security_policy.setter
+    def security_policy(self, policy):
+        self._security_policy = policy
+        self._policy = None
 
     def get_security_policy(self):
-        return self.security_policy(self)
+        """The security policy, built once and reused by all requests"""
+        if self._policy is None:
+            self._policy = self.security_policy(self)
+        return self._policy
+
+    def stats(self):
+        stats = {
+            "hasher": self.hasher.executor.stats(),
+            "pool": self.pool_stats.stats(),
+            "events": self.events.stats(),
+        }
+        if self.store is not None:
+            stats["storage"] = self.store.stats()
+        if self.snapshot is not None:
+            stats["memory_snapshot"] = self.snapshot.stats()
+        if self.sqlite is not None:
+            stats["sqlite"] = self.sqlite.stats()
+        if self.hasher.cache is not None:
+            stats["credential_cache"] = self.hasher.cache.stats()
+        if self.session_cache is not None:
+            stats["session_cache"] = self.session_cache.stats()
+        if self.bus is not None:
+            stats["invalidation_bus"] = self.bus.stats()
+        if self.reaper is not None:
+            stats["session_reaper"] = self.reaper.stats()
+        if self.partitions is not None:
+            stats["session_partitions"] = self.partitions.stats()
+        if self.outbox is not None:
+            stats["outbox"] = self.outbox.stats()
+        if self.activity is not None:
+            stats["activity_buffer"] = self.activity.stats()
+        return stats
+
+    def invalidate(self, kind: str, key):
+        """Drops local cached data
+        kind is one of:
+            password: key is the old password hash
+            token: key is cache.token_key(token)
+            user: key is a user_id
+            all: flushes everything
+        """
+        if kind == "password":
+            self.hasher.invalidate(key)
+        elif kind == "all":
+            if self.hasher.cache is not None:
+                self.hasher.cache.clear()
+            if self.session_cache is not None:
+                self.session_cache.clear()
+        elif self.session_cache is None:
+            return
+        elif kind == "token":
+            self.session_cache.invalidate(key)
+        elif kind == "user":
+            self.session_cache.invalidate_tag(key)
+
+    async def publish(self, db, kind: str, key):
+        """Drops local cached data, and when the invalidation bus is
+        enabled, notifies other workers using the db connection"""
+        self.invalidate(kind, key)
+        if self.bus is not None:
+            await self.bus.publish(db, kind, key)
 
-    def get_service(self, service_type):
+    def get_service(self, service_type, *, db=None):
         assert service_type in self.services
         factory = self.settings["default_service_factory"]
         if service_type in self.services_factory:
             factory = self.services_factory[service_type]
+        if db is not None:
+            return factory(self, self.services[service_type], db=db)
         return factory(self, self.services[service_type])
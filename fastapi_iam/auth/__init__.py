@@ -1,3 +1,5 @@
+from .executor import *  # noqa
 from .extractors import *  # noqa
 from .hasher import *  # noqa
+from .keys import *  # noqa
 from .policy import *  # noqa
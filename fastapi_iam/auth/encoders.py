@@ -1,4 +1,5 @@
 from .. import models
+from .keys import KeyRing
 
 import datetime
 import jwt
@@ -27,8 +28,10 @@ class InvalidToken(Exception):
 
 
 class JWTToken(ITokenEncoder):
-    def __init__(self, cfg):
+    def __init__(self, cfg, keys: KeyRing = None):
         self.cfg = cfg
+        # the iam key ring, built from settings when not provided
+        self.keys = keys or KeyRing.from_settings(cfg)
 
     async def create_access_token(
         self, user: models.User
@@ -41,29 +44,14 @@ class JWTToken(ITokenEncoder):
             seconds=expiration
         )
         expire_unixts = int(time.mktime(expire.timetuple()))
-        to_encode.update({"exp": expire_unixts})
-        encoded_jwt = jwt.encode(
-            to_encode,
-            self.cfg["jwt_secret_key"],
-            algorithm=self.cfg["jwt_algorithm"],
-        )
-        # jwt types say that is returning bytes, but really is returning a str
-        # mypy complains about
-        if isinstance(encoded_jwt, bytes):
-            encoded_jwt = encoded_jwt.decode("utf-8")
+        to_encode.update({"exp": expire_unixts, "iat": int(time.time())})
+        encoded_jwt = await self.keys.encode(to_encode)
         return encoded_jwt, expire
 
     async def validate(self, token: str) -> typing.Dict[str, typing.Any]:
         try:
-            result = jwt.decode(
-                token,
-                self.cfg["jwt_secret_key"],
-                algorithms=self.cfg["jwt_algorithm"],
-            )
-        except (
-            jwt.DecodeError,
-            jwt.ExpiredSignatureError,
-        ):
+            result = self.keys.decode(token)
+        except jwt.InvalidTokenError:
             raise InvalidToken()
         return result
 
@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.exceptions import HTTPException
+from functools import partial
+
+import asyncio
+import math
+import os
+import time
+import typing
+
+
+class HasherOverloaded(HTTPException):
+    """Raised when the hashing queue is full, the request is shed
+    with a 503 and a hint on when to retry"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail="hasher_overloaded",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class HashingExecutor:
+    """
+    A process wide, bounded thread pool for password hashing.
+    Argon2 is cpu and memory hungry (64MiB per hash with default params),
+    so the number of concurrent computations is limited by the number of
+    workers, and the number of waiting jobs is limited by queue_size.
+    When the queue is full, jobs are rejected fast with HasherOverloaded
+    instead of piling up in the event loop.
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int = None,
+        queue_size: int = 64,
+        memory_budget: int = None,  # in bytes
+        memory_cost: int = None,  # in bytes, memory used by one hash
+    ):
+        workers = workers or os.cpu_count() or 1
+        if memory_budget and memory_cost:
+            workers = min(workers, memory_budget // memory_cost)
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.pending = 0
+        # optional metrics.MetricsSink, set by the iam
+        self.metrics = None
+        self._pool: typing.Optional[ThreadPoolExecutor] = None
+        # counters
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+        self.hash_time = 0.0
+        self.hash_time_max = 0.0
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="iam-hasher"
+            )
+        return self._pool
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    def retry_after(self) -> int:
+        avg = self.hash_time / self.completed if self.completed else 1
+        return max(1, math.ceil(self.queue_depth * avg / self.workers))
+
+    async def run(self, func, *args, op: str = "", **kwargs):
+        """runs func on the pool, op labels its metrics (hash, verify)"""
+        if self.queue_depth >= self.queue_size:
+            self.rejected += 1
+            raise HasherOverloaded(self.retry_after())
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            result, waited, took = await loop.run_in_executor(
+                self.pool,
+                partial(_timed, time.monotonic(), func, *args, **kwargs),
+            )
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.wait_time += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.hash_time += took
+        self.hash_time_max = max(self.hash_time_max, took)
+        if self.metrics is not None:
+            self.metrics.observe("iam_hasher_queue_wait_seconds", waited, op)
+            self.metrics.observe("iam_hasher_seconds", took, op)
+        return result
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        completed = self.completed or 1
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": self.queue_depth,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_time_avg": self.wait_time / completed,
+            "wait_time_max": self.wait_time_max,
+            "hash_time_avg": self.hash_time / completed,
+            "hash_time_max": self.hash_time_max,
+        }
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+
+def _timed(submitted, func, *args, **kwargs):
+    # runs inside the worker thread, reports how long the job was
+    # queued and how long it took
+    started = time.monotonic()
+    result = func(*args, **kwargs)
+    return result, started - submitted, time.monotonic() - started
@@ -4,22 +4,23 @@ import base64
 
 
 async def get_extractors(iam, request: Request):
-    user = None
-    for extractor in iam.get_security_policy().extractors:
-        user = await extractor(request).extract_token()
-        if user:
-            break
-    return user
+    return await iam.get_security_policy().extract(request)
 
 
 # This part is from guillotina https://github.com/plone/guillotina
 class BasePolicy:
+    """
+    Extractors are built once per security policy and shared by all
+    requests, the request is given to extract_token.
+    """
+
     name = "<FILL IN>"
+    header = "authorization"  # lowercase, as stored by starlette
 
-    def __init__(self, request):
+    def __init__(self, request=None):
         self.request = request
 
-    async def extract_token(self):
+    async def extract_token(self, request=None):
         """
         Extracts token from request.
         This will be a dictionary including something like {id, password},
@@ -31,8 +32,9 @@ class BasePolicy:
 class BearerAuthPolicy(BasePolicy):
     name = "bearer"
 
-    async def extract_token(self):
-        header_auth = self.request.headers.get("AUTHORIZATION")
+    async def extract_token(self, request=None):
+        request = request or self.request
+        header_auth = request.headers.get(self.header)
         if header_auth is not None:
             schema, _, encoded_token = header_auth.partition(" ")
             if schema.lower() == "bearer":
@@ -42,9 +44,10 @@ class BearerAuthPolicy(BasePolicy):
 class BasicAuthPolicy(BasePolicy):
     name = "basic"
 
-    async def extract_token(self, value=None):
+    async def extract_token(self, request=None, value=None):
         if value is None:
-            header_auth = self.request.headers.get("AUTHORIZATION")
+            request = request or self.request
+            header_auth = request.headers.get(self.header)
         else:
             header_auth = value
         if header_auth is not None:
@@ -1,28 +1,114 @@
+from ..cache import TTLCache
 from ..utils import run_in_threadpool
-from functools import lru_cache
 
 import argon2
+import hashlib
+import hmac
+import secrets
+
+try:
+    import bcrypt
+except ImportError:  # pragma: no cover
+    bcrypt = None
 
 ph = argon2.PasswordHasher()
 
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+
+def is_bcrypt_hash(value: str) -> bool:
+    return value.startswith(BCRYPT_PREFIXES)
+
+
+def is_password_hash(value: str) -> bool:
+    """Hashes we can verify: argon2, or bcrypt (imported users) when
+    bcrypt is installed"""
+    if is_bcrypt_hash(value):
+        return bcrypt is not None
+    return value.startswith("$argon2")
+
+
+def _to_bytes(value) -> bytes:
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return value
+
+
+class CredentialCache:
+    """
+    Remembers successful password verifications, so repeated logins
+    (or basic auth requests) don't pay a full argon2 verify.
+    Plain passwords are never stored, entries are keyed by an HMAC of
+    (stored hash, password) with a per process random key, and tagged
+    with an HMAC of the stored hash so a password change can drop them.
+    Only successful verifications are cached.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300, key=None):
+        self._key = key or secrets.token_bytes(32)
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _digest(self, *parts) -> bytes:
+        return hmac.new(
+            self._key, b"\x00".join(_to_bytes(p) for p in parts), hashlib.sha256
+        ).digest()
+
+    def verified(self, token, password) -> bool:
+        return self.cache.get(self._digest(token, password)) is True
+
+    def add(self, token, password):
+        self.cache.set(
+            self._digest(token, password),
+            True,
+            tags=(self._digest(token),),
+        )
+
+    def invalidate_hash(self, token) -> int:
+        return self.cache.invalidate_tag(self._digest(token))
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
 
 class ArgonPasswordHasher:
     algorithm = "argon2"
+    # memory used by one hash computation, in bytes (argon2 uses KiB)
+    memory_cost = ph.memory_cost * 1024
+
+    def __init__(self, executor=None, cache: CredentialCache = None):
+        # optional HashingExecutor, when not provided hashing is done
+        # on the loop default thread pool
+        self.executor = executor
+        self.cache = cache
+
+    async def run(self, func, *args, op: str = ""):
+        if self.executor is not None:
+            return await self.executor.run(func, *args, op=op)
+        return await run_in_threadpool(func, *args)
 
     async def hash_password(self, password):
         if isinstance(password, str):
             password = password.encode("utf-8")
 
-        hashed_password = await run_in_threadpool(ph.hash, password)
+        hashed_password = await self.run(ph.hash, password, op="hash")
         return hashed_password
 
     async def check_password(self, token, password) -> bool:
-        return await run_in_threadpool(
-            self.argon2_password_validator, token, password
+        if self.cache is not None and self.cache.verified(token, password):
+            return True
+        valid = await self.run(
+            self.argon2_password_validator, token, password, op="verify"
         )
+        if valid is True and self.cache is not None:
+            self.cache.add(token, password)
+        return valid
 
-    @lru_cache(100)
     def argon2_password_validator(self, token, password):
+        if token.startswith(BCRYPT_PREFIXES):
+            return bcrypt_password_validator(token, password)
         try:
             return ph.verify(token, password)
         except (
@@ -30,3 +116,18 @@ class ArgonPasswordHasher:
             argon2.exceptions.VerifyMismatchError,
         ):
             return False
+
+    def invalidate(self, token):
+        """Forget cached verifications for a stored hash"""
+        if self.cache is not None:
+            self.cache.invalidate_hash(token)
+
+
+def bcrypt_password_validator(token, password) -> bool:
+    # bcrypt is an optional dependency, only needed for imported users
+    if bcrypt is None:
+        return False
+    try:
+        return bcrypt.checkpw(_to_bytes(password), _to_bytes(token))
+    except ValueError:
+        return False
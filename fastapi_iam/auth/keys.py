@@ -0,0 +1,175 @@
+from ..utils import run_in_threadpool
+from jwt.algorithms import get_default_algorithms
+from jwt.api_jwt import decode_complete
+
+import json
+import jwt
+import typing
+
+SYMMETRIC = ("HS256", "HS384", "HS512")
+
+
+class SigningKey:
+    """
+    A key of the KeyRing.
+    Symmetric algorithms (HS*) use a shared secret and are never
+    published. Asymmetric ones (RS*, PS*, ES*, EdDSA, they need
+    PyJWT[crypto]) take PEM keys, the public key is derived from the
+    private one when not given, and keys without a private key can only
+    verify tokens.
+    """
+
+    def __init__(
+        self,
+        kid: typing.Optional[str],
+        algorithm: str,
+        *,
+        secret: str = None,
+        private_key=None,
+        public_key=None,
+    ):
+        algorithms = get_default_algorithms()
+        if algorithm not in algorithms:
+            raise ValueError(
+                f"algorithm {algorithm} not available, "
+                "asymmetric keys need PyJWT[crypto]"
+            )
+        self.kid = kid
+        self.algorithm = algorithm
+        self.jwk = None
+        if algorithm in SYMMETRIC:
+            self.signing_key = self.verifying_key = secret
+            return
+
+        algo = algorithms[algorithm]
+        self.signing_key = None
+        if private_key is not None:
+            self.signing_key = algo.prepare_key(private_key)
+        if public_key is not None:
+            self.verifying_key = algo.prepare_key(public_key)
+        elif self.signing_key is not None:
+            self.verifying_key = self.signing_key.public_key()
+        else:
+            raise ValueError(f"key {kid} needs a private or a public key")
+        self.jwk = json.loads(algo.to_jwk(self.verifying_key))
+        self.jwk.update({"kid": kid, "alg": algorithm, "use": "sig"})
+
+    @property
+    def symmetric(self) -> bool:
+        return self.algorithm in SYMMETRIC
+
+    @classmethod
+    def from_dict(cls, data: typing.Dict[str, typing.Any]) -> "SigningKey":
+        return cls(
+            data["kid"],
+            data["algorithm"],
+            secret=data.get("secret"),
+            private_key=data.get("private_key"),
+            public_key=data.get("public_key"),
+        )
+
+
+class KeyRing:
+    """
+    The keys used to sign and verify access tokens.
+    The active key signs new tokens (adding its kid to the header),
+    every key in the ring is accepted on validation, and the public
+    ones are published on /.well-known/jwks.json, so other services can
+    validate tokens by themselves.
+    Rotating keys:
+        1. add the new key, not active, and wait until clients refresh
+           their jwks cache (jwks_max_age)
+        2. make it the active key
+        3. remove the old key after jwt_expiration, when all tokens
+           signed with it are expired
+    Without jwt_keys configured, tokens are signed with jwt_secret_key
+    and jwt_algorithm, without kid.
+    Asymmetric signing is cpu bound, it runs on the thread pool.
+    """
+
+    def __init__(self, keys: typing.List[SigningKey], active: str = None):
+        self.keys: typing.Dict[typing.Optional[str], SigningKey] = {}
+        self._jwks: typing.Optional[typing.Dict[str, typing.Any]] = None
+        for key in keys:
+            self.keys[key.kid] = key
+        if active is None:
+            # the kid of a key without kid is None too
+            signing = [k.kid for k in keys if k.signing_key is not None]
+            if not signing:
+                raise ValueError("no signing key")
+            active = signing[0]
+        self.activate(active)
+
+    @classmethod
+    def from_settings(cls, settings) -> "KeyRing":
+        if not settings.get("jwt_keys"):
+            return cls(
+                [
+                    SigningKey(
+                        None,
+                        settings["jwt_algorithm"],
+                        secret=settings["jwt_secret_key"],
+                    )
+                ]
+            )
+        keys = [SigningKey.from_dict(data) for data in settings["jwt_keys"]]
+        return cls(keys, active=settings.get("jwt_active_key"))
+
+    @property
+    def active(self) -> SigningKey:
+        return self.keys[self._active]
+
+    def activate(self, kid: typing.Optional[str]):
+        if kid not in self.keys or self.keys[kid].signing_key is None:
+            raise ValueError(f"no private key for {kid}")
+        self._active = kid
+
+    def add(self, key: SigningKey, *, activate: bool = False):
+        self.keys[key.kid] = key
+        self._jwks = None
+        if activate:
+            self.activate(key.kid)
+
+    def remove(self, kid: str):
+        if kid == self._active:
+            raise ValueError("the active key can't be removed")
+        self.keys.pop(kid, None)
+        self._jwks = None
+
+    def sign(self, claims: typing.Dict[str, typing.Any]) -> str:
+        key = self.active
+        headers = {"kid": key.kid} if key.kid is not None else None
+        token = jwt.encode(
+            claims, key.signing_key, algorithm=key.algorithm, headers=headers
+        )
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+        return token
+
+    async def encode(self, claims: typing.Dict[str, typing.Any]) -> str:
+        if self.active.symmetric:
+            return self.sign(claims)
+        return await run_in_threadpool(self.sign, claims)
+
+    def decode(self, token: str) -> typing.Dict[str, typing.Any]:
+        if len(self.keys) == 1:
+            # a single key, check the kid after decoding instead of
+            # parsing the token twice
+            key = self.active
+            decoded = decode_complete(
+                token, key.verifying_key, algorithms=[key.algorithm]
+            )
+            if decoded["header"].get("kid") != key.kid:
+                raise jwt.DecodeError("unknown key")
+            return decoded["payload"]
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.keys.get(kid)
+        if key is None:
+            raise jwt.DecodeError(f"unknown key {kid}")
+        # only the algorithm of the key, no algorithm confusion
+        return jwt.decode(token, key.verifying_key, algorithms=[key.algorithm])
+
+    def jwks(self) -> typing.Dict[str, typing.Any]:
+        if self._jwks is None:
+            self._jwks = {"keys": [k.jwk for k in self.keys.values() if k.jwk]}
+        return self._jwks
@@ -1,4 +1,8 @@
 from .. import models
+from ..cache import token_key
+from ..context import AuthTimings
+from ..context import current_timings
+from ..context import set_timings
 from ..interfaces import ISessionStorage
 from ..interfaces import IUsersStorage
 from .encoders import InvalidToken
@@ -12,9 +16,14 @@ from random import randint
 
 import asyncio
 import datetime
+import inspect
+import logging
+import random
 import time
 import typing
 
+logger = logging.getLogger("fastapi_iam")
+
 InvalidUser = HTTPException(status_code=403, detail="invalid_user")
 ExpiredToken = HTTPException(status_code=417, detail="invalid_user")
 InactiveUser = HTTPException(status_code=412, detail="inactive_user")
@@ -29,6 +38,13 @@ async def invalid_user():
     )
 
 
+def stamped(user: models.User, last_login) -> models.PublicUser:
+    """the user as returned by a login, without the password"""
+    data = user.dict(exclude={"password", "token"})
+    data["last_login"] = last_login
+    return models.PublicUser(**data)
+
+
 class PersistentSecurityPolicy:
     """
     A Security policy that stores tokens on the storage
@@ -40,49 +56,171 @@ class PersistentSecurityPolicy:
     """
 
     cookie_name = "refresh"
-    hasher: ArgonPasswordHasher = ArgonPasswordHasher()
     extractors = [BearerAuthPolicy]
     encoder = JWTToken
 
     def __init__(self, iam):
+        # a policy is built once per IAM (iam.get_security_policy) and
+        # shared by all requests, so encoder, serializer and extractors
+        # are built on first use and reused
         self.iam = iam
+        self._encoder = None
+        self._serializer = None
+        self._extractors = (None, [])
+        # (hook, sample_rate) pairs, see add_timing_hook
+        self.timing_hooks: typing.List[tuple] = []
+
+    def get_encoder(self):
+        keys = self.iam.keys
+        if self._encoder is None or self._encoder.keys is not keys:
+            self._encoder = self.encoder(self.cfg, keys=keys)
+        return self._encoder
+
+    def get_extractors(self):
+        # rebuilt when the extractors of the policy class are replaced
+        classes, extractors = self._extractors
+        if classes is not self.extractors:
+            extractors = [extractor() for extractor in self.extractors]
+            self._extractors = (self.extractors, extractors)
+        return extractors
+
+    async def extract(self, request):
+        start = time.perf_counter()
+        for extractor in self.get_extractors():
+            token = await extractor.extract_token(request)
+            if token:
+                break
+        else:
+            token = None
+        self.record("extract", start)
+        return token
+
+    def record(self, stage: str, start: float):
+        """Records the time spent on an auth stage (extract, decode,
+        encode, db, hash) since start, a time.perf_counter()"""
+        metrics = self.iam.metrics
+        timings = current_timings()
+        if metrics is None and timings is None:
+            return
+        elapsed = time.perf_counter() - start
+        if metrics is not None:
+            metrics.observe("iam_auth_stage_seconds", elapsed, stage)
+        if timings is not None:
+            timings.add(stage, elapsed)
+
+    def add_timing_hook(self, hook: typing.Callable, sample_rate: float = 1):
+        """
+        hook(request, timings) is called, and awaited when it returns an
+        awaitable, after the auth part of get_current_user, login and
+        renew, with the AuthTimings of the request. sample_rate is the
+        fraction of requests passed to the hook.
+        """
+        self.timing_hooks.append((hook, sample_rate))
+
+    def start_timing(self) -> typing.Optional[AuthTimings]:
+        """Starts collecting the stage timings of the request, only with
+        settings["server_timing"] or timing hooks"""
+        if not (self.timing_hooks or self.cfg["server_timing"]):
+            return None
+        timings = AuthTimings()
+        set_timings(timings)
+        return timings
+
+    async def finish_timing(self, request, timings: AuthTimings):
+        if timings is None:
+            return
+        set_timings(None)
+        timings["total"] = time.perf_counter() - timings.started
+        for hook, sample_rate in self.timing_hooks:
+            if sample_rate < 1 and random.random() >= sample_rate:
+                continue
+            try:
+                result = hook(request, timings)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception("auth timing hook failed")
+
+    def server_timing(self, response, timings: AuthTimings):
+        """Adds the Server-Timing header, with settings["server_timing"]"""
+        if timings is not None and self.cfg["server_timing"]:
+            response.headers["Server-Timing"] = timings.header()
+
+    def count_login(self, outcome: str):
+        metrics = self.iam.metrics
+        if metrics is not None:
+            metrics.inc("iam_logins_total", outcome)
+
+    @property
+    def hasher(self) -> ArgonPasswordHasher:
+        # the hasher is owned by the iam, sharing its bounded executor
+        return self.iam.hasher
 
     async def login(
         self, username, password, request=None
     ) -> typing.Tuple[models.PublicUser, models.UserSession]:
         user_service = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
         user = await user_service.by_email(username)
+        self.record("db", start)
         if not user:
+            self.count_login("invalid_user")
             return await invalid_user()
 
         if user.is_active is False:
+            self.count_login("inactive")
             raise InactiveUser
 
+        start = time.perf_counter()
         valid = await self.hasher.check_password(user.password, password)
+        self.record("hash", start)
         if valid is False:
+            self.count_login("invalid_password")
             return await invalid_user()
 
-        user_session = await self.create_session(user)
-        await user_service.update_user(
-            user.user_id, {"last_login": datetime.datetime.utcnow()}
-        )
+        user_session = await self.build_session(user)
+        start = time.perf_counter()
+        user = await self.store_login(user_session, user)
+        self.record("db", start)
+        self.count_login("success")
         return user, user_session
 
-    async def create_session(self, user) -> models.UserSession:
+    async def build_session(self, user) -> models.UserSession:
         """
-        creates a sesssion, makes a token, and stores on the db.
-        Also fabricates a token to be usable on the refreshtoken endpoint
+        makes a token, and a refresh token to be usable
+        on the refreshtoken endpoint, without storing them
         """
-        encoder = self.encoder(self.cfg)
+        encoder = self.get_encoder()
+        start = time.perf_counter()
         token, expire = await encoder.create_access_token(user)
+        self.record("encode", start)
         refresh_token, refresh_expiration = encoder.create_refresh_token()
-        us = models.UserSession(
+        return models.UserSession(
             user_id=user.user_id,
             token=token,
             expires=expire,
             refresh_token=refresh_token,
             refresh_token_expires=refresh_expiration,
         )
+
+    async def store_login(self, user_session, user) -> models.PublicUser:
+        """stores the session and the user last_login in one round trip,
+        with the activity buffer last_login is written later"""
+        session_service = self.iam.get_service(ISessionStorage)
+        now = datetime.datetime.utcnow()
+        activity = self.iam.activity
+        if activity is None:
+            return await session_service.login(user_session, now)
+        await session_service.store(user_session, user)
+        activity.touch_login(user.user_id, now)
+        return stamped(user, now)
+
+    async def create_session(self, user) -> models.UserSession:
+        """
+        creates a sesssion, makes a token, and stores on the db.
+        Also fabricates a token to be usable on the refreshtoken endpoint
+        """
+        us = await self.build_session(user)
         session_service = self.iam.get_service(ISessionStorage)
         await session_service.create(us)
         return us
@@ -97,17 +235,63 @@ class PersistentSecurityPolicy:
         return self.iam.settings
 
     async def validate(self, token) -> models.User:
-        encoder = self.encoder(self.cfg)
+        if token.get("type") == "basic":
+            return await self.validate_basic(token)
+        encoder = self.get_encoder()
         # decode token
+        start = time.perf_counter()
         try:
-            await encoder.validate(token.get("token"))
+            claims = await encoder.validate(token.get("token"))
         except InvalidToken:
             raise InvalidUser
+        finally:
+            self.record("decode", start)
+
+        cache = self.iam.session_cache
+        if cache is not None:
+            key = token_key(token.get("token"))
+            user = cache.get(key)
+            if user is not None:
+                self.touch_session(token.get("token"))
+                return user.copy()
 
         user_service = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
         user = await user_service.by_token(token=token.get("token"))
+        self.record("db", start)
         if user is None:
             raise InvalidUser
+        if cache is not None:
+            # never keep a session longer than its token
+            ttl = claims["exp"] - time.time()
+            cache.set(key, user.copy(), ttl=ttl, tags=(user.user_id,))
+        self.touch_session(token.get("token"))
+        return user
+
+    def touch_session(self, token: str):
+        """stamps the session last_used, with settings["session_last_used"]
+        and the activity buffer"""
+        activity = self.iam.activity
+        if activity is not None and self.cfg["session_last_used"]:
+            activity.touch_session(token, datetime.datetime.utcnow())
+
+    async def validate_basic(self, token) -> models.User:
+        """Validates credentials extracted with the BasicAuthPolicy,
+        verifications are cached by the hasher, so only the first
+        request of a user pays for the hash"""
+        user_service = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
+        user = await user_service.by_email(token.get("id"))
+        self.record("db", start)
+        if user is None or user.is_active is False:
+            raise InvalidUser
+        start = time.perf_counter()
+        valid = await self.hasher.check_password(
+            user.password, token.get("token")
+        )
+        self.record("hash", start)
+        if valid is not True:
+            raise InvalidUser
         return user
 
     async def refresh(self, token) -> models.UserSession:
@@ -119,8 +303,10 @@ class PersistentSecurityPolicy:
         """
         sess_repo = self.iam.get_service(ISessionStorage)
         users_repo = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
         user = await users_repo.by_token(refresh_token=token)
         expired = await sess_repo.is_expired(token)
+        self.record("db", start)
 
         if expired is True:
             raise ExpiredToken
@@ -128,7 +314,7 @@ class PersistentSecurityPolicy:
         if user is None:
             raise InvalidUser
 
-        encoder = self.encoder(self.cfg)
+        encoder = self.get_encoder()
 
         # handle refresh token rotation
         kwargs = {}
@@ -137,9 +323,13 @@ class PersistentSecurityPolicy:
             rt, rte = encoder.create_refresh_token()
             kwargs = {"new_rt": rt, "new_rte": rte}
 
+        start = time.perf_counter()
         new_token, new_expire = await encoder.create_access_token(user)
+        self.record("encode", start)
         # update storage token
+        start = time.perf_counter()
         await sess_repo.update_token(token, new_token, new_expire, **kwargs)
+        self.record("db", start)
         return models.UserSession(
             user_id=user.user_id,
             token=new_token,
@@ -183,9 +373,11 @@ class JWTSecurityPolicy(PersistentSecurityPolicy):
     Refresh token is a signed cookie that keeps the user_id and expiration date
     """
 
-    async def create_session(self, user):
-        encoder = self.encoder(self.cfg)
+    async def build_session(self, user):
+        encoder = self.get_encoder()
+        start = time.perf_counter()
         token, expire = await encoder.create_access_token(user)
+        self.record("encode", start)
         # we must crypt the user data into the token to be able to refresh it
         refresh_token, refresh_expiration = self.create_refresh_token(user)
         us = models.UserSession(
@@ -197,20 +389,64 @@ class JWTSecurityPolicy(PersistentSecurityPolicy):
         )
         return us
 
+    async def create_session(self, user):
+        return await self.build_session(user)
+
+    async def store_login(self, user_session, user) -> models.PublicUser:
+        # no sessions stored, just stamp last_login. The outbox event is
+        # written with the stamp, so it's never buffered then
+        now = datetime.datetime.utcnow()
+        activity = self.iam.activity
+        if activity is not None and not self.cfg["outbox"]:
+            activity.touch_login(user.user_id, now)
+            return stamped(user, now)
+        user_service = self.iam.get_service(IUsersStorage)
+        return await user_service.set_last_login(user_session.user_id, now)
+
     async def validate(self, token):
-        encoder = self.encoder(self.cfg)
+        if token.get("type") == "basic":
+            return await self.validate_basic(token)
+        encoder = self.get_encoder()
         # decode token
+        start = time.perf_counter()
         try:
             result = await encoder.validate(token.get("token"))
         except InvalidToken:
             raise InvalidUser
+        finally:
+            self.record("decode", start)
+
+        if self.cfg["jwt_claims_only"]:
+            return await self.validate_claims(result)
 
         user_service = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
         user = await user_service.by_id(result["sub"])
+        self.record("db", start)
         if user is None:
             raise InvalidUser
         return user
 
+    async def validate_claims(self, claims) -> models.User:
+        """
+        Builds the user from the verified claims, without db access.
+        Tokens older than jwt_claims_max_age (or issued without the
+        user claims) are checked against the db, so disabled or deleted
+        users are rejected after max age instead of on expiration.
+        """
+        max_age = self.cfg["jwt_claims_max_age"]
+        age = time.time() - claims.get("iat", 0)
+        if "groups" in claims and (max_age is None or age <= max_age):
+            return models.User.from_jwt_claims(claims)
+
+        user_service = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
+        user = await user_service.by_id(claims["sub"])
+        self.record("db", start)
+        if user is None or user.is_active is False:
+            raise InvalidUser
+        return user
+
     def create_refresh_token(self, user):
         expire = datetime.datetime.utcnow() + datetime.timedelta(
             seconds=self.cfg["session_expiration"]
@@ -234,7 +470,11 @@ class JWTSecurityPolicy(PersistentSecurityPolicy):
 
     @property
     def serializer(self):
-        return URLSafeSerializer(self.cfg["refresh_token_secret_key"])
+        if self._serializer is None:
+            self._serializer = URLSafeSerializer(
+                self.cfg["refresh_token_secret_key"]
+            )
+        return self._serializer
 
     async def refresh(self, token):
         try:
@@ -242,7 +482,9 @@ class JWTSecurityPolicy(PersistentSecurityPolicy):
         except InvalidRefreshToken:
             raise InvalidUser
         users_repo = self.iam.get_service(IUsersStorage)
+        start = time.perf_counter()
         user = await users_repo.by_id(user_id)
+        self.record("db", start)
         if not user:
             raise InvalidUser
 
@@ -250,8 +492,10 @@ class JWTSecurityPolicy(PersistentSecurityPolicy):
         if self.cfg["rotate_refresh_tokens"] is True:
             rt, rte = self.create_refresh_token(user)
 
-        encoder = self.encoder(self.cfg)
+        encoder = self.get_encoder()
+        start = time.perf_counter()
         new_token, new_expire = await encoder.create_access_token(user)
+        self.record("encode", start)
         return models.UserSession(
             user_id=user.user_id,
             token=new_token,
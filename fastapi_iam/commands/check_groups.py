@@ -0,0 +1,56 @@
+from argparse import ArgumentParser
+from fastapi_iam.services.pg import UserStorage
+
+import asyncio
+import asyncpg
+import os
+import sys
+import textwrap
+
+parser = ArgumentParser()
+parser.add_argument("--dsn", help="postgres-dsn")
+parser.add_argument("--schema", help="postgres schema")
+parser.add_argument(
+    "--repair",
+    action="store_true",
+    help="rewrite users groups from users_group",
+)
+
+
+async def check_groups():
+    args = parser.parse_args()
+    env_dsn = os.getenv("DB_DSN", None)
+    env_schema = os.getenv("DB_SCHEMA", None) or args.schema or ""
+    dbdsn = env_dsn or args.dsn
+    if dbdsn is None:
+        print(textwrap.dedent("""
+        >>>> ERROR!
+        Provide a -dsn argument or a DB_DSN env variable with
+        your postgresql configuration.
+        This script checks that the groups stored on the users table
+        match the users_group memberships.
+
+        """))
+        sys.exit(1)
+
+    db = await asyncpg.connect(dsn=dbdsn)
+    repo = UserStorage(db, schema=env_schema)
+    drift = await repo.check_groups(repair=args.repair)
+    for row in drift:
+        print(
+            f"user_id={row['user_id']} stored={row['stored']} "
+            f"expected={row['expected']}"
+        )
+    action = "REPAIRED" if args.repair else "FOUND"
+    print(f"{len(drift)} users with drifted groups {action}")
+    await db.close()
+    if drift and not args.repair:
+        sys.exit(2)
+
+
+def main():
+    asyncio.run(check_groups())
+
+
+if __name__ == "__main__":
+    main()
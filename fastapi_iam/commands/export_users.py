@@ -0,0 +1,69 @@
+from argparse import ArgumentParser
+from fastapi_iam.export import FORMATS
+from fastapi_iam.services.pg import UserStorage
+
+import asyncio
+import asyncpg
+import os
+import sys
+import textwrap
+
+
+def to_bool(value):
+    return value.lower() in ("1", "true", "yes")
+
+
+parser = ArgumentParser()
+parser.add_argument("--dsn", help="postgres-dsn")
+parser.add_argument("--schema", help="postgres schema")
+parser.add_argument("--format", choices=list(FORMATS), default="ndjson")
+parser.add_argument("--output", help="output file, defaults to stdout")
+parser.add_argument("--prefetch", type=int, default=1000)
+parser.add_argument("--q", help="email filter, like in GET /users")
+parser.add_argument("--is-staff", type=to_bool)
+parser.add_argument("--is-active", type=to_bool)
+parser.add_argument("--is-admin", type=to_bool)
+
+
+async def export_users():
+    args = parser.parse_args()
+    env_dsn = os.getenv("DB_DSN", None)
+    env_schema = os.getenv("DB_SCHEMA", None) or args.schema or ""
+    dbdsn = env_dsn or args.dsn
+    if dbdsn is None:
+        print(textwrap.dedent("""
+        >>>> ERROR!
+        Provide a -dsn argument or a DB_DSN env variable with
+        your postgresql configuration.
+        This script streams all users (or a filtered subset)
+        as ndjson or csv.
+
+        """))
+        sys.exit(1)
+
+    db = await asyncpg.connect(dsn=dbdsn)
+    repo = UserStorage(db, schema=env_schema)
+    _, encoder = FORMATS[args.format]
+    rows = repo.export(
+        q=args.q,
+        is_staff=args.is_staff,
+        is_active=args.is_active,
+        is_admin=args.is_admin,
+        prefetch=args.prefetch,
+    )
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        async for chunk in encoder(rows):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await db.close()
+
+
+def main():
+    asyncio.run(export_users())
+
+
+if __name__ == "__main__":
+    main()
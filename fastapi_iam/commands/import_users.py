@@ -0,0 +1,94 @@
+from argparse import ArgumentParser
+from fastapi_iam.auth.executor import HashingExecutor
+from fastapi_iam.auth.hasher import ArgonPasswordHasher
+from fastapi_iam.importer import PARSERS
+from fastapi_iam.importer import UserImporter
+from fastapi_iam.services.pg import UserStorage
+
+import asyncio
+import asyncpg
+import os
+import sys
+import textwrap
+
+parser = ArgumentParser()
+parser.add_argument("--dsn", help="postgres-dsn")
+parser.add_argument("--schema", help="postgres schema")
+parser.add_argument("input", help="csv or ndjson file, - for stdin")
+parser.add_argument("--format", choices=list(PARSERS))
+parser.add_argument("--batch-size", type=int, default=1000)
+parser.add_argument("--workers", type=int, help="hashing threads")
+parser.add_argument(
+    "--memory-budget", type=int, help="max MiB used by argon2 hashing"
+)
+parser.add_argument(
+    "--no-update",
+    action="store_true",
+    help="skip existing users instead of updating them",
+)
+
+
+def print_progress(report):
+    print(
+        f"{report['rows']} rows, {report['created']} created, "
+        f"{report['updated']} updated, {report['skipped']} skipped "
+        f"({report['rate']:.0f} rows/s)",
+        file=sys.stderr,
+    )
+
+
+async def import_users():
+    args = parser.parse_args()
+    env_dsn = os.getenv("DB_DSN", None)
+    env_schema = os.getenv("DB_SCHEMA", None) or args.schema or ""
+    dbdsn = env_dsn or args.dsn
+    if dbdsn is None:
+        print(textwrap.dedent("""
+        >>>> ERROR!
+        Provide a -dsn argument or a DB_DSN env variable with
+        your postgresql configuration.
+        This script imports users from a csv or ndjson file, hashing
+        plain passwords (password) or keeping argon2/bcrypt hashes
+        (password_hash).
+
+        """))
+        sys.exit(1)
+
+    fmt = args.format or ("csv" if args.input.endswith(".csv") else "ndjson")
+    memory_budget = args.memory_budget and args.memory_budget * 1024 * 1024
+    executor = HashingExecutor(
+        workers=args.workers,
+        queue_size=args.batch_size,
+        memory_budget=memory_budget,
+        memory_cost=ArgonPasswordHasher.memory_cost,
+    )
+    importer = UserImporter(
+        ArgonPasswordHasher(executor=executor),
+        batch_size=args.batch_size,
+        update_existing=not args.no_update,
+        on_progress=print_progress,
+    )
+    db = await asyncpg.connect(dsn=dbdsn)
+    repo = UserStorage(db, schema=env_schema)
+    source = sys.stdin if args.input == "-" else open(args.input)
+    try:
+        report = await importer.run(repo, PARSERS[fmt](source))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        executor.shutdown()
+        await db.close()
+    for error in report["errors"]:
+        print(f"row {error['row']}: {error['error']}", file=sys.stderr)
+    print(
+        f"{report['created']} users created, {report['updated']} updated, "
+        f"{report['skipped']} skipped in {report['elapsed']:.1f}s"
+    )
+
+
+def main():
+    asyncio.run(import_users())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+from argparse import ArgumentParser
+from fastapi import FastAPI
+from fastapi_asyncpg import configure_asyncpg
+from fastapi_iam import auth
+from fastapi_iam import configure_iam
+from fastapi_iam.auth.hasher import ArgonPasswordHasher
+from fastapi_iam.loadtest import ASGIClient
+from fastapi_iam.loadtest import delete_seeded
+from fastapi_iam.loadtest import HTTPClient
+from fastapi_iam.loadtest import LoadTest
+from fastapi_iam.loadtest import parse_mix
+from fastapi_iam.loadtest import RouteQueries
+from fastapi_iam.loadtest import seed_users
+from fastapi_iam.services.pg import UserStorage
+
+import asyncio
+import asyncpg
+import json
+import os
+import secrets
+import sys
+import textwrap
+
+POLICIES = {
+    "persistent": auth.PersistentSecurityPolicy,
+    "jwt": auth.JWTSecurityPolicy,
+}
+
+parser = ArgumentParser()
+parser.add_argument("--dsn", help="postgres-dsn")
+parser.add_argument("--schema", help="postgres schema")
+parser.add_argument(
+    "--url", help="base url of a running app, in process app by default"
+)
+parser.add_argument("--prefix", default="/auth", help="iam routes prefix")
+parser.add_argument("--policy", choices=list(POLICIES), default="persistent")
+parser.add_argument("--users", type=int, default=100, help="users to seed")
+parser.add_argument("--groups", type=int, default=0, help="groups per user")
+parser.add_argument("--password", default="loadtest")
+parser.add_argument(
+    "--mix",
+    type=parse_mix,
+    default="login=1,whoami=8,renew=1,logout=0",
+    help="route weights",
+)
+parser.add_argument("--concurrency", type=int, default=10)
+parser.add_argument("--rate", type=float, help="target requests/s")
+parser.add_argument("--duration", type=float, default=10, help="seconds")
+parser.add_argument("--requests", type=int, help="stop after n requests")
+parser.add_argument("--pool-size", type=int, default=10)
+parser.add_argument("--no-seed", action="store_true")
+parser.add_argument("--cleanup", action="store_true", help="drop seed users")
+parser.add_argument("--json", action="store_true", help="json report")
+
+
+def build_app(dsn, schema, policy, pool_size, queries):
+    app = FastAPI()
+    iam = configure_iam(
+        {"db_schema": schema, "jwt_secret_key": secrets.token_hex(32)},
+        security_policy=policy,
+    )
+
+    async def init(conn):
+        await iam.init_connection(conn)
+        conn.add_query_logger(queries)
+
+    db = configure_asyncpg(
+        app,
+        dsn,
+        init_db=iam.initialize_iam_db,
+        init=init,
+        min_size=pool_size,
+        max_size=pool_size,
+    )
+    iam.set_asyncpg(db)
+    app.include_router(iam.router, prefix="/auth")
+    return app
+
+
+def print_report(report):
+    print(
+        f"{report['requests']} requests in {report['elapsed']:.1f}s, "
+        f"{report['throughput']:.1f} req/s, {report['errors']} errors"
+    )
+    print(
+        f"{'route':8} {'requests':>9} {'errors':>7} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}"
+    )
+    for route, stats in report["routes"].items():
+        queries = stats.get("queries")
+        queries = "-" if queries is None else f"{queries:.2f}"
+        print(
+            f"{route:8} {stats['requests']:9} {stats['errors']:7} "
+            f"{stats['rps']:8.1f} {stats['p50']:8.2f} {stats['p95']:8.2f} "
+            f"{stats['p99']:8.2f} {queries:>8}"
+        )
+
+
+async def loadtest():
+    args = parser.parse_args()
+    env_dsn = os.getenv("DB_DSN", None)
+    env_schema = os.getenv("DB_SCHEMA", None) or args.schema or ""
+    dbdsn = env_dsn or args.dsn
+    if dbdsn is None and (args.url is None or not args.no_seed):
+        print(textwrap.dedent("""
+        >>>> ERROR!
+        Provide a -dsn argument or a DB_DSN env variable with
+        your postgresql configuration.
+        This script seeds users and drives a mix of login, whoami,
+        renew and logout requests against an in process app, or
+        a running one (--url, users seeded with --dsn or --no-seed).
+
+        """))
+        sys.exit(1)
+
+    policy = POLICIES[args.policy]
+    emails = [f"loadtest-{i}@loadtest.invalid" for i in range(args.users)]
+    if not args.no_seed:
+        db = await asyncpg.connect(dsn=dbdsn)
+        try:
+            hashed = await ArgonPasswordHasher().hash_password(args.password)
+            repo = UserStorage(db, schema=env_schema)
+            emails = await seed_users(
+                repo, args.users, hashed, groups=args.groups
+            )
+        finally:
+            await db.close()
+
+    queries = None
+    if args.url:
+        client = HTTPClient(args.url, concurrency=args.concurrency)
+    else:
+        queries = RouteQueries()
+        app = build_app(dbdsn, env_schema, policy, args.pool_size, queries)
+        client = ASGIClient(app)
+
+    async with client:
+        report = await LoadTest(
+            client,
+            [(email, args.password) for email in emails],
+            mix=args.mix,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            duration=None if args.requests else args.duration,
+            requests=args.requests,
+            prefix=args.prefix if args.url else "/auth",
+            cookie_name=policy.cookie_name,
+            queries=queries,
+        ).run()
+
+    if args.cleanup and dbdsn is not None:
+        db = await asyncpg.connect(dsn=dbdsn)
+        try:
+            schema = f"{env_schema}." if env_schema else ""
+            await delete_seeded(db, schema)
+        finally:
+            await db.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+def main():
+    asyncio.run(loadtest())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import time
+import typing
+
+# connection bound to the current request, see provider.bind_connection
+_connection: ContextVar = ContextVar("fastapi_iam_connection", default=None)
+# auth stage timings of the current request, when collected
+_timings: ContextVar = ContextVar("fastapi_iam_timings", default=None)
+
+
+def current_connection():
+    return _connection.get()
+
+
+def set_connection(db):
+    _connection.set(db)
+
+
+def current_timings() -> typing.Optional["AuthTimings"]:
+    return _timings.get()
+
+
+def set_timings(timings: typing.Optional["AuthTimings"]):
+    _timings.set(timings)
+
+
+class AuthTimings(dict):
+    """Seconds spent on each auth stage of a request (extract, decode,
+    encode, db, hash), total is added when auth is done"""
+
+    def __init__(self):
+        super().__init__()
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, elapsed: float):
+        self[stage] = self.get(stage, 0.0) + elapsed
+
+    def header(self) -> str:
+        """Server-Timing header value, durations in ms"""
+        return ", ".join(f"{k};dur={v * 1000:.3f}" for k, v in self.items())
+
+
+class PoolStats:
+    """Tracks how long requests wait to get a pool connection"""
+
+    def __init__(self):
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+
+    def observe(self, waited: float):
+        self.acquired += 1
+        self.wait_time += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "acquired": self.acquired,
+            "wait_time_avg": self.wait_time / (self.acquired or 1),
+            "wait_time_max": self.wait_time_max,
+        }
+
+
+@asynccontextmanager
+async def acquire(pool, stats: PoolStats, *, transaction: bool = False):
+    start = time.monotonic()
+    async with pool.acquire() as db:
+        stats.observe(time.monotonic() - start)
+        if transaction:
+            async with db.transaction():
+                yield db
+        else:
+            yield db
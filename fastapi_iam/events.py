@@ -1,7 +1,13 @@
+from .context import set_connection
+from .tasks import BackgroundTask
 from typing import Protocol
 
+import asyncio
+import logging
 import typing
 
+logger = logging.getLogger("fastapi_iam")
+
 
 class IEvent(Protocol):
     pass
@@ -11,9 +17,9 @@ events: typing.Dict[IEvent, typing.List[typing.Callable]] = {}
 
 
 async def notify(event: IEvent):
-    if event.__class__ in events:
-        for func in events[event.__class__]:
-            await func(event)
+    subscribers = events.get(event.__class__)
+    if subscribers:
+        await dispatcher.dispatch(event, subscribers)
 
 
 class subscriber:
@@ -31,6 +37,203 @@ def add_subscriber(event, func):
     events[event].append(func)
 
 
+async def unbound(func, event):
+    """Runs a subscriber without the connection bound to the request
+    (see provider.bind_connection), an asyncpg connection can't be used
+    by concurrent subscribers, nor by them and the request"""
+    set_connection(None)
+    await func(event)
+
+
+class SequentialDispatcher:
+    """Awaits subscribers one after another inside notify,
+    a subscriber error is raised to the caller"""
+
+    def __init__(self):
+        self.dispatched = 0
+
+    async def dispatch(self, event, subscribers):
+        self.dispatched += 1
+        for func in subscribers:
+            await func(event)
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {"dispatched": self.dispatched}
+
+
+class ConcurrentDispatcher:
+    """
+    Runs the subscribers of an event concurrently, each one limited to
+    `timeout` seconds. Errors and timeouts are logged and counted,
+    never raised, so a failing subscriber can't break a login.
+    """
+
+    def __init__(self, *, timeout: float = None):
+        self.timeout = timeout
+        self.dispatched = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    async def dispatch(self, event, subscribers):
+        self.dispatched += 1
+        if len(subscribers) == 1:
+            await self.call(subscribers[0], event)
+        else:
+            await asyncio.gather(*(self.call(f, event) for f in subscribers))
+
+    async def call(self, func, event):
+        try:
+            # a task copies the context, unbound only clears its own copy
+            task = asyncio.ensure_future(unbound(func, event))
+            if self.timeout:
+                await asyncio.wait_for(task, self.timeout)
+            else:
+                await task
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(
+                "subscriber %s timed out on %s", func, type(event).__name__
+            )
+        except Exception:
+            self.errors += 1
+            logger.exception(
+                "subscriber %s failed on %s", func, type(event).__name__
+            )
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "dispatched": self.dispatched,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
+
+
+class QueueDispatcher(BackgroundTask):
+    """
+    Hands events to a bounded queue drained by `workers` background
+    workers, notify returns as soon as the event is queued. Subscribers
+    run like in the ConcurrentDispatcher (timeouts, isolated errors).
+    When the queue is full, overflow "drop" discards the event (counted
+    on dropped), and "block" waits for room (backpressure).
+    Registered as an IAM task, so workers are only started (and stopped)
+    by the app lifespan, on shutdown the queue is drained for up to
+    `drain_timeout` seconds. Without running workers, before startup or
+    after shutdown, events are delivered in place.
+    """
+
+    name = "events"
+
+    def __init__(
+        self,
+        *,
+        maxsize: int = 1000,
+        workers: int = 4,
+        timeout: float = 5,
+        overflow: str = "drop",
+        drain_timeout: float = 5,
+    ):
+        super().__init__()
+        assert overflow in ("drop", "block"), "drop or block"
+        self.maxsize = maxsize
+        self.workers = workers
+        self.overflow = overflow
+        self.drain_timeout = drain_timeout
+        self.runner = ConcurrentDispatcher(timeout=timeout)
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self.queued = 0
+        self.dropped = 0
+        self.queue_depth_max = 0
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # created on the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        return self._queue
+
+    async def dispatch(self, event, subscribers):
+        if not self.running:
+            # workers started here would inherit this request context
+            await self.runner.dispatch(event, subscribers)
+            return
+        item = (event, subscribers)
+        if self.overflow == "block":
+            await self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                return
+        self.queued += 1
+        self.queue_depth_max = max(self.queue_depth_max, self.queue.qsize())
+
+    async def run(self):
+        await asyncio.gather(*(self.worker() for _ in range(self.workers)))
+
+    async def worker(self):
+        queue = self.queue
+        while True:
+            event, subscribers = await queue.get()
+            try:
+                await self.runner.dispatch(event, subscribers)
+            finally:
+                queue.task_done()
+
+    async def drain(self):
+        """waits until all queued events are delivered"""
+        await self.queue.join()
+
+    async def stop(self):
+        if self.running and self.drain_timeout:
+            try:
+                await asyncio.wait_for(self.drain(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "%d events not delivered on shutdown", self.queue.qsize()
+                )
+        await super().stop()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        stats = self.runner.stats()
+        stats.update(
+            {
+                "queue_size": self.maxsize,
+                "queue_depth": self.queue.qsize() if self._queue else 0,
+                "queue_depth_max": self.queue_depth_max,
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "workers": self.workers,
+                "running": self.running,
+            }
+        )
+        return stats
+
+
+def build_dispatcher(settings):
+    mode = settings["events_dispatcher"]
+    if mode == "sequential":
+        return SequentialDispatcher()
+    if mode == "concurrent":
+        return ConcurrentDispatcher(timeout=settings["events_timeout"])
+    if mode == "queue":
+        return QueueDispatcher(
+            maxsize=settings["events_queue_size"],
+            workers=settings["events_workers"],
+            timeout=settings["events_timeout"],
+            overflow=settings["events_overflow"],
+        )
+    raise ValueError(f"unknown events_dispatcher {mode}")
+
+
+dispatcher = SequentialDispatcher()
+
+
+def set_dispatcher(new):
+    global dispatcher
+    dispatcher = new
+
+
 class UserLogin:
     def __init__(self, user, token):
         self.user = user
@@ -0,0 +1,72 @@
+import csv
+import datetime
+import io
+import json
+import typing
+
+Rows = typing.AsyncIterator[typing.Mapping]
+
+# public user columns, password is never exported
+EXPORT_COLUMNS = (
+    "user_id",
+    "email",
+    "username",
+    "is_staff",
+    "is_active",
+    "is_admin",
+    "date_joined",
+    "last_login",
+    "groups",
+)
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value)} is not serializable")
+
+
+async def to_ndjson(rows: Rows, chunk_size: int = 500):
+    """One json object per line"""
+    lines = []
+    async for row in rows:
+        lines.append(json.dumps(dict(row), default=_default) + "\n")
+        if len(lines) >= chunk_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+async def to_csv(rows: Rows, chunk_size: int = 500):
+    """A header plus one line per row, groups are comma separated"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    pending = 0
+    async for row in rows:
+        writer.writerow([_csv_value(row[c]) for c in EXPORT_COLUMNS])
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue()
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ",".join(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+# format: (media type, encoder)
+FORMATS = {
+    "ndjson": ("application/x-ndjson", to_ndjson),
+    "csv": ("text/csv", to_csv),
+}
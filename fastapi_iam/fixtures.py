@@ -47,12 +47,37 @@ async def conn(pool):
         yield db
 
 
+# storages the app fixtures run against
+STORAGES = ("pg", "memory", "sqlite")
+
+# for tests poking postgresql directly
+pg_only = pytest.mark.parametrize("storage", ["pg"])
+
+
+@pytest.fixture(params=STORAGES)
+def storage(request):
+    return request.param
+
+
+@pytest.fixture
+def storage_pool(request, storage):
+    # postgresql is only started for the pg storage
+    if storage == "pg":
+        return request.getfixturevalue("pool")
+    return None
+
+
 @pytest.fixture
-async def theapp(pool):
+async def theapp(request, storage, storage_pool):
     app = FastAPI()
-    db = configure_asyncpg(app, "", pool=pool)
-    settings = {}
-    iam = configure_iam(settings, fastapi_asyncpg=db)
+    if storage == "pg":
+        db = configure_asyncpg(app, "", pool=storage_pool)
+        iam = configure_iam({}, fastapi_asyncpg=db)
+    elif storage == "sqlite":
+        path = request.getfixturevalue("tmp_path") / "iam.sqlite3"
+        iam = configure_iam({"storage": storage, "sqlite_path": str(path)})
+    else:
+        iam = configure_iam({"storage": storage})
     app.include_router(iam.router, prefix="/auth")
     yield iam, app
 
@@ -0,0 +1,185 @@
+from .auth.hasher import is_bcrypt_hash
+from .auth.hasher import is_password_hash
+
+import asyncio
+import csv
+import json
+import time
+import typing
+
+# bulk import staging columns, in COPY order
+IMPORT_COLUMNS = (
+    "n",
+    "email",
+    "password",
+    "username",
+    "is_staff",
+    "is_active",
+    "is_admin",
+    "groups",
+)
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def parse_ndjson(lines: typing.Iterable[str]):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def parse_csv(lines: typing.Iterable[str]):
+    for row in csv.DictReader(lines):
+        if "groups" in row:
+            groups = row["groups"] or ""
+            row["groups"] = [g for g in groups.split(",") if g]
+        yield row
+
+
+PARSERS = {"ndjson": parse_ndjson, "csv": parse_csv}
+
+
+def _bool(value) -> bool:
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+class UserImporter:
+    """
+    Imports users in batches, a row is a mapping with:
+        email, password (plain) or password_hash (argon2 or bcrypt),
+        username, is_staff, is_active, is_admin, groups
+    Plain passwords are hashed concurrently on the hasher executor,
+    limited to `concurrency` jobs in flight (half its workers by
+    default), so logins always find room on the executor queue.
+    Pre hashed passwords are kept as is, bcrypt ones are only accepted
+    when bcrypt is installed.
+    Every batch is stored with IUsersStorage.bulk_import, and after
+    every batch on_progress is called with the current report.
+    """
+
+    def __init__(
+        self,
+        hasher,
+        *,
+        batch_size: int = 1000,
+        concurrency: int = None,
+        update_existing: bool = True,
+        on_progress: typing.Callable[[dict], typing.Any] = None,
+        max_errors: int = 100,
+    ):
+        self.hasher = hasher
+        self.batch_size = batch_size
+        executor = getattr(hasher, "executor", None)
+        if concurrency is None:
+            workers = executor.workers if executor else 4
+            concurrency = max(1, workers // 2)
+        self.concurrency = concurrency
+        self.update_existing = update_existing
+        self.on_progress = on_progress
+        self.max_errors = max_errors
+        self.report = {
+            "rows": 0,
+            "created": 0,
+            "updated": 0,
+            "skipped": 0,
+            "hashed": 0,
+            "errors": [],
+            "elapsed": 0.0,
+            "rate": 0.0,
+        }
+
+    async def run(self, repo, rows: typing.Iterable[typing.Mapping]):
+        started = time.monotonic()
+        batch = []
+        for n, row in enumerate(rows, start=1):
+            batch.append((n, row))
+            if len(batch) >= self.batch_size:
+                await self.import_batch(repo, batch, started)
+                batch = []
+        if batch:
+            await self.import_batch(repo, batch, started)
+        return self.report
+
+    async def import_batch(self, repo, batch, started: float):
+        records = []
+        to_hash = []
+        for n, row in batch:
+            try:
+                record, plain = self.to_record(n, row)
+            except InvalidRow as e:
+                self.error(n, str(e))
+                continue
+            records.append(record)
+            if plain is not None:
+                to_hash.append((len(records) - 1, plain))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def hash_password(idx, plain):
+            async with semaphore:
+                hashed = await self.hasher.hash_password(plain)
+            records[idx][2] = hashed
+
+        await asyncio.gather(*(hash_password(i, p) for i, p in to_hash))
+        self.report["hashed"] += len(to_hash)
+
+        result = {"created": 0, "updated": 0}
+        if records:
+            result = await repo.bulk_import(
+                [tuple(r) for r in records],
+                update_existing=self.update_existing,
+            )
+        report = self.report
+        report["rows"] += len(batch)
+        report["created"] += result["created"]
+        report["updated"] += result["updated"]
+        report["skipped"] += (
+            len(records) - result["created"] - result["updated"]
+        )
+        report["elapsed"] = time.monotonic() - started
+        report["rate"] = report["rows"] / (report["elapsed"] or 1)
+        if self.on_progress is not None:
+            self.on_progress(report)
+
+    def to_record(self, n: int, row: typing.Mapping):
+        # emails are stored lowercased, so rows differing only in case
+        # are the same user (the last one wins)
+        email = (row.get("email") or "").strip().lower()
+        if not email:
+            raise InvalidRow("missing email")
+        plain = row.get("password") or None
+        hashed = row.get("password_hash") or None
+        if hashed is not None:
+            if not is_password_hash(hashed):
+                if is_bcrypt_hash(hashed):
+                    # it could never be verified on login
+                    raise InvalidRow("bcrypt password_hash, install bcrypt")
+                raise InvalidRow("unsupported password_hash")
+            plain = None
+        elif plain is None:
+            raise InvalidRow("missing password")
+        groups = row.get("groups") or []
+        if isinstance(groups, str):
+            groups = [g for g in groups.split(",") if g]
+        record = [
+            n,
+            email,
+            hashed,
+            row.get("username") or None,
+            _bool(row.get("is_staff", False)),
+            _bool(row.get("is_active", True)),
+            _bool(row.get("is_admin", False)),
+            sorted(set(groups)),
+        ]
+        return record, plain
+
+    def error(self, n: int, message: str):
+        errors = self.report["errors"]
+        if len(errors) < self.max_errors:
+            errors.append({"row": n, "error": message})
+        self.report["skipped"] += 1
@@ -1,6 +1,8 @@
+from .services.pg import partitions
 from pathlib import Path
 
 import asyncpg
+import datetime
 import glob
 import logging
 import typing
@@ -20,9 +22,9 @@ def load_migration(name: str):
         return f.read()
 
 
-def get_available():
+def get_available(path: Path = None):
     files: typing.Dict[int, str] = {}
-    path = str(get_migrations_path())
+    path = str(path or get_migrations_path())
     for item in glob.glob(f"{path}/*.up.sql"):
         file = item.replace(path + "/", "")
         version = int(file.split("_")[0])
@@ -58,3 +60,66 @@ async def initialize_db(settings, db):
 
     if applied == current:
         logger.info("No migrations applied")
+
+    if settings.get("session_partitions"):
+        await partition_sessions(settings, db)
+
+    if settings.get("outbox"):
+        await create_outbox(settings, db)
+
+
+async def partition_sessions(settings, db) -> bool:
+    """Applies the optional users_session partitioning migration,
+    if the table is not already partitioned"""
+    schema = f"{settings['db_schema']}." if settings["db_schema"] else ""
+    if await partitions.is_partitioned(db, schema):
+        await upgrade_partitions(settings, db, schema)
+        return False
+    async with db.transaction():
+        if settings["db_schema"]:
+            await db.execute(f"set schema '{settings['db_schema']}'")
+        await db.execute(
+            load_migration("optional/sessions_partitions_functions.sql")
+        )
+        await db.execute(load_migration("optional/sessions_partitioned.sql"))
+        # room for the sessions created from now on
+        now = datetime.datetime.utcnow()
+        until = partitions.partitions_until(
+            now, settings.get("session_expiration", 0)
+        )
+        await partitions.create_partitions(db, schema, now, until)
+    logger.info("users_session partitioned")
+    return True
+
+
+async def upgrade_partitions(settings, db, schema: str):
+    """Tables partitioned by older versions had no default partition
+    (nor the reaper index)"""
+    default = await db.fetchval(
+        "SELECT to_regclass($1)", f"{schema}users_session_default"
+    )
+    if default is not None:
+        return
+    async with db.transaction():
+        if settings["db_schema"]:
+            await db.execute(f"set schema '{settings['db_schema']}'")
+        await db.execute(
+            load_migration("optional/sessions_partitions_functions.sql")
+        )
+        await db.execute(
+            "CREATE TABLE users_session_default "
+            "PARTITION OF users_session DEFAULT"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS users_session_expires_idx on "
+            "users_session using btree(refresh_token_expires)"
+        )
+    logger.info("users_session default partition created")
+
+
+async def create_outbox(settings, db):
+    """Applies the optional users_outbox migration"""
+    async with db.transaction():
+        if settings["db_schema"]:
+            await db.execute(f"set schema '{settings['db_schema']}'")
+        await db.execute(load_migration("optional/outbox.sql"))
@@ -12,6 +12,9 @@ class IIAM(Protocol):
     settings: typing.Dict[str, typing.Any]
 
     security_policy: ISecurityPolicy
+    hasher: typing.Any  # password hasher, shared by all policy instances
+    keys: typing.Any  # auth.KeyRing, signs and validates access tokens
+    metrics: typing.Any  # optional metrics.MetricsSink
     services: typing.Dict[typing.Any, typing.Any]  # a registry for service
     # factory for each service
     services_factory: typing.Dict[typing.Any, typing.Callable]
@@ -19,12 +22,13 @@ class IIAM(Protocol):
     def get_security_policy(self) -> "ISecurityPolicy":
         pass
 
-    def get_service(self, service_type):
+    def get_service(self, service_type, *, db=None):
         """Given a registered IService, factorizes an instance of it
         ready to be used. If no factory declared, it uses
             settings["default_service_factory"]
         This is mostly used to inject a db connection or other settings
-        into a service.
+        into a service. When db is provided, the service is bound to it,
+        otherwise to the request connection (if any) or the pool.
         """
         pass
 
@@ -53,6 +57,14 @@ class ISecurityPolicy(Protocol):
         """ Vadlidates a session and returns the avaialble user"""
         pass
 
+    async def extract(self, request) -> typing.Optional[dict]:
+        """ Extracts the token from the request with the policy extractors"""
+        pass
+
+    def add_timing_hook(self, hook: typing.Callable, sample_rate: float = 1):
+        """ hook(request, timings) receives the auth stage timings"""
+        pass
+
     async def refresh(self, refresh_token) -> models.UserSession:
         """ Creates a new access token and stores it using the refresh token"""
         pass
@@ -84,6 +96,21 @@ class IUsersStorage(Protocol):
     async def update_user(self, user, data):
         pass
 
+    def export(self, **filters):
+        """Async iterator over all matching users, without password"""
+        pass
+
+    async def bulk_import(self, records, *, update_existing=True):
+        """Upserts a batch of users, returns created and updated counts"""
+        pass
+
+    async def set_last_login(self, user_id, last_login):
+        pass
+
+    async def flush_last_login(self, user_ids, last_login):
+        """Stamps last_login of many users, lists of the same length"""
+        pass
+
     async def update_groups(self, user, groups):
         pass
 
@@ -107,12 +134,29 @@ class ISessionStorage(Protocol):
     async def create(self, user_session):
         pass
 
+    async def login(self, user_session, last_login):
+        """Stores the session and stamps user last_login,
+        returns the public user"""
+        pass
+
+    async def store(self, user_session, user):
+        """Stores the session without stamping user last_login"""
+        pass
+
+    async def flush_last_used(self, tokens, last_used):
+        """Stamps last_used of many sessions, lists of the same length"""
+        pass
+
     async def is_expired(self, refresh_token):
         pass
 
     async def delete(self, token):
         pass
 
+    async def reap_expired(self, before, limit):
+        """Deletes a batch of expired sessions, returns the count"""
+        pass
+
     async def update_token(
         self, refresh_token, token, expires, new_rt=None, new_rte=None
     ):
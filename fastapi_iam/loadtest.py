@@ -0,0 +1,290 @@
+from .utils import auth_header
+from .utils import TRANSACTION_STATEMENTS
+
+import asyncio
+import collections
+import contextvars
+import random
+import time
+import typing
+
+ROUTES = ("login", "whoami", "renew", "logout")
+DEFAULT_MIX = {"login": 1, "whoami": 8, "renew": 1, "logout": 0}
+SEED_DOMAIN = "loadtest.invalid"
+
+# the route being requested, queries are attributed to it
+current_route: contextvars.ContextVar = contextvars.ContextVar(
+    "loadtest_route", default=None
+)
+
+
+def parse_mix(value: str) -> typing.Dict[str, float]:
+    """login=1,whoami=8 -> {"login": 1.0, "whoami": 8.0}"""
+    mix = {}
+    for part in value.split(","):
+        route, _, weight = part.partition("=")
+        route = route.strip()
+        if route not in ROUTES:
+            raise ValueError(f"unknown route {route}, one of {ROUTES}")
+        mix[route] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("at least one route needs a weight")
+    return mix
+
+
+def percentile(timings: typing.List[float], p: float) -> float:
+    """timings must be sorted"""
+    if not timings:
+        return 0.0
+    return timings[min(int(len(timings) * p), len(timings) - 1)]
+
+
+class RouteQueries:
+    """asyncpg query logger counting queries by current_route,
+    add it to every connection of the pool"""
+
+    def __init__(self):
+        self.counts: typing.Counter[str] = collections.Counter()
+
+    def __call__(self, record):
+        route = current_route.get()
+        query = record.query.strip()
+        if route and not query.upper().startswith(TRANSACTION_STATEMENTS):
+            self.counts[route] += 1
+
+
+class ASGIClient:
+    """Drives an in process app, running its lifespan"""
+
+    def __init__(self, app):
+        from async_asgi_testclient import TestClient
+
+        self.client = TestClient(app, use_cookies=False)
+
+    async def __aenter__(self):
+        await self.client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.__aexit__(*exc)
+
+    async def request(self, method, path, *, form=None, headers, cookies):
+        return await self.client.open(
+            path, method=method, form=form, headers=headers, cookies=cookies
+        )
+
+
+class HTTPClient:
+    """Drives a running app, needs httpx"""
+
+    def __init__(self, url: str, *, concurrency: int = 10):
+        import httpx
+
+        limits = httpx.Limits(max_connections=concurrency)
+        self.client = httpx.AsyncClient(base_url=url, limits=limits)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    async def request(self, method, path, *, form=None, headers, cookies):
+        if cookies:
+            headers = dict(headers)
+            headers["cookie"] = "; ".join(
+                f"{k}={v}" for k, v in cookies.items()
+            )
+        res = await self.client.request(
+            method, path, data=form, headers=headers
+        )
+        # every virtual user keeps its own cookies
+        self.client.cookies.clear()
+        return res
+
+
+class VirtualUser:
+    def __init__(self, email: str, password: str):
+        self.email = email
+        self.password = password
+        self.token: typing.Optional[str] = None
+        self.refresh: typing.Optional[str] = None
+
+
+class LoadTest:
+    """
+    Drives a mix of /login, /whoami, /renew and /logout requests with
+    `concurrency` virtual users, each one logging in when it has no
+    session. Runs for `duration` seconds or `requests` requests, paced
+    to `rate` requests per second when given.
+    Reports throughput, latency percentiles per route, and, with
+    queries (a RouteQueries logged on the pool connections), db queries
+    per request.
+    """
+
+    def __init__(
+        self,
+        client,
+        users: typing.List[typing.Tuple[str, str]],
+        *,
+        mix: typing.Dict[str, float] = None,
+        concurrency: int = 10,
+        rate: float = None,
+        duration: float = None,
+        requests: int = None,
+        prefix: str = "/auth",
+        cookie_name: str = "refresh",
+        queries: RouteQueries = None,
+    ):
+        assert users, "at least one user needed"
+        assert duration or requests, "duration or requests needed"
+        mix = mix or DEFAULT_MIX
+        self.client = client
+        self.users = users
+        self.routes = [r for r in mix if mix[r] > 0]
+        self.weights = [mix[r] for r in self.routes]
+        self.concurrency = concurrency
+        self.interval = 1 / rate if rate else None
+        self.duration = duration
+        self.requests = requests
+        self.prefix = prefix
+        self.cookie_name = cookie_name
+        self.queries = queries
+        self.timings: typing.Dict[str, typing.List[float]] = {
+            r: [] for r in ROUTES
+        }
+        self.errors: typing.Counter[str] = collections.Counter()
+        self.statuses: typing.Counter[int] = collections.Counter()
+        self.sent = 0
+        self.next_slot = 0.0
+
+    def done(self, started: float) -> bool:
+        if self.requests is not None and self.sent >= self.requests:
+            return True
+        if self.duration is not None:
+            return time.monotonic() - started >= self.duration
+        return False
+
+    async def pace(self):
+        if self.interval is None:
+            return
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def call(self, route: str, user: VirtualUser):
+        self.sent += 1
+        method = "GET" if route == "whoami" else "POST"
+        form = None
+        headers = {}
+        cookies = {}
+        if route == "login":
+            form = {"username": user.email, "password": user.password}
+        elif route == "renew":
+            cookies[self.cookie_name] = user.refresh
+        else:
+            headers = auth_header(user.token)
+
+        token = current_route.set(route)
+        start = time.perf_counter()
+        try:
+            res = await self.client.request(
+                method,
+                f"{self.prefix}/{route}",
+                form=form,
+                headers=headers,
+                cookies=cookies,
+            )
+        finally:
+            self.timings[route].append(time.perf_counter() - start)
+            current_route.reset(token)
+
+        self.statuses[res.status_code] += 1
+        if res.status_code >= 400:
+            self.errors[route] += 1
+            user.token = user.refresh = None
+            return
+        if route in ("login", "renew"):
+            user.token = res.json()["access_token"]
+            user.refresh = res.cookies.get(self.cookie_name) or user.refresh
+        elif route == "logout":
+            user.token = user.refresh = None
+
+    async def worker(self, user: VirtualUser, started: float):
+        while not self.done(started):
+            route = random.choices(self.routes, self.weights)[0]
+            if user.token is None or (route == "renew" and not user.refresh):
+                route = "login"
+            await self.pace()
+            if self.done(started):
+                break
+            await self.call(route, user)
+
+    async def run(self) -> typing.Dict[str, typing.Any]:
+        users = [
+            VirtualUser(*self.users[i % len(self.users)])
+            for i in range(self.concurrency)
+        ]
+        started = time.monotonic()
+        await asyncio.gather(*(self.worker(u, started) for u in users))
+        return self.report(time.monotonic() - started)
+
+    def report(self, elapsed: float) -> typing.Dict[str, typing.Any]:
+        routes = {}
+        for route, timings in self.timings.items():
+            if not timings:
+                continue
+            timings = sorted(timings)
+            routes[route] = {
+                "requests": len(timings),
+                "errors": self.errors[route],
+                "rps": len(timings) / elapsed,
+                "p50": percentile(timings, 0.50) * 1000,
+                "p95": percentile(timings, 0.95) * 1000,
+                "p99": percentile(timings, 0.99) * 1000,
+            }
+            if self.queries is not None:
+                queries = self.queries.counts[route] / len(timings)
+                routes[route]["queries"] = queries
+        return {
+            "requests": self.sent,
+            "errors": sum(self.errors.values()),
+            "elapsed": elapsed,
+            "throughput": self.sent / elapsed if elapsed else 0.0,
+            "statuses": dict(self.statuses),
+            "routes": routes,
+        }
+
+
+async def seed_users(
+    repo, count: int, password_hash: str, *, groups: int = 0
+) -> typing.List[str]:
+    """Creates (or updates) count users loadtest-N@loadtest.invalid
+    with the same password, returns their emails"""
+    names = [f"loadtest-{i}" for i in range(groups)]
+    emails = [f"loadtest-{i}@{SEED_DOMAIN}" for i in range(count)]
+    for start in range(0, count, 1000):
+        records = [
+            (n, email, password_hash, None, False, True, False, names)
+            for n, email in enumerate(emails[start : start + 1000], start)
+        ]
+        await repo.bulk_import(records, update_existing=True)
+    return emails
+
+
+async def delete_seeded(db, schema: str = "") -> int:
+    """Removes the users created by seed_users, with their sessions"""
+    users = f"SELECT user_id FROM {schema}users WHERE email LIKE $1"
+    pattern = f"loadtest-%@{SEED_DOMAIN}"
+    async with db.transaction():
+        for table in ("users_session", "users_group"):
+            await db.execute(
+                f"DELETE FROM {schema}{table} WHERE user_id IN ({users})",
+                pattern,
+            )
+        result = await db.execute(
+            f"DELETE FROM {schema}users WHERE email LIKE $1", pattern
+        )
+    return int(result.split()[-1])
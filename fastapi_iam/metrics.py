@@ -0,0 +1,179 @@
+from bisect import bisect_left
+
+import math
+import typing
+
+# seconds, from a cached token validation to a slow argon2 hash
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# name: (type, help, label name)
+METRICS = {
+    "iam_auth_stage_seconds": (
+        "histogram",
+        "Time spent on each authentication stage",
+        "stage",
+    ),
+    "iam_hasher_seconds": (
+        "histogram",
+        "Password hashing and verification time",
+        "op",
+    ),
+    "iam_hasher_queue_wait_seconds": (
+        "histogram",
+        "Time waited on the hashing executor queue",
+        "op",
+    ),
+    "iam_storage_seconds": (
+        "histogram",
+        "Storage method call time",
+        "method",
+    ),
+    "iam_logins_total": ("counter", "Login attempts by outcome", "outcome"),
+}
+
+
+class MetricsSink:
+    """
+    Receives the iam measurements, the default one does nothing.
+    Subclass it to feed another metrics system (statsd, opentelemetry).
+    Names are the ones in METRICS, labels are plain strings known in
+    advance, so recording doesn't need to build anything per request.
+    """
+
+    def observe(self, name: str, value: float, label: str = ""):
+        pass
+
+    def inc(self, name: str, label: str = "", value: float = 1):
+        pass
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values: typing.Dict[str, float] = {}
+
+    def inc(self, label: str = "", value: float = 1):
+        values = self.values
+        values[label] = values.get(label, 0) + value
+
+    def samples(self):
+        for label, value in self.values.items():
+            yield self.name, self._labels(label), value
+
+    def _labels(self, label: str, **extra) -> str:
+        labels = {self.label: label} if self.label else {}
+        labels.update(extra)
+        if not labels:
+            return ""
+        pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        return "{" + pairs + "}"
+
+
+class Histogram(Counter):
+    """Fixed buckets, a label series is a list of bucket counts plus
+    the sum, allocated the first time the label is seen"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label: str = None,
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+        self.series: typing.Dict[str, typing.List[float]] = {}
+
+    def observe(self, value: float, label: str = ""):
+        series = self.series.get(label)
+        if series is None:
+            # one slot per bucket, +Inf, and the sum
+            series = self.series[label] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for label, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                labels = self._labels(label, le=le)
+                yield f"{self.name}_bucket", labels, cumulative
+            yield f"{self.name}_sum", self._labels(label), series[-1]
+            yield f"{self.name}_count", self._labels(label), cumulative
+
+
+class PrometheusMetrics(MetricsSink):
+    """In process registry of METRICS, rendered in prometheus text
+    format by the /metrics route"""
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.metrics: typing.Dict[str, Counter] = {}
+        for name, (kind, help, label) in METRICS.items():
+            if kind == "histogram":
+                self.metrics[name] = Histogram(name, help, label, buckets)
+            else:
+                self.metrics[name] = Counter(name, help, label)
+
+    def observe(self, name: str, value: float, label: str = ""):
+        self.metrics[name].observe(value, label)
+
+    def inc(self, name: str, label: str = "", value: float = 1):
+        self.metrics[name].inc(label, value)
+
+    def render(self) -> str:
+        lines = []
+        for name, metric in self.metrics.items():
+            kind = METRICS[name][0]
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in metric.samples():
+                lines.append(f"{sample}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def render_stats(stats: typing.Dict[str, typing.Any], prefix="iam") -> str:
+    """IAM.stats() as gauges, iam_<component>_<key>"""
+    lines = []
+    for component, values in stats.items():
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue  # None, or not a number
+            name = f"{prefix}_{component}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _number(value) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
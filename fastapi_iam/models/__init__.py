@@ -64,8 +64,27 @@ class User(BaseUser):
             "email_verified": True,
             "principals": self.get_principals(),
             "is_admin": self.is_admin,
+            "is_staff": self.is_staff,
+            "username": self.username,
+            "groups": self.groups,
         }
 
+    @classmethod
+    def from_jwt_claims(cls, claims: typing.Dict[str, typing.Any]) -> "User":
+        """The user as seen when the token was issued,
+        only active users get tokens. Claims are signed by us, they
+        are not validated again"""
+        return cls.construct(
+            user_id=claims["sub"],
+            email=claims["email"],
+            username=claims["username"],
+            is_staff=claims["is_staff"],
+            is_admin=claims["is_admin"],
+            is_active=True,
+            groups=claims["groups"],
+            password="",
+        )
+
 
 class UserCreate(pd.BaseModel):
     email: str
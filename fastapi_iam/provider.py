@@ -1,10 +1,13 @@
 from __future__ import annotations
 
-from .auth import get_extractors
+from .context import current_connection
+from .context import set_connection
 from .models import anonymous_user
 from fastapi import Depends
 from fastapi.exceptions import HTTPException
 from fastapi.requests import Request
+from fastapi.responses import Response
+from fastapi.routing import APIRoute
 from fastapi.security import OAuth2PasswordBearer
 
 current_app = None
@@ -25,15 +28,58 @@ def IAMProvider():
     return current_app
 
 
+class BoundConnectionRoute(APIRoute):
+    """
+    Route class of the iam router with settings["request_connection"]:
+    acquires one pool connection for the whole request, and binds all
+    storage services created with iam.get_service to it.
+    With "transaction" the request runs inside a transaction, committed
+    (or rolled back) before the response is sent, so clients never see
+    a response for writes that are not visible yet, or failed to commit.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def bound_handler(request: Request) -> Response:
+            iam = IAMProvider()
+            mode = iam.settings["request_connection"]
+            transaction = mode == "transaction"
+            async with iam.connection(transaction=transaction) as db:
+                set_connection(db)
+                try:
+                    return await handler(request)
+                finally:
+                    set_connection(None)
+
+        return bound_handler
+
+
+async def bind_connection():
+    """The connection bound to the current request (see
+    BoundConnectionRoute), None when the route has no connection"""
+    return current_connection()
+
+
 async def get_current_user(
-    request: Request, iam=Depends(IAMProvider), token=Depends(oauth2_scheme)
+    request: Request,
+    response: Response,
+    iam=Depends(IAMProvider),
+    token=Depends(oauth2_scheme),
 ):
     policy = iam.get_security_policy()
-    token = await get_extractors(iam, request)
-    if not token:
-        return anonymous_user
-    user = await policy.validate(token)
-    user.token = token.get("token")
+    timings = policy.start_timing()
+    try:
+        token = await policy.extract(request)
+        if not token:
+            return anonymous_user
+        user = await policy.validate(token)
+    finally:
+        await policy.finish_timing(request, timings)
+        policy.server_timing(response, timings)
+    if token.get("type") != "basic":
+        # never carry a plain password around
+        user.token = token.get("token")
     return user
 
 
@@ -0,0 +1,50 @@
+-- keep user groups denormalized on the users row, so user lookups
+-- don't need to join groups/users_group.
+-- users_group remains the source of truth, see check_groups command
+
+
+ALTER TABLE users ADD COLUMN groups varchar(150)[] NOT NULL default '{}';
+
+UPDATE users u SET groups = coalesce((
+    SELECT array_agg(g.name ORDER BY g.name) FROM groups g
+        INNER JOIN users_group ug using(group_id)
+    WHERE ug.user_id = u.user_id
+), '{}');
+
+CREATE INDEX users_groups_idx on
+    users using gin(groups);
+
+
+CREATE or replace function update_groups(v_groups varchar[], v_user_id integer)
+    RETURNS varchar[] as $$
+BEGIN
+    DELETE from users_group where user_id=v_user_id;
+    INSERT INTO users_group (user_id, group_id)
+        SELECT v_user_id, group_id from groups where name = ANY(v_groups);
+    UPDATE users SET groups = ARRAY(
+        SELECT name from groups where name = ANY(v_groups) ORDER BY name
+    ) WHERE user_id=v_user_id;
+    RETURN v_groups;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+
+CREATE OR REPLACE FUNCTION trigger_groups_denormalize()
+    RETURNS trigger LANGUAGE plpgsql SET search_path FROM CURRENT as $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE users SET groups = array_remove(groups, OLD.name)
+            WHERE groups @> ARRAY[OLD.name];
+        RETURN OLD;
+    END IF;
+    IF NEW.name <> OLD.name THEN
+        UPDATE users SET groups = array_replace(groups, OLD.name, NEW.name)
+            WHERE groups @> ARRAY[OLD.name];
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER trigger_groups_users AFTER
+        DELETE OR UPDATE OF name ON groups
+    FOR EACH ROW EXECUTE PROCEDURE trigger_groups_denormalize();
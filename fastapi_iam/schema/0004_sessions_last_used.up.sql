@@ -0,0 +1,5 @@
+-- last activity of a session, stamped in batches by the ActivityBuffer
+-- when settings["session_last_used"] is enabled
+
+
+ALTER TABLE users_session ADD COLUMN last_used timestamp without time zone;
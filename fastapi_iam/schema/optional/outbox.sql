@@ -0,0 +1,17 @@
+-- optional, applied by initialize_db when settings["outbox"] is enabled.
+-- auth events (UserLogin, UserLogout) are inserted by the same
+-- statement storing or deleting the session, so they commit (or roll
+-- back) with it. OutboxRelay claims them in batches and hands them to
+-- the registered sinks.
+-- No foreign key on user_id, events outlive deleted users, and
+-- inserting them stays cheap.
+
+
+CREATE TABLE IF NOT EXISTS users_outbox (
+    id bigserial primary key,
+    event varchar(64) NOT NULL,
+    user_id integer,
+    data jsonb NOT NULL default '{}'::jsonb,
+    created timestamp without time zone NOT NULL
+        default (now() at time zone 'utc')
+);
@@ -0,0 +1,55 @@
+-- optional, applied by initialize_db when settings["session_partitions"]
+-- is enabled.
+-- users_session is range partitioned by refresh_token_expires, one
+-- partition per month, so expired sessions are dropped a whole
+-- partition at a time (see SessionPartitionMaintainer) instead of
+-- deleted row by row.
+-- Session lookups filter by refresh_token_expires > now(), so
+-- partitions already expired are pruned.
+-- The partition functions are in sessions_partitions_functions.sql,
+-- applied before this one.
+
+
+-- same columns (and defaults) as users_session, including the ones
+-- added by later migrations
+CREATE TABLE users_session_partitioned (
+    LIKE users_session INCLUDING DEFAULTS
+) PARTITION BY RANGE (refresh_token_expires);
+
+ALTER TABLE users_session_partitioned
+    ALTER COLUMN refresh_token_expires SET NOT NULL,
+    ADD FOREIGN KEY (user_id) REFERENCES users(user_id);
+
+
+ALTER TABLE users_session RENAME TO users_session_old;
+ALTER TABLE users_session_partitioned RENAME TO users_session;
+
+-- sessions past the monthly partitions, until their partition is
+-- created (see create_session_partitions)
+CREATE TABLE users_session_default PARTITION OF users_session DEFAULT;
+
+SELECT create_session_partitions(
+    (now() at time zone 'utc')::timestamp,
+    coalesce(
+        (SELECT max(refresh_token_expires) FROM users_session_old),
+        (now() at time zone 'utc')::timestamp
+    ) + '1 month'::interval
+);
+
+-- sessions already expired are not copied
+INSERT INTO users_session
+    SELECT * FROM users_session_old
+    WHERE refresh_token_expires > (now() at time zone 'utc')::timestamp;
+
+DROP TABLE users_session_old;
+
+
+CREATE INDEX users_session_idx on
+    users_session using btree(token);
+
+CREATE INDEX users_session_refresh_idx on
+    users_session using btree(refresh_token);
+
+-- the reaper index of migration 0003
+CREATE INDEX users_session_expires_idx on
+    users_session using btree(refresh_token_expires);
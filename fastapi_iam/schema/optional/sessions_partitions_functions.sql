@@ -0,0 +1,75 @@
+-- users_session partitions maintenance, applied by initialize_db with
+-- the partitioning migration (and on tables partitioned before the
+-- default partition existed).
+
+
+CREATE OR REPLACE FUNCTION create_session_partitions(
+    v_from timestamp, v_until timestamp
+) RETURNS integer LANGUAGE plpgsql SET search_path FROM CURRENT as $$
+DECLARE
+    v_start timestamp := date_trunc('month', v_from);
+    v_name text;
+    v_created integer := 0;
+BEGIN
+    -- several workers could be maintaining partitions at once
+    PERFORM pg_advisory_xact_lock(hashtext('fastapi_iam.users_session'));
+    WHILE v_start < v_until LOOP
+        v_name := 'users_session_' || to_char(v_start, 'YYYY_MM');
+        IF to_regclass(v_name) IS NULL THEN
+            -- sessions of the month stored on the default partition
+            -- (created before the partition) are moved to it, no new
+            -- ones can be stored there until it's attached
+            LOCK TABLE users_session_default IN SHARE ROW EXCLUSIVE MODE;
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE users_session INCLUDING DEFAULTS)',
+                v_name
+            );
+            EXECUTE format(
+                'WITH moved AS ('
+                '    DELETE FROM users_session_default'
+                '    WHERE refresh_token_expires >= %L'
+                '      AND refresh_token_expires < %L'
+                '    RETURNING *'
+                ') INSERT INTO %I SELECT * FROM moved',
+                v_start, v_start + '1 month'::interval, v_name
+            );
+            EXECUTE format(
+                'ALTER TABLE users_session ATTACH PARTITION %I '
+                'FOR VALUES FROM (%L) TO (%L)',
+                v_name, v_start, v_start + '1 month'::interval
+            );
+            v_created := v_created + 1;
+        END IF;
+        v_start := v_start + '1 month'::interval;
+    END LOOP;
+    RETURN v_created;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION drop_session_partitions(v_before timestamp)
+    RETURNS integer LANGUAGE plpgsql SET search_path FROM CURRENT as $$
+DECLARE
+    v_name text;
+    v_dropped integer := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('fastapi_iam.users_session'));
+    -- dropping needs a short exclusive lock on users_session,
+    -- give up instead of queuing behind long queries
+    PERFORM set_config('lock_timeout', '5s', true);
+    FOR v_name IN
+        SELECT c.relname FROM pg_inherits i
+            INNER JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'users_session'::regclass
+          AND c.relname <> 'users_session_default'
+        ORDER BY c.relname
+    LOOP
+        IF to_timestamp(right(v_name, 7), 'YYYY_MM')::timestamp
+                + '1 month'::interval <= v_before THEN
+            EXECUTE format('DROP TABLE %I', v_name);
+            v_dropped := v_dropped + 1;
+        END IF;
+    END LOOP;
+    RETURN v_dropped;
+END;
+$$;
@@ -0,0 +1,96 @@
+-- sqlite version of ../0001_schema.up.sql, see services/sqlite.
+-- timestamps are utc iso strings, booleans integers and jsonb json
+-- text. enums are checks, and the lowercasing trigger updates the row
+-- after it's written.
+
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id integer primary key autoincrement,
+    email varchar(254) NOT NULL,
+    password varchar(128) NOT NULL,
+    username varchar(254) NOT NULL default 'noname',
+    is_staff boolean NOT NULL default 0,
+    is_active boolean NOT NULL default 0,
+    is_admin boolean NOT NULL default 0,
+    date_joined timestamp NOT NULL
+        default (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    last_login timestamp,
+    auth_type varchar NOT NULL default 'password'
+        CHECK (auth_type IN ('password', 'provider', 'service-token')),
+    auth_provider varchar,
+    props json default '{}',
+    UNIQUE (email)
+);
+
+CREATE TABLE users_keys (
+    id integer primary key autoincrement,
+    user_id integer references users(user_id),
+    public_key varchar not null,
+    last_used timestamp,
+    comment varchar,
+    enabled boolean
+);
+
+
+CREATE TABLE users_token (
+    user_id integer references users(user_id),
+    token varchar(32),
+    expires timestamp,
+    token_type varchar not null
+        CHECK (token_type IN ('register', 'forgot', 'authemail'))
+);
+
+CREATE INDEX users_token_idx on users_token(token);
+
+
+
+CREATE TABLE users_session (
+    token varchar not null,
+    user_id integer references users(user_id),
+    expires timestamp
+        default (strftime('%Y-%m-%d %H:%M:%f', 'now', '+30 minutes')),
+    refresh_token varchar,
+    refresh_token_expires timestamp
+        default (strftime('%Y-%m-%d %H:%M:%f', 'now', '+7 days')),
+    data json
+);
+
+
+CREATE INDEX users_session_idx on users_session(token);
+
+CREATE INDEX users_session_refresh_idx on users_session(refresh_token);
+
+
+CREATE TABLE groups (
+    group_id integer primary key autoincrement,
+    name varchar(150) NOT NULL,
+    unique(name)
+);
+
+
+CREATE TABLE users_group (
+    id integer primary key autoincrement,
+    user_id integer references users(user_id),
+    group_id integer references groups(group_id) ON DELETE CASCADE,
+    UNIQUE (user_id, group_id)
+);
+
+create table users_version (
+    value integer
+);
+insert into users_version values (0);
+
+
+CREATE TRIGGER trigger_insertusers AFTER INSERT ON users
+BEGIN
+    UPDATE users SET username = lower(new.username), email = lower(new.email)
+    WHERE user_id = new.user_id;
+END;
+
+CREATE TRIGGER trigger_updateusers AFTER UPDATE OF username, email ON users
+    WHEN new.username <> lower(new.username)
+        OR new.email <> lower(new.email)
+BEGIN
+    UPDATE users SET username = lower(new.username), email = lower(new.email)
+    WHERE user_id = new.user_id;
+END;
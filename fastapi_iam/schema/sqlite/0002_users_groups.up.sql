@@ -0,0 +1,44 @@
+-- keep user groups denormalized on the users row, as a sorted json
+-- array of names, so user lookups don't need to join groups/users_group.
+-- users_group remains the source of truth, see check_groups command.
+-- update_groups is UserStorage.update_groups, sqlite has no functions
+
+
+ALTER TABLE users ADD COLUMN groups json NOT NULL default '[]';
+
+UPDATE users SET groups = (
+    SELECT json_group_array(name) FROM (
+        SELECT g.name FROM groups g
+            INNER JOIN users_group ug using(group_id)
+        WHERE ug.user_id = users.user_id
+        ORDER BY g.name
+    )
+);
+
+
+CREATE TRIGGER trigger_groups_delete AFTER DELETE ON groups
+BEGIN
+    UPDATE users SET groups = (
+        SELECT json_group_array(value) FROM json_each(users.groups)
+        WHERE value <> old.name
+    )
+    WHERE EXISTS (
+        SELECT 1 FROM json_each(users.groups) WHERE value = old.name
+    );
+END;
+
+CREATE TRIGGER trigger_groups_rename AFTER UPDATE OF name ON groups
+    WHEN new.name <> old.name
+BEGIN
+    UPDATE users SET groups = (
+        SELECT json_group_array(name) FROM (
+            SELECT CASE WHEN value = old.name THEN new.name ELSE value END
+                AS name
+            FROM json_each(users.groups)
+            ORDER BY name
+        )
+    )
+    WHERE EXISTS (
+        SELECT 1 FROM json_each(users.groups) WHERE value = old.name
+    );
+END;
@@ -0,0 +1,6 @@
+-- supports reaping expired sessions (see SessionReaper)
+-- without scanning the whole users_session table
+
+
+CREATE INDEX users_session_expires_idx on
+    users_session(refresh_token_expires);
@@ -0,0 +1,57 @@
+import base64
+import functools
+import inspect
+import json
+import time
+
+# keyset columns, and the type of their cursor values
+SEARCH_ORDER = {"user_id": int, "email": str}
+
+
+def instrument(func, label: str):
+    """times a storage method on iam_storage_seconds, when the
+    repository has a metrics sink"""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if self.metrics is None:
+            return await func(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe("iam_storage_seconds", elapsed, label)
+
+    return wrapper
+
+
+class InstrumentedRepository:
+    """Base of the storages of every backend, their public coroutine
+    methods are timed (labeled with Class.method)"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or name == "invalidate":
+                continue
+            if inspect.iscoroutinefunction(func):
+                setattr(cls, name, instrument(func, f"{cls.__name__}.{name}"))
+
+
+def encode_cursor(order_by: str, value) -> str:
+    data = json.dumps([order_by, value]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("utf-8")
+
+
+def decode_cursor(cursor: str, order_by: str):
+    try:
+        key, value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if key != order_by:
+        raise ValueError("cursor does not match order_by")
+    # bool is an int too
+    if type(value) is not SEARCH_ORDER[order_by]:
+        raise ValueError("invalid cursor")
+    return value
@@ -0,0 +1,24 @@
+from ...interfaces import IGroupsStorage
+from ...interfaces import ISessionStorage
+from ...interfaces import IUsersStorage
+from .base import *  # noqa
+from .groups import *  # noqa
+from .session import *  # noqa
+from .store import *  # noqa
+from .users import *  # noqa
+
+
+def memory_service_factory(iam, service, db=None):
+    # all services share the iam store, db is ignored
+    return service(iam.store, invalidator=iam.publish, metrics=iam.metrics)
+
+
+# settings for storage="memory", see configure_iam
+SETTINGS = {
+    "services": {
+        IUsersStorage: UserStorage,  # noqa
+        ISessionStorage: SessionStorage,  # noqa
+        IGroupsStorage: GroupStorage,  # noqa
+    },
+    "default_service_factory": memory_service_factory,
+}
@@ -0,0 +1,22 @@
+from ..base import InstrumentedRepository
+from .store import MemoryStore
+
+import typing
+
+
+class MemoryRepository(InstrumentedRepository):
+    def __init__(
+        self,
+        store: MemoryStore,
+        invalidator: typing.Callable = None,
+        metrics=None,
+    ):
+        self.records = store
+        # awaited with (db, kind, key) when cached data should be dropped
+        self.invalidator = invalidator
+        # optional metrics.MetricsSink
+        self.metrics = metrics
+
+    async def invalidate(self, kind: str, key):
+        if self.invalidator is not None:
+            await self.invalidator(None, kind, key)
@@ -0,0 +1,9 @@
+from .base import MemoryRepository
+
+
+class GroupStorage(MemoryRepository):
+    async def add_group(self, name):
+        return {"group_id": self.records.add_group(name), "name": name}
+
+    async def get_groups(self):
+        return list(self.records.groups)
@@ -0,0 +1,77 @@
+from ... import models
+from ...cache import token_key
+from .base import MemoryRepository
+from .store import utcnow
+
+import datetime
+import typing
+
+
+class SessionStorage(MemoryRepository):
+    async def create(self, us: models.UserSession):
+        self.records.add_session(us.dict())
+        return us.copy()
+
+    async def login(
+        self, us: models.UserSession, last_login: datetime.datetime
+    ) -> models.PublicUser:
+        """Stores the session and stamps the user last_login,
+        returns the updated user"""
+        self.records.add_session(us.dict())
+        user = self.records.users[us.user_id]
+        self.records.update_user(user, {"last_login": last_login})
+        return models.PublicUser(**user.values(models.PublicUser.__fields__))
+
+    async def store(self, us: models.UserSession, user: models.User):
+        """Stores the session of a login without stamping the user
+        last_login, see ActivityBuffer"""
+        self.records.add_session(us.dict())
+
+    async def flush_last_used(
+        self,
+        tokens: typing.List[str],
+        last_used: typing.List[datetime.datetime],
+    ):
+        sessions = self.records.sessions
+        for token, when in zip(tokens, last_used):
+            session = sessions.get(token)
+            if session is not None:
+                session.last_used = when
+        self.records.version += 1
+
+    async def is_expired(self, refresh_token: str) -> bool:
+        session = self.records.refresh_tokens.get(refresh_token)
+        return session is None or session.refresh_token_expires <= utcnow()
+
+    async def delete(self, token):
+        session = self.records.sessions.get(token)
+        if session is not None:
+            self.records.remove_session(session)
+        await self.invalidate("token", token_key(token))
+
+    async def update_token(
+        self,
+        refresh_token: str,
+        token: str,
+        expires: datetime.datetime,
+        *,
+        new_rt: str = None,  # set it to rotate the refresh token
+        new_rte: str = None,
+    ):
+        if new_rt:
+            assert (
+                new_rt and new_rte
+            ), "new_token and new_token_expiration required"
+        session = self.records.refresh_tokens.get(refresh_token)
+        if session is None or session.refresh_token_expires <= utcnow():
+            return
+        replaced = session.token
+        self.records.update_session(session, token, expires, new_rt, new_rte)
+        await self.invalidate("token", token_key(replaced))
+
+    async def reap_expired(
+        self, before: datetime.datetime, limit: int = 500
+    ) -> int:
+        """Deletes up to limit sessions whose refresh token expired
+        before `before`, returns how many were deleted"""
+        return self.records.reap(before, limit)
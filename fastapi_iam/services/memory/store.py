@@ -0,0 +1,388 @@
+from ...tasks import BackgroundTask
+
+import asyncio
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import typing
+
+logger = logging.getLogger("fastapi_iam")
+
+# same columns as the users and users_session tables
+USER_FIELDS = (
+    "user_id",
+    "email",
+    "password",
+    "username",
+    "is_staff",
+    "is_active",
+    "is_admin",
+    "date_joined",
+    "last_login",
+    "auth_type",
+    "auth_provider",
+    "props",
+    "groups",
+)
+SESSION_FIELDS = (
+    "token",
+    "user_id",
+    "expires",
+    "refresh_token",
+    "refresh_token_expires",
+    "data",
+    "last_used",
+)
+DATETIME_FIELDS = {
+    "date_joined",
+    "last_login",
+    "expires",
+    "refresh_token_expires",
+    "last_used",
+}
+SNAPSHOT_VERSION = 1
+
+
+class UserRecord:
+    __slots__ = USER_FIELDS
+
+    def __init__(self, **values):
+        self.user_id = values["user_id"]
+        self.email = values["email"].lower()
+        self.password = values["password"]
+        self.username = (values.get("username") or "noname").lower()
+        self.is_staff = values.get("is_staff") or False
+        self.is_active = values.get("is_active") or False
+        self.is_admin = values.get("is_admin") or False
+        self.date_joined = values.get("date_joined") or utcnow()
+        self.last_login = values.get("last_login")
+        self.auth_type = values.get("auth_type") or "password"
+        self.auth_provider = values.get("auth_provider")
+        self.props = values.get("props") or {}
+        self.groups = list(values.get("groups") or ())
+
+    def values(self, fields=USER_FIELDS) -> typing.Dict[str, typing.Any]:
+        return {f: getattr(self, f) for f in fields}
+
+
+class SessionRecord:
+    __slots__ = SESSION_FIELDS
+
+    def __init__(self, **values):
+        now = utcnow()
+        self.token = values["token"]
+        self.user_id = values["user_id"]
+        # the users_session defaults
+        self.expires = values.get("expires") or now + datetime.timedelta(
+            minutes=30
+        )
+        self.refresh_token = values.get("refresh_token")
+        self.refresh_token_expires = values.get(
+            "refresh_token_expires"
+        ) or now + datetime.timedelta(days=7)
+        self.data = values.get("data")
+        self.last_used = values.get("last_used")
+
+    def values(self, fields=SESSION_FIELDS) -> typing.Dict[str, typing.Any]:
+        return {f: getattr(self, f) for f in fields}
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+class MemoryStore:
+    """
+    Users, groups and sessions of the memory storage, shared by all the
+    storage services of an IAM (iam.store).
+    Records are slotted objects in dicts, with secondary indexes for
+    every lookup the services do (email, token, refresh token, sessions
+    of a user). Sessions are also kept on a heap ordered by
+    refresh_token_expires, so reaping expired ones never scans.
+    Everything runs on the event loop without awaiting, so every
+    method is atomic.
+    """
+
+    def __init__(self):
+        self.users: typing.Dict[int, UserRecord] = {}
+        self.emails: typing.Dict[str, UserRecord] = {}
+        self.sessions: typing.Dict[str, SessionRecord] = {}
+        self.refresh_tokens: typing.Dict[str, SessionRecord] = {}
+        self.user_sessions: typing.Dict[int, typing.Set[SessionRecord]] = {}
+        self.groups: typing.Dict[str, int] = {}
+        self.expiry: typing.List[tuple] = []
+        self._user_ids = itertools.count(1)
+        self._group_ids = itertools.count(1)
+        # heap entries tie breaker, records are not comparable
+        self._entries = itertools.count()
+        # bumped on every change, see SnapshotTask
+        self.version = 0
+
+    # users
+
+    def add_user(self, values: typing.Dict[str, typing.Any]) -> UserRecord:
+        email = values["email"].lower()
+        if email in self.emails:
+            raise ValueError(f"user {email} already exists")
+        user = UserRecord(**{**values, "user_id": next(self._user_ids)})
+        self.users[user.user_id] = user
+        self.emails[user.email] = user
+        self.version += 1
+        return user
+
+    def update_user(
+        self, user: UserRecord, values: typing.Dict[str, typing.Any]
+    ):
+        if "email" in values:
+            email = values["email"].lower()
+            if email != user.email:
+                if email in self.emails:
+                    raise ValueError(f"user {email} already exists")
+                del self.emails[user.email]
+                self.emails[email] = user
+            values["email"] = email
+        if "username" in values:
+            values["username"] = values["username"].lower()
+        for key, value in values.items():
+            setattr(user, key, value)
+        self.version += 1
+
+    def set_groups(self, user: UserRecord, groups: typing.Iterable[str]):
+        """only existing groups are kept, like update_groups()"""
+        user.groups = sorted({g for g in groups if g in self.groups})
+        self.version += 1
+
+    # groups
+
+    def add_group(self, name: str) -> int:
+        if name in self.groups:
+            raise ValueError(f"group {name} already exists")
+        group_id = self.groups[name] = next(self._group_ids)
+        self.version += 1
+        return group_id
+
+    # sessions
+
+    def add_session(
+        self, values: typing.Dict[str, typing.Any]
+    ) -> SessionRecord:
+        if values["user_id"] not in self.users:
+            raise ValueError(f"user {values['user_id']} does not exist")
+        session = SessionRecord(**values)
+        self.sessions[session.token] = session
+        if session.refresh_token:
+            self.refresh_tokens[session.refresh_token] = session
+        self.user_sessions.setdefault(session.user_id, set()).add(session)
+        self._schedule(session)
+        self.version += 1
+        return session
+
+    def remove_session(self, session: SessionRecord):
+        # the heap entry is dropped when it expires
+        if self.sessions.get(session.token) is session:
+            del self.sessions[session.token]
+        if self.refresh_tokens.get(session.refresh_token) is session:
+            del self.refresh_tokens[session.refresh_token]
+        sessions = self.user_sessions.get(session.user_id)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self.user_sessions[session.user_id]
+        self.version += 1
+
+    def update_session(
+        self,
+        session: SessionRecord,
+        token: str,
+        expires: datetime.datetime,
+        refresh_token: str = None,
+        refresh_token_expires: datetime.datetime = None,
+    ):
+        if self.sessions.get(session.token) is session:
+            del self.sessions[session.token]
+        session.token = token
+        session.expires = expires
+        self.sessions[token] = session
+        if refresh_token:
+            self.refresh_tokens.pop(session.refresh_token, None)
+            session.refresh_token = refresh_token
+            session.refresh_token_expires = refresh_token_expires
+            self.refresh_tokens[refresh_token] = session
+            self._schedule(session)
+        self.version += 1
+
+    def _schedule(self, session: SessionRecord):
+        if len(self.expiry) > 2 * len(self.sessions) + 1024:
+            self.compact()
+        entry = (session.refresh_token_expires, next(self._entries), session)
+        heapq.heappush(self.expiry, entry)
+
+    def compact(self):
+        """Rebuilds the expiry heap without the entries of removed or
+        rescheduled sessions"""
+        self.expiry = [
+            (s.refresh_token_expires, next(self._entries), s)
+            for s in self.all_sessions()
+        ]
+        heapq.heapify(self.expiry)
+
+    def reap(self, before: datetime.datetime, limit: int) -> int:
+        """Removes up to limit sessions expired before `before`"""
+        reaped = 0
+        expiry = self.expiry
+        while expiry and reaped < limit and expiry[0][0] < before:
+            expires, _, session = heapq.heappop(expiry)
+            if session.refresh_token_expires != expires:
+                continue  # rescheduled, a newer entry exists
+            if session not in self.user_sessions.get(session.user_id, ()):
+                continue  # already removed
+            self.remove_session(session)
+            reaped += 1
+        return reaped
+
+    def all_sessions(self) -> typing.Iterator[SessionRecord]:
+        # logins of the same second can share an access token, like on
+        # users_session the older ones stay usable by refresh token
+        for sessions in self.user_sessions.values():
+            yield from sessions
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "users": len(self.users),
+            "groups": len(self.groups),
+            "sessions": len(self.sessions),
+            "expiry_heap": len(self.expiry),
+        }
+
+    # snapshots
+
+    def dump(self) -> typing.Dict[str, typing.Any]:
+        now = utcnow()
+        return {
+            "version": SNAPSHOT_VERSION,
+            "groups": dict(self.groups),
+            "users": [
+                [_encode(u, f) for f in USER_FIELDS]
+                for u in self.users.values()
+            ],
+            # expired sessions are not kept
+            "sessions": [
+                [_encode(s, f) for f in SESSION_FIELDS]
+                for s in self.all_sessions()
+                if s.refresh_token_expires > now
+            ],
+        }
+
+    def restore(self, data: typing.Dict[str, typing.Any]):
+        if data.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"unknown snapshot version {data.get('version')}")
+        self.__init__()
+        self.groups = dict(data["groups"])
+        for row in data["users"]:
+            user = UserRecord(**_decode(USER_FIELDS, row))
+            self.users[user.user_id] = user
+            self.emails[user.email] = user
+        for row in data["sessions"]:
+            self.add_session(_decode(SESSION_FIELDS, row))
+        self._user_ids = itertools.count(max(self.users, default=0) + 1)
+        self._group_ids = itertools.count(
+            max(self.groups.values(), default=0) + 1
+        )
+        self.version = 0
+
+    def save(self, path: str):
+        """Writes a json snapshot, atomically replacing path"""
+        write_snapshot(path, self.dump())
+
+    def load(self, path: str):
+        with open(path) as f:
+            self.restore(json.load(f))
+
+
+def write_snapshot(path: str, data: typing.Dict[str, typing.Any]):
+    tmp = f"{path}.tmp"
+    # it holds password hashes and session tokens, only for the owner
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _encode(record, field: str):
+    value = getattr(record, field)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _decode(fields, row) -> typing.Dict[str, typing.Any]:
+    values = dict(zip(fields, row))
+    for field in DATETIME_FIELDS.intersection(values):
+        if values[field] is not None:
+            values[field] = datetime.datetime.fromisoformat(values[field])
+    return values
+
+
+class SnapshotTask(BackgroundTask):
+    """
+    Loads the store from `path` on startup (when it exists), and
+    saves it every `interval` seconds when it changed, and on shutdown.
+    Snapshots are written to a temp file and renamed, a crash never
+    leaves a partial one. Changes since the last snapshot are lost
+    on a crash.
+    """
+
+    name = "memory-snapshot"
+
+    def __init__(self, store: MemoryStore, path: str, *, interval: float = 60):
+        super().__init__()
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.saved_version = 0
+        self.snapshots = 0
+        self.errors = 0
+
+    async def start(self):
+        if not self.running and os.path.exists(self.path):
+            self.store.load(self.path)
+            logger.info("memory storage loaded from %s", self.path)
+        self.saved_version = self.store.version
+        await super().start()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("memory storage snapshot failed")
+
+    async def save(self):
+        version = self.store.version
+        if version == self.saved_version:
+            return
+        # dumped on the loop, consistent, and written from a thread
+        data = self.store.dump()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_snapshot, self.path, data)
+        self.saved_version = version
+        self.snapshots += 1
+
+    async def stop(self):
+        if self.running:
+            await super().stop()
+            await self.save()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "snapshots": self.snapshots,
+            "errors": self.errors,
+            "running": self.running,
+        }
@@ -0,0 +1,249 @@
+from ... import models
+from ...export import EXPORT_COLUMNS
+from ...importer import IMPORT_COLUMNS
+from ..base import decode_cursor
+from ..base import encode_cursor
+from ..base import SEARCH_ORDER
+from .base import MemoryRepository
+from .store import utcnow
+from bisect import bisect_right
+from fastapi.encoders import jsonable_encoder
+from functools import lru_cache
+from typing import Optional
+
+import datetime
+import re
+import typing
+
+USER_MODEL_FIELDS = tuple(f for f in models.User.__fields__ if f != "token")
+PUBLIC_FIELDS = tuple(models.PublicUser.__fields__)
+
+
+@lru_cache(maxsize=256)
+def like(pattern: str) -> typing.Pattern:
+    """an ILIKE pattern as a regular expression"""
+    parts = []
+    for char in pattern:
+        if char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class UserStorage(MemoryRepository):
+    async def create(self, user: models.UserCreate) -> models.PublicUser:
+        record = self.records.add_user(user.dict(exclude_none=True))
+        return self.to_public(record)
+
+    async def by_email(self, email: str) -> Optional[models.User]:
+        # emails are stored lowercased, and matched as given, like the
+        # postgresql and sqlite storages
+        return self.to_model(self.records.emails.get(email))
+
+    async def by_id(self, user_id: int) -> Optional[models.User]:
+        return self.to_model(self.records.users.get(user_id))
+
+    def to_model(self, record) -> Optional[models.User]:
+        if record is None:
+            return None
+        # records are valid already, groups are copied
+        values = record.values(USER_MODEL_FIELDS)
+        values["groups"] = list(values["groups"])
+        return models.User.construct(**values)
+
+    def to_public(self, record) -> models.PublicUser:
+        return models.PublicUser(**record.values(PUBLIC_FIELDS))
+
+    async def by_token(
+        self, *, token: str = None, refresh_token: str = None
+    ) -> Optional[models.User]:
+        assert token or refresh_token, "at least one required"
+        now = utcnow()
+        if token:
+            session = self.records.sessions.get(token)
+            if session is None or session.expires <= now:
+                return None
+        else:
+            session = self.records.refresh_tokens.get(refresh_token)
+            if session is None:
+                return None
+        if session.refresh_token_expires <= now:
+            return None
+        return self.to_model(self.records.users.get(session.user_id))
+
+    def filter(self, q=None, is_staff=None, is_active=None, is_admin=None):
+        """matching users, by user_id"""
+        pattern = like(q).fullmatch if q else None
+        for user in self.records.users.values():
+            if pattern is not None and pattern(user.email) is None:
+                continue
+            if is_staff is not None and user.is_staff != is_staff:
+                continue
+            if is_active is not None and user.is_active != is_active:
+                continue
+            if is_admin is not None and user.is_admin != is_admin:
+                continue
+            yield user
+
+    async def search(
+        self,
+        *,
+        q=None,
+        page=0,
+        limit=100,
+        is_staff=None,
+        is_active=None,
+        is_admin=None,
+        cursor: str = None,
+        order_by: str = "user_id",
+        total: str = "exact",
+        total_cap: int = 10000,
+    ):
+        """Same arguments and results as the postgresql UserStorage"""
+        if order_by not in SEARCH_ORDER:
+            raise ValueError(f"invalid order_by {order_by}")
+        if total not in ("exact", "estimate", "none"):
+            raise ValueError(f"invalid total {total}")
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, order_by)
+            page = 0
+
+        found = list(self.filter(q, is_staff, is_active, is_admin))
+        if order_by == "email":
+            found.sort(key=lambda u: u.email)
+        start = page * limit
+        if after is not None:
+            keys = [getattr(u, order_by) for u in found]
+            start += bisect_right(keys, after)
+        results = found[start : start + limit]
+        next_cursor = None
+        if len(results) == limit and limit > 0:
+            next_cursor = encode_cursor(
+                order_by, getattr(results[-1], order_by)
+            )
+
+        count: Optional[int] = len(found)
+        if total == "none":
+            count = None
+        elif total == "estimate":
+            filters = (q, is_staff, is_active, is_admin)
+            if all(f is None for f in filters):
+                count = len(self.records.users)
+            else:
+                count = min(count, total_cap)
+        return {
+            "total": count,
+            "page": page,
+            "limit": limit,
+            "next_cursor": next_cursor,
+            "items": [self.to_public(r) for r in results],
+        }
+
+    async def export(
+        self,
+        *,
+        q=None,
+        is_staff=None,
+        is_active=None,
+        is_admin=None,
+        prefetch: int = 1000,
+    ) -> typing.AsyncIterator[typing.Mapping]:
+        """Yields all matching users (without password), users created
+        while iterating are not included"""
+        for user in list(self.filter(q, is_staff, is_active, is_admin)):
+            row = user.values(EXPORT_COLUMNS)
+            row["groups"] = list(row["groups"])
+            yield row
+
+    async def bulk_import(
+        self, records: typing.List[tuple], *, update_existing: bool = True
+    ) -> typing.Dict[str, int]:
+        """
+        Stores a batch of users, records are tuples in IMPORT_COLUMNS
+        order, with already hashed passwords. Like the postgresql
+        storage, the last row wins on duplicated emails, missing groups
+        are created and imported groups replace the user ones.
+        """
+        latest: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for record in records:
+            row = dict(zip(IMPORT_COLUMNS, record))
+            email = row.pop("email").lower()
+            previous = latest.get(email)
+            if previous is None or row["n"] >= previous["n"]:
+                row["email"] = email
+                latest[email] = row
+        store = self.records
+        for row in latest.values():
+            for group in row["groups"] or ():
+                if group not in store.groups:
+                    store.add_group(group)
+        created = updated = 0
+        for email, row in latest.items():
+            row.pop("n")
+            row["username"] = row["username"] or "noname"
+            row["groups"] = list(row["groups"] or ())
+            user = store.emails.get(email)
+            if user is None:
+                store.add_user(row)
+                created += 1
+            elif update_existing:
+                store.update_user(user, row)
+                updated += 1
+        if updated:
+            # passwords and groups could have changed
+            await self.invalidate("all", None)
+        return {"created": created, "updated": updated}
+
+    async def update_user(self, user_id: int, data):
+        if "props" in data:
+            data["props"] = jsonable_encoder(data["props"])
+
+        record = self.records.users.get(user_id)
+        groups = data.pop("groups", None)
+        if record is not None and len(data) > 0:
+            password = record.password
+            self.records.update_user(record, data)
+            if "password" in data:
+                await self.invalidate("password", password)
+            await self.invalidate("user", user_id)
+        if groups:
+            await self.update_groups(self.to_model(record), groups)
+        return self.to_public(self.records.users[user_id])
+
+    async def set_last_login(
+        self, user_id: int, last_login: datetime.datetime
+    ) -> Optional[models.PublicUser]:
+        record = self.records.users.get(user_id)
+        if record is None:
+            return None
+        self.records.update_user(record, {"last_login": last_login})
+        return self.to_public(record)
+
+    async def flush_last_login(
+        self,
+        user_ids: typing.List[int],
+        last_login: typing.List[datetime.datetime],
+    ):
+        users = self.records.users
+        for user_id, when in zip(user_ids, last_login):
+            record = users.get(user_id)
+            if record is None:
+                continue
+            if record.last_login is None or record.last_login < when:
+                record.last_login = when
+        self.records.version += 1
+
+    async def update_groups(
+        self, user: models.User, groups: typing.List[str]
+    ) -> models.User:
+        self.records.set_groups(self.records.users[user.user_id], groups)
+        await self.invalidate("user", user.user_id)
+        return await self.by_id(user.user_id)
+
+    async def check_groups(self, *, repair: bool = False):
+        # memberships are only kept on the user, they can't drift
+        return []
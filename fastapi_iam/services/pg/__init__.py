@@ -1,7 +1,21 @@
+from ...context import current_connection
+from .bus import *  # noqa
 from .groups import *  # noqa
+from .outbox import *  # noqa
+from .partitions import *  # noqa
 from .session import *  # noqa
+from .statements import *  # noqa
 from .users import *  # noqa
 
 
-def pg_service_factory(iam, service):
-    return service(iam.pool, iam.settings["db_schema"])
+def pg_service_factory(iam, service, db=None):
+    # use the connection bound to the request when there's one
+    if db is None:
+        db = current_connection() or iam.pool
+    return service(
+        db,
+        iam.settings["db_schema"],
+        invalidator=iam.publish,
+        metrics=iam.metrics,
+        outbox=iam.settings["outbox"],
+    )
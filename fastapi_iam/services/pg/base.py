@@ -1,11 +1,34 @@
+from ..base import InstrumentedRepository
+from .statements import get_statements
+from .statements import Statements
+
 import asyncpg
+import typing
 
 
-class BaseRepository:
-    def __init__(self, db: asyncpg.Connection, schema: str = None):
+class BaseRepository(InstrumentedRepository):
+    def __init__(
+        self,
+        db: asyncpg.Connection,
+        schema: str = None,
+        invalidator: typing.Callable = None,
+        metrics=None,
+        outbox: bool = False,
+    ):
         self.db = db
         self._schema = schema
+        # awaited with (db, kind, key) when cached data should be dropped
+        self.invalidator = invalidator
+        # optional metrics.MetricsSink
+        self.metrics = metrics
+        # write auth events to users_outbox, with the session changes
+        self.outbox = outbox
+        self.statements: Statements = get_statements(schema)
 
     @property
     def schema(self):
         return f"{self._schema}." if self._schema else ""
+
+    async def invalidate(self, kind: str, key, *, db=None):
+        if self.invalidator is not None:
+            await self.invalidator(db or self.db, kind, key)
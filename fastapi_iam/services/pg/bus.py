@@ -0,0 +1,112 @@
+from ...tasks import BackgroundTask
+
+import asyncio
+import logging
+import uuid
+
+logger = logging.getLogger("fastapi_iam")
+
+
+class InvalidationBus(BackgroundTask):
+    """
+    Keeps per worker caches coherent using postgresql LISTEN/NOTIFY.
+    Storage services publish compact messages like `user:12` or
+    `token:<token_key>` on the same connection (and transaction) they
+    write with, so notifications are only delivered after commit.
+    Every worker holds one pool connection listening on the channel,
+    and evicts matching local entries.
+    If the listening connection is lost, notifications could have been
+    missed, so after reconnecting all local caches are flushed.
+    """
+
+    name = "invalidation-bus"
+    # password hashes are never published, stale credential entries
+    # are unreachable once the stored hash changes
+    kinds = ("token", "user", "all")
+
+    def __init__(
+        self,
+        iam,
+        *,
+        channel: str = "fastapi_iam",
+        check_interval: float = 30,
+        reconnect_delay: float = 1,
+    ):
+        super().__init__()
+        self.iam = iam
+        self.channel = channel
+        self.check_interval = check_interval
+        self.reconnect_delay = reconnect_delay
+        self.origin = uuid.uuid4().hex[:8]
+        self.received = 0
+        self.published = 0
+        self.reconnects = 0
+
+    async def publish(self, db, kind: str, key):
+        if kind not in self.kinds:
+            return
+        await db.execute(
+            "SELECT pg_notify($1, $2)",
+            self.channel,
+            f"{self.origin}|{kind}:{key}",
+        )
+        self.published += 1
+
+    def on_message(self, conn, pid, channel, payload: str):
+        origin, _, message = payload.partition("|")
+        if origin == self.origin:
+            return  # already evicted when published
+        kind, _, key = message.partition(":")
+        self.received += 1
+        if kind == "user":
+            self.iam.invalidate(kind, int(key))
+        elif kind in self.kinds:
+            self.iam.invalidate(kind, key)
+        else:
+            logger.warning("unknown invalidation message %s", payload)
+
+    async def run(self):
+        connected_once = False
+        while True:
+            try:
+                await self.listen(flush=connected_once)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("invalidation bus connection lost")
+            connected_once = True
+            self.reconnects += 1
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def listen(self, *, flush: bool):
+        pool = self.iam.pool
+        conn = await pool.acquire()
+        lost = asyncio.Event()
+
+        def on_termination(conn):
+            lost.set()
+
+        try:
+            conn.add_termination_listener(on_termination)
+            await conn.add_listener(self.channel, self.on_message)
+            if flush:
+                # we could have missed notifications while disconnected
+                self.iam.invalidate("all", None)
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), self.check_interval)
+                except asyncio.TimeoutError:
+                    await conn.fetchval("SELECT 1")
+        finally:
+            if not conn.is_closed():
+                await conn.remove_listener(self.channel, self.on_message)
+                conn.remove_termination_listener(on_termination)
+            await pool.release(conn)
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "received": self.received,
+            "reconnects": self.reconnects,
+            "listening": self.running,
+        }
@@ -7,6 +7,5 @@ class GroupStorage(BaseRepository):
         return await sql.insert(self.db, f"{self.schema}groups", {"name": name})
 
     async def get_groups(self):
-        return [
-            r["name"] for r in await self.db.fetch("SELECT name from groups")
-        ]
+        rows = await self.statements.fetch(self.db, "groups_names")
+        return [r["name"] for r in rows]
@@ -0,0 +1,101 @@
+from ...tasks import BackgroundTask
+from .statements import get_statements
+
+import asyncio
+import json
+import logging
+import random
+import typing
+
+logger = logging.getLogger("fastapi_iam")
+
+
+def to_event(row) -> typing.Dict[str, typing.Any]:
+    event = dict(row)
+    if isinstance(event["data"], str):
+        event["data"] = json.loads(event["data"])
+    return event
+
+
+async def claim_events(db, limit: int, schema: str = None):
+    """Deletes and returns up to limit outbox events, oldest first.
+    Run it inside a transaction, rolling back returns them"""
+    rows = await get_statements(schema).fetch(db, "outbox_claim", limit)
+    return sorted((to_event(row) for row in rows), key=lambda e: e["id"])
+
+
+class OutboxRelay(BackgroundTask):
+    """
+    Delivers the auth events stored on users_outbox (see the outbox
+    setting) to the registered sinks.
+    Every batch of up to `batch_size` events is claimed with FOR UPDATE
+    SKIP LOCKED and deleted in the transaction delivering it, so
+    several workers can relay at once without sharing events. When a
+    sink fails the transaction is rolled back and the batch is retried
+    later: delivery is at least once, sinks should dedupe by event id.
+    Full batches are followed by the next one right away, otherwise
+    the outbox is polled every `interval` seconds.
+
+        async def sink(events):  # a list of dicts, id, event, user_id,
+            ...                  # data and created, ordered by id
+
+        iam.outbox.add_sink(sink)
+    """
+
+    name = "outbox-relay"
+
+    def __init__(self, iam, *, interval: float = 1, batch_size: int = 500):
+        super().__init__()
+        self.iam = iam
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sinks: typing.List[typing.Callable] = []
+        self.batches = 0
+        self.delivered = 0
+        self.errors = 0
+        self.last_batch_size = 0
+
+    def add_sink(self, sink: typing.Callable):
+        self.sinks.append(sink)
+
+    async def run(self):
+        # spread workers started at the same time
+        await asyncio.sleep(self.interval * random.random())
+        while True:
+            try:
+                relayed = await self.relay()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                relayed = 0
+                logger.exception("relaying outbox events failed")
+            if relayed < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def relay(self) -> int:
+        """Delivers a batch, returns its size"""
+        if not self.sinks:
+            return 0
+        async with self.iam.connection(transaction=True) as db:
+            events = await claim_events(
+                db, self.batch_size, self.iam.settings["db_schema"]
+            )
+            if events:
+                for sink in self.sinks:
+                    await sink(events)
+        self.last_batch_size = len(events)
+        if events:
+            self.batches += 1
+            self.delivered += len(events)
+        return len(events)
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "batches": self.batches,
+            "delivered": self.delivered,
+            "errors": self.errors,
+            "last_batch_size": self.last_batch_size,
+            "sinks": len(self.sinks),
+            "running": self.running,
+        }
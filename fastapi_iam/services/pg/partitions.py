@@ -0,0 +1,104 @@
+from ...tasks import BackgroundTask
+
+import asyncio
+import datetime
+import logging
+import random
+import typing
+
+logger = logging.getLogger("fastapi_iam")
+
+
+async def is_partitioned(db, schema: str = "") -> bool:
+    return bool(
+        await db.fetchval(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass($1)",
+            f"{schema}users_session",
+        )
+    )
+
+
+# partitions are kept a month ahead of the longest session, so a late
+# maintenance run doesn't leave new sessions on the default partition
+HEADROOM = datetime.timedelta(days=31)
+
+
+def partitions_until(
+    now: datetime.datetime, session_expiration: int
+) -> datetime.datetime:
+    return now + datetime.timedelta(seconds=session_expiration) + HEADROOM
+
+
+async def create_partitions(
+    db, schema: str, since: datetime.datetime, until: datetime.datetime
+) -> int:
+    """Makes sure monthly users_session partitions exist
+    from since to until, returns how many were created"""
+    return await db.fetchval(
+        f"SELECT {schema}create_session_partitions($1, $2)", since, until
+    )
+
+
+async def drop_partitions(db, schema: str, before: datetime.datetime) -> int:
+    """Drops partitions where all sessions expired before `before`"""
+    return await db.fetchval(
+        f"SELECT {schema}drop_session_partitions($1)", before
+    )
+
+
+class SessionPartitionMaintainer(BackgroundTask):
+    """
+    Keeps users_session partitions ready for sessions expiring up to
+    session_expiration (plus a month) from now, and drops partitions once all their
+    sessions expired (a metadata only operation, no row deletes).
+    Needs the optional partitioning migration, see the session_partitions
+    setting. Partition functions take an advisory lock, so it's safe
+    to run it from several workers.
+    """
+
+    name = "session-partitions"
+
+    def __init__(self, iam, *, interval: float = 60 * 60):
+        super().__init__()
+        self.iam = iam
+        self.interval = interval
+        self.runs = 0
+        self.errors = 0
+        self.created = 0
+        self.dropped = 0
+
+    @property
+    def schema(self) -> str:
+        schema = self.iam.settings["db_schema"]
+        return f"{schema}." if schema else ""
+
+    async def run(self):
+        while True:
+            try:
+                await self.maintain()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("maintaining session partitions failed")
+            await asyncio.sleep(self.interval * random.uniform(0.9, 1.1))
+
+    async def maintain(self):
+        now = datetime.datetime.utcnow()
+        until = partitions_until(now, self.iam.settings["session_expiration"])
+        async with self.iam.connection() as db:
+            if not await is_partitioned(db, self.schema):
+                logger.warning("users_session is not partitioned")
+                return
+            self.created += await create_partitions(db, self.schema, now, until)
+            self.dropped += await drop_partitions(db, self.schema, now)
+        self.runs += 1
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "created": self.created,
+            "dropped": self.dropped,
+            "running": self.running,
+        }
@@ -1,8 +1,10 @@
 from ... import models
+from ...cache import token_key
 from .base import BaseRepository
 from fastapi_asyncpg import sql
 
 import datetime
+import typing
 
 
 class SessionStorage(BaseRepository):
@@ -14,24 +16,71 @@ class SessionStorage(BaseRepository):
         )
         return models.UserSession(**dict(result))
 
+    async def login(
+        self, us: models.UserSession, last_login: datetime.datetime
+    ) -> models.PublicUser:
+        """Stores the session and stamps the user last_login
+        in a single statement, returns the updated user"""
+        args = [
+            us.token,
+            us.user_id,
+            us.expires,
+            us.refresh_token,
+            us.refresh_token_expires,
+            us.data,
+            last_login,
+        ]
+        name = "session_login"
+        if self.outbox:
+            name = "session_login_outbox"
+            args.append(token_key(us.token))
+        row = await self.statements.fetchrow(self.db, name, *args)
+        return models.PublicUser(**dict(row))
+
+    async def store(self, us: models.UserSession, user: models.User):
+        """Stores the session of a login without stamping the user
+        last_login, see ActivityBuffer"""
+        args = [
+            us.token,
+            us.user_id,
+            us.expires,
+            us.refresh_token,
+            us.refresh_token_expires,
+            us.data,
+        ]
+        if self.outbox:
+            args += [user.email, token_key(us.token)]
+            await self.statements.fetchval(
+                self.db, "session_store_outbox", *args
+            )
+        else:
+            await self.statements.fetchval(self.db, "session_store", *args)
+
+    async def flush_last_used(
+        self,
+        tokens: typing.List[str],
+        last_used: typing.List[datetime.datetime],
+    ):
+        """Stamps last_used of many sessions in one statement"""
+        await self.statements.fetchval(
+            self.db, "sessions_flush_last_used", tokens, last_used
+        )
+
     async def is_expired(self, refresh_token: str) -> bool:
-        expiration = await self.db.fetchval(
-            f"""
-            SELECT refresh_token_expires
-                FROM {self.schema}users_session
-            WHERE refresh_token=$1
-        """,
-            refresh_token,
+        now = datetime.datetime.utcnow()
+        expiration = await self.statements.fetchval(
+            self.db, "session_is_expired", refresh_token, now
         )
-        return expiration < datetime.datetime.utcnow()
+        return expiration is None or expiration < now
 
     async def delete(self, token):
-        await sql.delete(
-            self.db,
-            f"{self.schema}users_session",
-            "token=$1",
-            args=[token],
-        )
+        if self.outbox:
+            await self.statements.fetchval(
+                self.db, "session_delete_outbox", token, token_key(token)
+            )
+        else:
+            await self.statements.fetchval(self.db, "session_delete", token)
+        await self.invalidate("token", token_key(token))
 
     async def update_token(
         self,
@@ -42,20 +91,25 @@ class SessionStorage(BaseRepository):
         new_rt: str = None,  # set it to rotate the refresh token
         new_rte: str = None,
     ):
-        extra = ""
+        name = "session_update_token"
         args = [token, expires, refresh_token]
         if new_rt:
             assert (
                 new_rt and new_rte
             ), "new_token and new_token_expiration required"
-            extra = ", refresh_token=$4, refresh_token_expires=$5"
+            name = "session_update_token_rotate"
             args = args + [new_rt, new_rte]
 
-        await self.db.execute(
-            f"""
-            UPDATE {self.schema}users_session
-                set token=$1, expires=$2 {extra}
-            WHERE refresh_token=$3
-        """,
-            *args,
+        # returns the replaced access tokens, to drop them from caches
+        replaced = await self.statements.fetch(self.db, name, *args)
+        for row in replaced:
+            await self.invalidate("token", token_key(row["token"]))
+
+    async def reap_expired(
+        self, before: datetime.datetime, limit: int = 500
+    ) -> int:
+        """Deletes up to limit sessions whose refresh token expired
+        before `before`, returns how many were deleted"""
+        return await self.statements.fetchval(
+            self.db, "session_reap", before, limit
         )
@@ -0,0 +1,446 @@
+from ...export import EXPORT_COLUMNS
+
+import asyncpg
+import logging
+import typing
+import weakref
+
+logger = logging.getLogger("fastapi_iam")
+
+
+def build_queries(schema: str) -> typing.Dict[str, str]:
+    # groups are denormalized on the users row (see 0002 migration)
+    base_query = f"SELECT u.* FROM {schema}users u"
+    search_conds = """
+            WHERE ($1::varchar IS NULL OR u.email ilike $1)
+              AND ($2::boolean IS NULL OR u.is_staff = $2)
+              AND ($3::boolean IS NULL OR u.is_active = $3)
+              AND ($4::boolean IS NULL OR u.is_admin = $4)
+    """
+    # last row wins on duplicated emails, existing memberships not in
+    # the imported groups are removed, new ones added.
+    # xmax = 0 tells created from updated rows
+    import_users = f"""
+            WITH u AS (
+                INSERT INTO {schema}users
+                    (email, password, username,
+                     is_staff, is_active, is_admin, groups)
+                SELECT DISTINCT ON (i.email)
+                    i.email, i.password, coalesce(i.username, 'noname'),
+                    i.is_staff, i.is_active, i.is_admin, i.groups
+                FROM iam_import i
+                ORDER BY i.email, i.n DESC
+                ON CONFLICT (email) DO {{on_conflict}}
+                RETURNING user_id, groups, (xmax = 0) AS created
+            ), d AS (
+                DELETE FROM {schema}users_group ug
+                USING u, {schema}groups g
+                WHERE ug.user_id = u.user_id AND ug.group_id = g.group_id
+                  AND g.name <> ALL(u.groups)
+            ), m AS (
+                INSERT INTO {schema}users_group (user_id, group_id)
+                SELECT u.user_id, g.group_id
+                    FROM u INNER JOIN {schema}groups g
+                    ON g.name = ANY(u.groups)
+                ON CONFLICT (user_id, group_id) DO NOTHING
+            )
+            SELECT count(*) FILTER (WHERE created) AS created,
+                count(*) FILTER (WHERE NOT created) AS updated
+            FROM u
+    """
+    export_columns = ", ".join(f"u.{c}" for c in EXPORT_COLUMNS)
+    groups_drift = f"""
+            SELECT u.user_id, u.groups as stored,
+                coalesce(a.groups, '{{}}') as expected
+            FROM {schema}users u
+            LEFT JOIN LATERAL (
+                SELECT array_agg(g.name ORDER BY g.name) as groups
+                FROM {schema}groups g
+                    INNER JOIN {schema}users_group ug using(group_id)
+                WHERE ug.user_id = u.user_id
+            ) a on true
+            WHERE NOT (
+                u.groups @> coalesce(a.groups, '{{}}')
+                AND u.groups <@ coalesce(a.groups, '{{}}')
+            )
+    """
+    # auth events written by the statement changing the session,
+    # see the optional outbox migration
+    outbox = f"""
+            o AS (
+                INSERT INTO {schema}users_outbox (event, user_id, data)
+                SELECT {{event}}, user_id, {{data}} FROM {{source}}
+            )
+    """
+    # $8 (login) and $2 (logout) are the token_key of the session
+    login_outbox = outbox.format(
+        event="'UserLogin'",
+        data="jsonb_build_object('email', email, 'session', $8::text)",
+        source="u",
+    )
+    last_login_outbox = outbox.format(
+        event="'UserLogin'",
+        data="jsonb_build_object('email', email)",
+        source="u",
+    )
+    store_outbox = outbox.format(
+        event="'UserLogin'",
+        data="jsonb_build_object('email', $7::text, 'session', $8::text)",
+        source="s",
+    )
+    logout_outbox = outbox.format(
+        event="'UserLogout'",
+        data="jsonb_build_object('session', $2::text)",
+        source="d",
+    )
+    return {
+        "base_query": base_query,
+        "user_by_email": f"{base_query} WHERE email=$1",
+        "user_by_id": f"{base_query} WHERE user_id=$1",
+        "user_by_token": f"""
+            {base_query}
+            INNER JOIN {schema}users_session t using(user_id)
+            WHERE token=$1 and expires>now()
+                and refresh_token_expires>now()
+        """,
+        "user_by_refresh_token": f"""
+            {base_query}
+            INNER JOIN {schema}users_session t using(user_id)
+            WHERE refresh_token=$1 and refresh_token_expires>now()
+        """,
+        # keyset pagination, $5 is the last seen key (NULL for first page)
+        "user_search_by_user_id": f"""
+            {base_query}
+            {search_conds}
+              AND ($5::integer IS NULL OR u.user_id > $5)
+            ORDER BY u.user_id
+            LIMIT $6 OFFSET $7
+        """,
+        "user_search_by_email": f"""
+            {base_query}
+            {search_conds}
+              AND ($5::varchar IS NULL OR u.email > $5)
+            ORDER BY u.email
+            LIMIT $6 OFFSET $7
+        """,
+        "user_search_count": f"""
+            SELECT count(*) FROM {schema}users u
+            {search_conds}
+        """,
+        "user_search_count_capped": f"""
+            SELECT count(*) FROM (
+                SELECT 1 FROM {schema}users u
+                {search_conds}
+                LIMIT $5
+            ) c
+        """,
+        "users_estimate": f"""
+            SELECT reltuples::bigint FROM pg_class
+            WHERE oid = '{schema}users'::regclass
+        """,
+        "user_export": f"""
+            SELECT {export_columns} FROM {schema}users u
+            {search_conds}
+            ORDER BY u.user_id
+        """,
+        # bulk import, rows are copied into a per connection temp table
+        "import_staging": """
+            CREATE TEMP TABLE IF NOT EXISTS iam_import (
+                n integer,
+                email varchar(254),
+                password varchar(128),
+                username varchar(254),
+                is_staff boolean,
+                is_active boolean,
+                is_admin boolean,
+                groups varchar(150)[]
+            ) ON COMMIT DELETE ROWS
+        """,
+        "import_groups": f"""
+            INSERT INTO {schema}groups (name)
+                SELECT DISTINCT unnest(groups) FROM iam_import
+            ON CONFLICT (name) DO NOTHING
+        """,
+        "import_users": import_users.format(on_conflict="""UPDATE SET
+                    password = EXCLUDED.password,
+                    username = EXCLUDED.username,
+                    is_staff = EXCLUDED.is_staff,
+                    is_active = EXCLUDED.is_active,
+                    is_admin = EXCLUDED.is_admin,
+                    groups = EXCLUDED.groups"""),
+        "import_users_new": import_users.format(on_conflict="NOTHING"),
+        "user_set_last_login": f"""
+            WITH u AS (
+                UPDATE {schema}users SET last_login=$2
+                WHERE user_id=$1
+                RETURNING *
+            )
+            SELECT * FROM u
+        """,
+        "user_set_last_login_outbox": f"""
+            WITH u AS (
+                UPDATE {schema}users SET last_login=$2
+                WHERE user_id=$1
+                RETURNING *
+            ), {last_login_outbox}
+            SELECT * FROM u
+        """,
+        # last_login of many users, coalesced by the ActivityBuffer.
+        # rows are locked in user_id order, the guard skips stale stamps
+        "users_flush_last_login": f"""
+            UPDATE {schema}users u SET last_login = v.last_login
+            FROM unnest($1::integer[], $2::timestamp[])
+                AS v(user_id, last_login)
+            WHERE u.user_id = v.user_id
+              AND (u.last_login IS NULL OR u.last_login < v.last_login)
+        """,
+        "user_update_groups": f"SELECT FROM {schema}update_groups($1, $2)",
+        "session_login": f"""
+            WITH s AS (
+                INSERT INTO {schema}users_session
+                    (token, user_id, expires, refresh_token,
+                     refresh_token_expires, data)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                RETURNING user_id
+            ), u AS (
+                UPDATE {schema}users SET last_login=$7
+                FROM s WHERE users.user_id = s.user_id
+                RETURNING users.*
+            )
+            SELECT * FROM u
+        """,
+        "session_login_outbox": f"""
+            WITH s AS (
+                INSERT INTO {schema}users_session
+                    (token, user_id, expires, refresh_token,
+                     refresh_token_expires, data)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                RETURNING user_id
+            ), u AS (
+                UPDATE {schema}users SET last_login=$7
+                FROM s WHERE users.user_id = s.user_id
+                RETURNING users.*
+            ), {login_outbox}
+            SELECT * FROM u
+        """,
+        # a session, last_login is stamped later by the ActivityBuffer
+        "session_store": f"""
+            INSERT INTO {schema}users_session
+                (token, user_id, expires, refresh_token,
+                 refresh_token_expires, data)
+            VALUES ($1, $2, $3, $4, $5, $6)
+        """,
+        # $7 is the user email, $8 the token_key of the session
+        "session_store_outbox": f"""
+            WITH s AS (
+                INSERT INTO {schema}users_session
+                    (token, user_id, expires, refresh_token,
+                     refresh_token_expires, data)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                RETURNING user_id
+            ), {store_outbox}
+            SELECT count(*) FROM s
+        """,
+        "sessions_flush_last_used": f"""
+            UPDATE {schema}users_session s SET last_used = v.last_used
+            FROM unnest($1::varchar[], $2::timestamp[])
+                AS v(token, last_used)
+            WHERE s.token = v.token and s.refresh_token_expires>now()
+        """,
+        # sessions past refresh_token_expires are dead (and could be
+        # reaped, or their partition dropped), filtering by it also
+        # prunes expired partitions
+        "session_is_expired": f"""
+            SELECT refresh_token_expires
+                FROM {schema}users_session
+            WHERE refresh_token=$1 and refresh_token_expires>$2
+        """,
+        "session_delete": f"""
+            DELETE FROM {schema}users_session
+            WHERE token=$1 and refresh_token_expires>now()
+        """,
+        "session_delete_outbox": f"""
+            WITH d AS (
+                DELETE FROM {schema}users_session
+                WHERE token=$1 and refresh_token_expires>now()
+                RETURNING user_id
+            ), {logout_outbox}
+            SELECT count(*) FROM d
+        """,
+        "session_update_token": f"""
+            UPDATE {schema}users_session s
+                set token=$1, expires=$2
+            FROM (
+                SELECT token FROM {schema}users_session
+                WHERE refresh_token=$3 and refresh_token_expires>now()
+            ) old
+            WHERE s.refresh_token=$3 and s.refresh_token_expires>now()
+            RETURNING old.token
+        """,
+        "session_update_token_rotate": f"""
+            UPDATE {schema}users_session s
+                set token=$1, expires=$2,
+                    refresh_token=$4, refresh_token_expires=$5
+            FROM (
+                SELECT token FROM {schema}users_session
+                WHERE refresh_token=$3 and refresh_token_expires>now()
+            ) old
+            WHERE s.refresh_token=$3 and s.refresh_token_expires>now()
+            RETURNING old.token
+        """,
+        # batch of expired sessions, rows locked by another worker
+        # (or a concurrent refresh) are skipped
+        "session_reap": f"""
+            WITH expired AS (
+                SELECT tableoid, ctid FROM {schema}users_session
+                WHERE refresh_token_expires < $1
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            ), d AS (
+                -- a ctid is only unique within a partition
+                DELETE FROM {schema}users_session s
+                USING expired
+                WHERE s.tableoid = expired.tableoid and s.ctid = expired.ctid
+                RETURNING 1
+            )
+            SELECT count(*) FROM d
+        """,
+        # a batch of events, deleted on commit, rows claimed by another
+        # relay are skipped
+        "outbox_claim": f"""
+            WITH batch AS (
+                SELECT id FROM {schema}users_outbox
+                ORDER BY id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            DELETE FROM {schema}users_outbox o
+            USING batch WHERE o.id = batch.id
+            RETURNING o.id, o.event, o.user_id, o.data, o.created
+        """,
+        "groups_names": f"SELECT name from {schema}groups",
+        # users with groups not matching users_group
+        "groups_drift": groups_drift,
+        "groups_repair": f"""
+            UPDATE {schema}users u SET groups = d.expected
+            FROM ({groups_drift}) d
+            WHERE u.user_id = d.user_id
+            RETURNING d.*
+        """,
+    }
+
+
+# queries on temp tables, or templates, can't be prepared upfront
+NOT_PREPARED = (
+    "base_query",
+    "import_staging",
+    "import_groups",
+    "import_users",
+    "import_users_new",
+)
+
+# queries on optional tables, prepared only when the table exists
+OPTIONAL = {
+    "user_set_last_login_outbox": "users_outbox",
+    "session_login_outbox": "users_outbox",
+    "session_delete_outbox": "users_outbox",
+    "session_store_outbox": "users_outbox",
+    "outbox_claim": "users_outbox",
+}
+
+
+class Statements:
+    """
+    Registry of the storage queries of a schema.
+    Queries are built once, and could be prepared on every pool
+    connection (see IAM.init_connection) to skip parsing and planning.
+    When running on a connection without them (or on the pool itself)
+    queries are sent as plain sql, hitting the asyncpg statement cache.
+    """
+
+    def __init__(self, schema: str = None):
+        self.schema = f"{schema}." if schema else ""
+        self.queries = build_queries(self.schema)
+        self._prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # connections that couldn't prepare, the db was not migrated
+        self.unprepared = 0
+
+    def __getitem__(self, name: str) -> str:
+        return self.queries[name]
+
+    async def prepare(self, conn):
+        """Prepares all queries on a connection,
+        usable as the asyncpg pool init hook"""
+        prepared = {}
+        tables = set(OPTIONAL.values())
+        # a failed prepare would abort the transaction we could be in
+        existing = await conn.fetchval(
+            "SELECT array_agg(t) FROM unnest($1::text[]) t "
+            "WHERE to_regclass($2 || t) IS NOT NULL",
+            list(tables),
+            self.schema,
+        )
+        try:
+            for name, query in self.queries.items():
+                if name in NOT_PREPARED:
+                    continue
+                if name in OPTIONAL and OPTIONAL[name] not in (existing or ()):
+                    continue
+                prepared[name] = await conn.prepare(query)
+        except asyncpg.exceptions.SyntaxOrAccessError:
+            # db not migrated yet, plain queries will be used
+            logger.warning("statements not prepared, missing tables")
+            self.unprepared += 1
+            return
+        self._prepared[_raw(conn)] = prepared
+
+    def prepared(self, db, name: str):
+        try:
+            statements = self._prepared.get(_raw(db))
+        except TypeError:  # not a connection, could be a pool
+            return None
+        return statements.get(name) if statements else None
+
+    async def _run(self, method: str, db, name: str, *args):
+        statement = self.prepared(db, name)
+        if statement is not None:
+            try:
+                return await getattr(statement, method)(*args)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                # schema changed, stop using prepared statements here
+                self._prepared.pop(_raw(db), None)
+                if _raw(db).is_in_transaction():
+                    # aborted, the plain query would fail too
+                    raise
+        return await getattr(db, method)(self.queries[name], *args)
+
+    async def fetch(self, db, name: str, *args):
+        return await self._run("fetch", db, name, *args)
+
+    async def fetchrow(self, db, name: str, *args):
+        return await self._run("fetchrow", db, name, *args)
+
+    async def fetchval(self, db, name: str, *args):
+        return await self._run("fetchval", db, name, *args)
+
+    def cursor(self, db, name: str, *args, prefetch: int = None):
+        """A server side cursor, must be iterated inside a transaction"""
+        statement = self.prepared(db, name)
+        if statement is not None:
+            return statement.cursor(*args, prefetch=prefetch)
+        return db.cursor(self.queries[name], *args, prefetch=prefetch)
+
+
+def _raw(db):
+    # pool connection proxies wrap the real connection
+    return getattr(db, "_con", db)
+
+
+_registry: typing.Dict[str, Statements] = {}
+
+
+def get_statements(schema: str = None) -> Statements:
+    key = schema or ""
+    if key not in _registry:
+        _registry[key] = Statements(schema)
+    return _registry[key]
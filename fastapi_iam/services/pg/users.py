@@ -1,9 +1,15 @@
 from ... import models
+from ...importer import IMPORT_COLUMNS
+from ..base import decode_cursor
+from ..base import encode_cursor
+from ..base import SEARCH_ORDER
 from .base import BaseRepository
+from contextlib import asynccontextmanager
 from fastapi.encoders import jsonable_encoder
 from fastapi_asyncpg import sql
 from typing import Optional
 
+import datetime
 import typing
 
 
@@ -14,15 +20,11 @@ class UserStorage(BaseRepository):
         return models.PublicUser(**dict(await self.by_id(result["user_id"])))
 
     async def by_email(self, email: str) -> Optional[models.User]:
-        q = f"{self.base_query()} WHERE email=$1 GROUP BY u.user_id"
-        row = await self.db.fetchrow(q, email)
+        row = await self.statements.fetchrow(self.db, "user_by_email", email)
         return self.to_model(row)
 
     async def by_id(self, user_id: int):
-        row = await self.db.fetchrow(
-            f"{self.base_query()} WHERE user_id=$1 GROUP BY u.user_id",
-            user_id,
-        )
+        row = await self.statements.fetchrow(self.db, "user_by_id", user_id)
         return self.to_model(row)
 
     def to_model(self, row) -> Optional[models.User]:
@@ -34,18 +36,14 @@ class UserStorage(BaseRepository):
         self, *, token: str = None, refresh_token: str = None
     ) -> Optional[models.User]:
         assert token or refresh_token, "at least one required"
-        field = "token" if token else "refresh_token"
-        refresh_field = "expires" if token else "refresh_token_expires"
-        value = token if token else refresh_token
-        row = await self.db.fetchrow(
-            f"""
-            {self.base_query()}
-            LEFT JOIN {self.schema}users_session t using(user_id)
-            WHERE {field}=$1 and {refresh_field}>now()
-            GROUP BY u.user_id
-            """,
-            value,
-        )
+        if token:
+            row = await self.statements.fetchrow(
+                self.db, "user_by_token", token
+            )
+        else:
+            row = await self.statements.fetchrow(
+                self.db, "user_by_refresh_token", refresh_token
+            )
         return self.to_model(row)
 
     async def search(
@@ -57,44 +55,116 @@ class UserStorage(BaseRepository):
         is_staff=None,
         is_active=None,
         is_admin=None,
+        cursor: str = None,
+        order_by: str = "user_id",
+        total: str = "exact",
+        total_cap: int = 10000,
     ):
-        conds = []
-        args = []
-        if q:
-            conds.append("u.email ilike $1")
-            args.append(q)
-        if is_staff is not None:
-            conds.append(f"u.is_staff = {to_str(is_staff)}")
-        if is_active is not None:
-            conds.append(f"u.is_active = {to_str(is_active)}")
-        if is_admin is not None:
-            conds.append(f"u.is_admin = {to_str(is_admin)}")
-
-        qs = f"""
-            {self.base_query()}
-            {'WHERE ' + ' AND '.join(conds) if len(conds) > 0 else ''}
-            GROUP BY u.user_id
         """
-        pag = f"LIMIT {limit} OFFSET {page*limit}"
-        total = await self.db.fetchval(
-            f"""SELECT count(*) FROM (
-                {qs}
-            ) as foo""",
-            *args,
-        )
-        results = await self.db.fetch(
-            f"""
-            {qs} {pag}
-        """,
-            *args,
+        Search users, paginated with page/limit (offset) or with an opaque
+        cursor (keyset) taken from the next_cursor of the previous page.
+        Keyset pages cost the same no matter how deep they are.
+        total is one of:
+            exact: count(*) of the matching users
+            estimate: planner estimate without filters, otherwise a count
+                capped to total_cap
+            none: skip counting
+        """
+        if order_by not in SEARCH_ORDER:
+            raise ValueError(f"invalid order_by {order_by}")
+        if total not in ("exact", "estimate", "none"):
+            raise ValueError(f"invalid total {total}")
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, order_by)
+            page = 0
+
+        # an empty q is no filter
+        conds = [q or None, is_staff, is_active, is_admin]
+        results = await self.statements.fetch(
+            self.db,
+            f"user_search_by_{order_by}",
+            *conds,
+            after,
+            limit,
+            page * limit,
         )
+        next_cursor = None
+        if len(results) == limit and limit > 0:
+            next_cursor = encode_cursor(order_by, results[-1][order_by])
         return {
-            "total": total,
+            "total": await self.count(conds, total, total_cap),
             "page": page,
             "limit": limit,
+            "next_cursor": next_cursor,
             "items": [models.PublicUser(**dict(res)) for res in results],
         }
 
+    async def count(self, conds, total: str, total_cap: int):
+        if total == "none":
+            return None
+        if total == "estimate":
+            if all(c is None for c in conds):
+                estimate = await self.statements.fetchval(
+                    self.db, "users_estimate"
+                )
+                if estimate is not None and estimate >= 0:
+                    return estimate
+            return await self.statements.fetchval(
+                self.db, "user_search_count_capped", *conds, total_cap
+            )
+        return await self.statements.fetchval(
+            self.db, "user_search_count", *conds
+        )
+
+    async def export(
+        self,
+        *,
+        q=None,
+        is_staff=None,
+        is_active=None,
+        is_admin=None,
+        prefetch: int = 1000,
+    ) -> typing.AsyncIterator[typing.Mapping]:
+        """
+        Yields all matching users (without password) from a server side
+        cursor, fetching prefetch rows at a time, so memory use doesn't
+        depend on how many users are exported.
+        When the storage is bound to a pool, a connection is held until
+        the iteration ends.
+        """
+        args = [q or None, is_staff, is_active, is_admin]
+        async with _acquire(self.db) as conn:
+            async with conn.transaction():
+                cursor = self.statements.cursor(
+                    conn, "user_export", *args, prefetch=prefetch
+                )
+                async for row in cursor:
+                    yield row
+
+    async def bulk_import(
+        self, records: typing.List[tuple], *, update_existing: bool = True
+    ) -> typing.Dict[str, int]:
+        """
+        Stores a batch of users in one transaction, records are tuples
+        in IMPORT_COLUMNS order, with already hashed passwords.
+        Rows are COPYed into a temp staging table, and groups, users and
+        memberships are upserted from it with set based statements.
+        """
+        name = "import_users" if update_existing else "import_users_new"
+        async with _acquire(self.db) as conn:
+            async with conn.transaction():
+                await conn.execute(self.statements["import_staging"])
+                await conn.copy_records_to_table(
+                    "iam_import", records=records, columns=IMPORT_COLUMNS
+                )
+                await conn.execute(self.statements["import_groups"])
+                row = await conn.fetchrow(self.statements[name])
+                if row["updated"]:
+                    # passwords and groups could have changed
+                    await self.invalidate("all", None, db=conn)
+        return dict(row)
+
     async def update_user(self, user_id: int, data):
         if "props" in data:
             data["props"] = jsonable_encoder(data["props"])
@@ -105,33 +175,59 @@ class UserStorage(BaseRepository):
             await sql.update(
                 self.db, f"{self.schema}users", {"user_id": user_id}, data
             )
+            if user is not None and "password" in data:
+                await self.invalidate("password", user.password)
+            await self.invalidate("user", user_id)
         if groups:
             await self.update_groups(user, groups)
         return models.PublicUser(**dict(await self.by_id(user_id)))
 
+    async def set_last_login(
+        self, user_id: int, last_login: datetime.datetime
+    ) -> Optional[models.PublicUser]:
+        name = "user_set_last_login"
+        if self.outbox:
+            name = "user_set_last_login_outbox"
+        row = await self.statements.fetchrow(self.db, name, user_id, last_login)
+        return models.PublicUser(**dict(row)) if row else None
+
+    async def flush_last_login(
+        self,
+        user_ids: typing.List[int],
+        last_login: typing.List[datetime.datetime],
+    ):
+        """Stamps last_login of many users in one statement"""
+        await self.statements.fetchval(
+            self.db, "users_flush_last_login", user_ids, last_login
+        )
+
     async def update_groups(
         self, user: models.User, groups: typing.List[str]
     ) -> models.User:
-        await self.db.fetch(
-            "select FROM update_groups($1, $2)", groups, user.user_id
+        await self.statements.fetch(
+            self.db, "user_update_groups", groups, user.user_id
         )
+        await self.invalidate("user", user.user_id)
         return await self.by_id(user.user_id)
 
+    async def check_groups(self, *, repair: bool = False):
+        """Finds users whose denormalized groups don't match users_group,
+        and optionally rewrites them from users_group"""
+        name = "groups_repair" if repair else "groups_drift"
+        drift = await self.statements.fetch(self.db, name)
+        if repair:
+            for row in drift:
+                await self.invalidate("user", row["user_id"])
+        return [dict(row) for row in drift]
+
     def base_query(self) -> str:
-        return f"""
-            SELECT
-                u.*,
-                array_remove(array_agg(g.name), null) as groups
-            FROM {self.schema}users u
-            LEFT JOIN LATERAL (
-                SELECT gg.name from {self.schema}groups gg
-                    inner join {self.schema}users_group ug using(group_id)
-                    WHERE ug.user_id = u.user_id
-            ) g on true
-        """
+        return self.statements["base_query"]
 
 
-def to_str(item: bool):
-    if item is True:
-        return "true"
-    return "false"
+@asynccontextmanager
+async def _acquire(db):
+    if hasattr(db, "acquire"):  # a pool
+        async with db.acquire() as conn:
+            yield conn
+    else:
+        yield db
@@ -0,0 +1,24 @@
+from ...interfaces import IGroupsStorage
+from ...interfaces import ISessionStorage
+from ...interfaces import IUsersStorage
+from .base import *  # noqa
+from .db import *  # noqa
+from .groups import *  # noqa
+from .session import *  # noqa
+from .users import *  # noqa
+
+
+def sqlite_service_factory(iam, service, db=None):
+    # all services share the iam database, db is ignored
+    return service(iam.sqlite, invalidator=iam.publish, metrics=iam.metrics)
+
+
+# settings for storage="sqlite", see configure_iam
+SETTINGS = {
+    "services": {
+        IUsersStorage: UserStorage,  # noqa
+        ISessionStorage: SessionStorage,  # noqa
+        IGroupsStorage: GroupStorage,  # noqa
+    },
+    "default_service_factory": sqlite_service_factory,
+}
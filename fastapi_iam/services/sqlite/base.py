@@ -0,0 +1,22 @@
+from ..base import InstrumentedRepository
+from .db import SQLiteDatabase
+
+import typing
+
+
+class SQLiteRepository(InstrumentedRepository):
+    def __init__(
+        self,
+        db: SQLiteDatabase,
+        invalidator: typing.Callable = None,
+        metrics=None,
+    ):
+        self.db = db
+        # awaited with (db, kind, key) when cached data should be dropped
+        self.invalidator = invalidator
+        # optional metrics.MetricsSink
+        self.metrics = metrics
+
+    async def invalidate(self, kind: str, key):
+        if self.invalidator is not None:
+            await self.invalidator(None, kind, key)
@@ -0,0 +1,282 @@
+from ...initialize import get_available
+from ...initialize import get_migrations_path
+from ...initialize import load_migration
+from ...tasks import BackgroundTask
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import typing
+
+logger = logging.getLogger("fastapi_iam")
+
+# decoded from their sqlite text/integer representation
+JSON_COLUMNS = {"props", "groups", "data", "stored", "expected"}
+DATETIME_COLUMNS = {
+    "date_joined",
+    "last_login",
+    "expires",
+    "refresh_token_expires",
+    "last_used",
+}
+BOOL_COLUMNS = {"is_staff", "is_active", "is_admin"}
+
+
+def encode(value):
+    """a query parameter, as stored on sqlite"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ", "microseconds")
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, separators=(",", ":"))
+    return value
+
+
+def params(*args) -> tuple:
+    return tuple(encode(arg) for arg in args)
+
+
+def decode(row: sqlite3.Row) -> typing.Dict[str, typing.Any]:
+    values = dict(zip(row.keys(), row))
+    for key, value in values.items():
+        if value is None:
+            continue
+        if key in JSON_COLUMNS:
+            values[key] = json.loads(value)
+        elif key in DATETIME_COLUMNS:
+            values[key] = datetime.datetime.fromisoformat(value)
+        elif key in BOOL_COLUMNS:
+            values[key] = bool(value)
+    return values
+
+
+def utcnow() -> str:
+    return encode(datetime.datetime.utcnow())
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Applies the pending sqlite migrations, each one in its own
+    transaction, returns the current version"""
+    path = get_migrations_path() / "sqlite"
+    try:
+        current = conn.execute("SELECT value FROM users_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        current = 0
+    migrations = get_available(path)
+    for version in sorted(migrations):
+        if version <= current:
+            continue
+        script = load_migration(f"sqlite/{migrations[version]}")
+        try:
+            conn.executescript(
+                f"BEGIN;\n{script}\n"
+                f"UPDATE users_version SET value={version};\nCOMMIT;"
+            )
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        current = version
+        logger.info("applied sqlite migration %s", version)
+    return current
+
+
+class SQLiteDatabase(BackgroundTask):
+    """
+    The database of the sqlite storage (iam.sqlite), a file in WAL mode
+    so readers never block the writer, nor the other way around.
+
+    Reads run on a pool of `readers` threads, each one with its own
+    connection, so they don't block the event loop and scale across
+    threads (sqlite releases the GIL while running a query).
+    Writes are serialized on a single connection, owned by one thread:
+    `write` queues a function and this task runs the queued ones in
+    batches of up to `batch_size`, in one transaction (a single fsync).
+    Every write runs in a savepoint, a failing one is rolled back and
+    raises to its caller without affecting the rest of the batch.
+    The database is created and migrated on start.
+
+        row = await db.read(lambda conn: conn.execute(...).fetchone())
+        await db.write(lambda conn: conn.execute(...).rowcount)
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, *, readers: int = 4, batch_size: int = 100):
+        super().__init__()
+        self.path = path
+        self.readers = readers
+        self.batch_size = batch_size
+        self.version = 0
+        self._conn: typing.Optional[sqlite3.Connection] = None
+        self._writer: typing.Optional[ThreadPoolExecutor] = None
+        self._reader: typing.Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._reader_conns: typing.List[sqlite3.Connection] = []
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self._lock: typing.Optional[asyncio.Lock] = None
+        self.reads = 0
+        self.writes = 0
+        self.batches = 0
+        self.batch_size_max = 0
+        self.errors = 0
+
+    def connect(self) -> sqlite3.Connection:
+        # transactions are handled by hand, see run_batch
+        conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def open(self) -> int:
+        """runs on the writer thread"""
+        conn = self._conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        # durable on checkpoints, a crash can lose the last commits
+        # but never corrupts the database
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return migrate(conn)
+
+    def open_reader(self):
+        """reader threads initializer"""
+        conn = self.connect()
+        conn.execute("PRAGMA query_only=ON")
+        self._local.conn = conn
+        self._reader_conns.append(conn)
+
+    async def start(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._conn is None:
+                loop = asyncio.get_running_loop()
+                self._writer = ThreadPoolExecutor(
+                    1, thread_name_prefix="iam-sqlite-writer"
+                )
+                self.version = await loop.run_in_executor(
+                    self._writer, self.open
+                )
+                self._reader = ThreadPoolExecutor(
+                    self.readers,
+                    thread_name_prefix="iam-sqlite-reader",
+                    initializer=self.open_reader,
+                )
+            await super().start()
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # created on the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def read(self, func: typing.Callable, *args):
+        """runs func(conn, *args) on a reader connection"""
+        if self._reader is None:
+            await self.start()
+        self.reads += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, self._read, func, args)
+
+    def _read(self, func, args):
+        return func(self._local.conn, *args)
+
+    async def write(self, func: typing.Callable, *args):
+        """queues func(conn, *args) on the writer connection, returns
+        its result once committed"""
+        if not self.running:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((func, args, future))
+        return await future
+
+    async def run(self):
+        queue = self.queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            ops = [(func, args) for func, args, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._writer, self.run_batch, ops
+                )
+            except asyncio.CancelledError:
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:  # the commit failed
+                results = [(None, e)] * len(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+            self.batches += 1
+            self.writes += len(batch)
+            self.batch_size_max = max(self.batch_size_max, len(batch))
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue  # the caller was cancelled
+                if error is not None:
+                    self.errors += 1
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def run_batch(self, ops) -> typing.List[tuple]:
+        """runs on the writer thread, (result, error) of every op"""
+        conn = self._conn
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for func, args in ops:
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = func(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    results.append((None, e))
+                else:
+                    results.append((result, None))
+                conn.execute("RELEASE op")
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return results
+
+    async def stop(self):
+        if self.running:
+            # pending writes are committed before closing
+            await self.queue.join()
+        await super().stop()
+        if self._conn is not None:
+            # waits for running reads, off the event loop
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._reader.shutdown, True)
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+            await loop.run_in_executor(self._writer, self._conn.close)
+            await loop.run_in_executor(None, self._writer.shutdown, True)
+            self._conn = self._reader = self._writer = None
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "reads": self.reads,
+            "writes": self.writes,
+            "batches": self.batches,
+            "batch_size_max": self.batch_size_max,
+            "errors": self.errors,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "readers": self.readers,
+            "migration": self.version,
+            "running": self.running,
+        }
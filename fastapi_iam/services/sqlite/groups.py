@@ -0,0 +1,19 @@
+from .base import SQLiteRepository
+from .statements import QUERIES
+
+
+def _add_group(conn, name):
+    group_id = conn.execute(QUERIES["group_insert"], (name,)).lastrowid
+    return dict(conn.execute(QUERIES["group_by_id"], (group_id,)).fetchone())
+
+
+def _get_groups(conn):
+    return [r["name"] for r in conn.execute(QUERIES["groups_names"])]
+
+
+class GroupStorage(SQLiteRepository):
+    async def add_group(self, name):
+        return await self.db.write(_add_group, name)
+
+    async def get_groups(self):
+        return await self.db.read(_get_groups)
@@ -0,0 +1,121 @@
+from ... import models
+from ...cache import token_key
+from .base import SQLiteRepository
+from .db import params
+from .statements import QUERIES
+from .users import fetch
+from .users import store_last_login
+
+import datetime
+import json
+import typing
+
+
+def _values(us: models.UserSession) -> tuple:
+    data = json.dumps(us.data) if us.data is not None else None
+    return params(
+        us.token,
+        us.user_id,
+        us.expires,
+        us.refresh_token,
+        us.refresh_token_expires,
+        data,
+    )
+
+
+def _insert(conn, values: tuple):
+    conn.execute(QUERIES["session_insert"], values)
+
+
+def _login(conn, values: tuple, last_login: datetime.datetime):
+    _insert(conn, values)
+    return store_last_login(conn, values[1], last_login)
+
+
+def _flush_last_used(conn, tokens, last_used, now):
+    conn.executemany(
+        QUERIES["sessions_flush_last_used"],
+        [params(t, u, now) for t, u in zip(tokens, last_used)],
+    )
+
+
+def _execute(conn, name: str, *args) -> int:
+    return conn.execute(QUERIES[name], params(*args)).rowcount
+
+
+def _update_token(conn, name: str, *args) -> typing.List[str]:
+    """returns the replaced access tokens"""
+    rows = conn.execute(QUERIES["session_tokens"], params(*args[:2]))
+    replaced = [r["token"] for r in rows]
+    _execute(conn, name, *args)
+    return replaced
+
+
+class SessionStorage(SQLiteRepository):
+    async def create(self, us: models.UserSession):
+        await self.db.write(_insert, _values(us))
+        return us.copy()
+
+    async def login(
+        self, us: models.UserSession, last_login: datetime.datetime
+    ) -> models.PublicUser:
+        """Stores the session and stamps the user last_login
+        in a single write, returns the updated user"""
+        row = await self.db.write(_login, _values(us), last_login)
+        return models.PublicUser(**row)
+
+    async def store(self, us: models.UserSession, user: models.User):
+        """Stores the session of a login without stamping the user
+        last_login, see ActivityBuffer"""
+        await self.db.write(_insert, _values(us))
+
+    async def flush_last_used(
+        self,
+        tokens: typing.List[str],
+        last_used: typing.List[datetime.datetime],
+    ):
+        """Stamps last_used of many sessions in one write"""
+        now = datetime.datetime.utcnow()
+        await self.db.write(_flush_last_used, tokens, last_used, now)
+
+    async def is_expired(self, refresh_token: str) -> bool:
+        now = datetime.datetime.utcnow()
+        row = await self.db.read(
+            fetch, "session_is_expired", refresh_token, now
+        )
+        return row is None or row["refresh_token_expires"] < now
+
+    async def delete(self, token):
+        now = datetime.datetime.utcnow()
+        await self.db.write(_execute, "session_delete", token, now)
+        await self.invalidate("token", token_key(token))
+
+    async def update_token(
+        self,
+        refresh_token: str,
+        token: str,
+        expires: datetime.datetime,
+        *,
+        new_rt: str = None,  # set it to rotate the refresh token
+        new_rte: str = None,
+    ):
+        now = datetime.datetime.utcnow()
+        name = "session_update_token"
+        args = [refresh_token, now, token, expires]
+        if new_rt:
+            assert (
+                new_rt and new_rte
+            ), "new_token and new_token_expiration required"
+            name = "session_update_token_rotate"
+            args = args + [new_rt, new_rte]
+
+        replaced = await self.db.write(_update_token, name, *args)
+        for old in replaced:
+            await self.invalidate("token", token_key(old))
+
+    async def reap_expired(
+        self, before: datetime.datetime, limit: int = 500
+    ) -> int:
+        """Deletes up to limit sessions whose refresh token expired
+        before `before`, returns how many were deleted"""
+        return await self.db.write(_execute, "session_reap", before, limit)
@@ -0,0 +1,163 @@
+from ...export import EXPORT_COLUMNS
+
+# user columns that can be set by create and update_user
+USER_COLUMNS = (
+    "email",
+    "password",
+    "username",
+    "is_staff",
+    "is_active",
+    "is_admin",
+    "date_joined",
+    "last_login",
+    "auth_type",
+    "auth_provider",
+    "props",
+)
+
+SESSION_COLUMNS = (
+    "token",
+    "user_id",
+    "expires",
+    "refresh_token",
+    "refresh_token_expires",
+    "data",
+)
+
+base_query = "SELECT u.* FROM users u"
+search_conds = """
+        WHERE (?1 IS NULL OR u.email LIKE ?1)
+          AND (?2 IS NULL OR u.is_staff = ?2)
+          AND (?3 IS NULL OR u.is_active = ?3)
+          AND (?4 IS NULL OR u.is_admin = ?4)
+"""
+# sorted names of the groups in ?1 that exist, as a json array
+expected_groups = """
+        SELECT json_group_array(name) FROM (
+            SELECT name FROM groups
+            WHERE name IN (SELECT value FROM json_each(?1))
+            ORDER BY name
+        )
+"""
+groups_drift = """
+        SELECT * FROM (
+            SELECT u.user_id, u.groups as stored, (
+                SELECT json_group_array(name) FROM (
+                    SELECT g.name FROM groups g
+                        INNER JOIN users_group ug using(group_id)
+                    WHERE ug.user_id = u.user_id
+                    ORDER BY g.name
+                )
+            ) as expected
+            FROM users u
+        ) WHERE stored <> expected
+"""
+session_insert = f"""
+        INSERT INTO users_session ({", ".join(SESSION_COLUMNS)})
+        VALUES (?, ?, ?, ?, ?, ?)
+"""
+export_columns = ", ".join(f"u.{c}" for c in EXPORT_COLUMNS)
+
+# same queries as the postgresql storage, "now" is always a parameter,
+# so timestamps are compared in the format they are stored with.
+# No RETURNING, it needs sqlite 3.35: rows are read after writing them
+QUERIES = {
+    "user_by_email": f"{base_query} WHERE email=?",
+    "user_by_id": f"{base_query} WHERE user_id=?",
+    "user_by_token": f"""
+        {base_query}
+        INNER JOIN users_session t using(user_id)
+        WHERE token=?1 and expires>?2 and refresh_token_expires>?2
+    """,
+    "user_by_refresh_token": f"""
+        {base_query}
+        INNER JOIN users_session t using(user_id)
+        WHERE refresh_token=?1 and refresh_token_expires>?2
+    """,
+    # keyset pagination, ?5 is the last seen key (NULL for first page)
+    "user_search_by_user_id": f"""
+        {base_query}
+        {search_conds}
+          AND (?5 IS NULL OR u.user_id > ?5)
+        ORDER BY u.user_id
+        LIMIT ?6 OFFSET ?7
+    """,
+    "user_search_by_email": f"""
+        {base_query}
+        {search_conds}
+          AND (?5 IS NULL OR u.email > ?5)
+        ORDER BY u.email
+        LIMIT ?6 OFFSET ?7
+    """,
+    "user_search_count": f"SELECT count(*) FROM users u {search_conds}",
+    "user_search_count_capped": f"""
+        SELECT count(*) FROM (
+            SELECT 1 FROM users u
+            {search_conds}
+            LIMIT ?5
+        )
+    """,
+    # a page of the export, ?5 is the last exported user_id
+    "user_export": f"""
+        SELECT {export_columns} FROM users u
+        {search_conds}
+          AND u.user_id > ?5
+        ORDER BY u.user_id
+        LIMIT ?6
+    """,
+    "user_set_last_login": "UPDATE users SET last_login=?2 WHERE user_id=?1",
+    # the guard skips stale stamps
+    "user_flush_last_login": """
+        UPDATE users SET last_login=?2
+        WHERE user_id=?1 AND (last_login IS NULL OR last_login < ?2)
+    """,
+    "user_group_delete": "DELETE FROM users_group WHERE user_id=?",
+    "user_group_insert": """
+        INSERT INTO users_group (user_id, group_id)
+        SELECT ?2, group_id FROM groups
+        WHERE name IN (SELECT value FROM json_each(?1))
+    """,
+    "user_update_groups": f"""
+        UPDATE users SET groups = ({expected_groups}) WHERE user_id=?2
+    """,
+    "session_insert": session_insert,
+    "sessions_flush_last_used": """
+        UPDATE users_session SET last_used=?2
+        WHERE token=?1 and refresh_token_expires>?3
+    """,
+    "session_is_expired": """
+        SELECT refresh_token_expires FROM users_session
+        WHERE refresh_token=?1 and refresh_token_expires>?2
+    """,
+    "session_delete": """
+        DELETE FROM users_session
+        WHERE token=?1 and refresh_token_expires>?2
+    """,
+    "session_tokens": """
+        SELECT token FROM users_session
+        WHERE refresh_token=?1 and refresh_token_expires>?2
+    """,
+    "session_update_token": """
+        UPDATE users_session SET token=?3, expires=?4
+        WHERE refresh_token=?1 and refresh_token_expires>?2
+    """,
+    "session_update_token_rotate": """
+        UPDATE users_session SET token=?3, expires=?4,
+            refresh_token=?5, refresh_token_expires=?6
+        WHERE refresh_token=?1 and refresh_token_expires>?2
+    """,
+    "session_reap": """
+        DELETE FROM users_session WHERE rowid IN (
+            SELECT rowid FROM users_session
+            WHERE refresh_token_expires < ?1
+            LIMIT ?2
+        )
+    """,
+    "group_insert": "INSERT INTO groups (name) VALUES (?)",
+    "group_by_id": "SELECT group_id, name FROM groups WHERE group_id=?",
+    "groups_insert_missing": "INSERT OR IGNORE INTO groups (name) VALUES (?)",
+    "groups_names": "SELECT name from groups",
+    # users with groups not matching users_group
+    "groups_drift": groups_drift,
+    "group_repair": "UPDATE users SET groups=?2 WHERE user_id=?1",
+}
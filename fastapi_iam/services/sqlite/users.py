@@ -0,0 +1,296 @@
+from ... import models
+from ...importer import IMPORT_COLUMNS
+from ..base import decode_cursor
+from ..base import encode_cursor
+from ..base import SEARCH_ORDER
+from .base import SQLiteRepository
+from .db import decode
+from .db import encode
+from .db import params
+from .statements import QUERIES
+from .statements import USER_COLUMNS
+from fastapi.encoders import jsonable_encoder
+from typing import Optional
+
+import datetime
+import typing
+
+
+def fetch(conn, name: str, *args):
+    row = conn.execute(QUERIES[name], params(*args)).fetchone()
+    return decode(row) if row is not None else None
+
+
+def fetch_all(conn, name: str, *args):
+    return [decode(r) for r in conn.execute(QUERIES[name], params(*args))]
+
+
+def fetch_value(conn, name: str, *args):
+    return conn.execute(QUERIES[name], params(*args)).fetchone()[0]
+
+
+def _columns(values) -> typing.List[str]:
+    columns = [c for c in values if c in USER_COLUMNS]
+    if len(columns) != len(values):
+        unknown = set(values) - set(columns)
+        raise ValueError(f"unknown user columns {sorted(unknown)}")
+    return columns
+
+
+def _insert(conn, values) -> int:
+    columns = _columns(values)
+    query = "INSERT INTO users ({}) VALUES ({})".format(
+        ", ".join(columns), ", ".join("?" * len(columns))
+    )
+    return conn.execute(query, params(*values.values())).lastrowid
+
+
+def _update(conn, user_id: int, values):
+    columns = _columns(values)
+    assignments = ", ".join(f"{c}=?" for c in columns)
+    query = f"UPDATE users SET {assignments} WHERE user_id=?"
+    conn.execute(query, params(*values.values(), user_id))
+
+
+def _create(conn, values):
+    return fetch(conn, "user_by_id", _insert(conn, values))
+
+
+def store_last_login(conn, user_id: int, last_login):
+    query = QUERIES["user_set_last_login"]
+    if conn.execute(query, params(user_id, last_login)).rowcount == 0:
+        return None
+    return fetch(conn, "user_by_id", user_id)
+
+
+def _set_groups(conn, user_id: int, groups: typing.List[str]):
+    """update_groups() of the postgresql schema"""
+    groups = encode(list(groups))
+    conn.execute(QUERIES["user_group_delete"], (user_id,))
+    conn.execute(QUERIES["user_group_insert"], (groups, user_id))
+    conn.execute(QUERIES["user_update_groups"], (groups, user_id))
+
+
+def _search(conn, order_by, conds, after, limit, offset, total, total_cap):
+    name = f"user_search_by_{order_by}"
+    rows = fetch_all(conn, name, *conds, after, limit, offset)
+    if total == "none":
+        count = None
+    elif total == "estimate":
+        count = fetch_value(conn, "user_search_count_capped", *conds, total_cap)
+    else:
+        count = fetch_value(conn, "user_search_count", *conds)
+    return rows, count
+
+
+def _bulk_import(conn, records, update_existing: bool):
+    # last row wins on duplicated emails
+    latest: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for record in records:
+        row = dict(zip(IMPORT_COLUMNS, record))
+        row["email"] = row["email"].lower()
+        previous = latest.get(row["email"])
+        if previous is None or row["n"] >= previous["n"]:
+            latest[row["email"]] = row
+    names = {g for row in latest.values() for g in row["groups"] or ()}
+    conn.executemany(
+        QUERIES["groups_insert_missing"], [(name,) for name in sorted(names)]
+    )
+    created = updated = 0
+    for email, row in latest.items():
+        del row["n"]
+        groups = row.pop("groups") or []
+        row["username"] = row["username"] or "noname"
+        existing = fetch(conn, "user_by_email", email)
+        if existing is None:
+            user_id = _insert(conn, row)
+            created += 1
+        elif update_existing:
+            user_id = existing["user_id"]
+            del row["email"]
+            _update(conn, user_id, row)
+            updated += 1
+        else:
+            continue
+        _set_groups(conn, user_id, groups)
+    return {"created": created, "updated": updated}
+
+
+def _flush_last_login(conn, user_ids, last_login):
+    conn.executemany(
+        QUERIES["user_flush_last_login"],
+        [params(u, t) for u, t in zip(user_ids, last_login)],
+    )
+
+
+def _repair_groups(conn):
+    drift = fetch_all(conn, "groups_drift")
+    for row in drift:
+        conn.execute(
+            QUERIES["group_repair"],
+            (row["user_id"], encode(row["expected"])),
+        )
+    return drift
+
+
+class UserStorage(SQLiteRepository):
+    async def create(self, user: models.UserCreate) -> models.PublicUser:
+        data = user.dict(exclude_none=True)
+        return models.PublicUser(**await self.db.write(_create, data))
+
+    async def by_email(self, email: str) -> Optional[models.User]:
+        return self.to_model(await self.db.read(fetch, "user_by_email", email))
+
+    async def by_id(self, user_id: int) -> Optional[models.User]:
+        return self.to_model(await self.db.read(fetch, "user_by_id", user_id))
+
+    def to_model(self, row) -> Optional[models.User]:
+        if not row:
+            return None
+        return models.User(**row)
+
+    async def by_token(
+        self, *, token: str = None, refresh_token: str = None
+    ) -> Optional[models.User]:
+        assert token or refresh_token, "at least one required"
+        now = datetime.datetime.utcnow()
+        if token:
+            row = await self.db.read(fetch, "user_by_token", token, now)
+        else:
+            row = await self.db.read(
+                fetch, "user_by_refresh_token", refresh_token, now
+            )
+        return self.to_model(row)
+
+    async def search(
+        self,
+        *,
+        q=None,
+        page=0,
+        limit=100,
+        is_staff=None,
+        is_active=None,
+        is_admin=None,
+        cursor: str = None,
+        order_by: str = "user_id",
+        total: str = "exact",
+        total_cap: int = 10000,
+    ):
+        """Same arguments and results as the postgresql UserStorage,
+        an estimated total is always a count capped to total_cap"""
+        if order_by not in SEARCH_ORDER:
+            raise ValueError(f"invalid order_by {order_by}")
+        if total not in ("exact", "estimate", "none"):
+            raise ValueError(f"invalid total {total}")
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, order_by)
+            page = 0
+
+        # an empty q is no filter
+        conds = [q or None, is_staff, is_active, is_admin]
+        results, count = await self.db.read(
+            _search,
+            order_by,
+            conds,
+            after,
+            limit,
+            page * limit,
+            total,
+            total_cap,
+        )
+        next_cursor = None
+        if len(results) == limit and limit > 0:
+            next_cursor = encode_cursor(order_by, results[-1][order_by])
+        return {
+            "total": count,
+            "page": page,
+            "limit": limit,
+            "next_cursor": next_cursor,
+            "items": [models.PublicUser(**res) for res in results],
+        }
+
+    async def export(
+        self,
+        *,
+        q=None,
+        is_staff=None,
+        is_active=None,
+        is_admin=None,
+        prefetch: int = 1000,
+    ) -> typing.AsyncIterator[typing.Mapping]:
+        """Yields all matching users (without password), read in pages
+        of prefetch users, so no connection is held while iterating"""
+        args = [q or None, is_staff, is_active, is_admin]
+        last = 0
+        while True:
+            rows = await self.db.read(
+                fetch_all, "user_export", *args, last, prefetch
+            )
+            for row in rows:
+                yield row
+            if len(rows) < prefetch:
+                break
+            last = rows[-1]["user_id"]
+
+    async def bulk_import(
+        self, records: typing.List[tuple], *, update_existing: bool = True
+    ) -> typing.Dict[str, int]:
+        """
+        Stores a batch of users in one write, records are tuples in
+        IMPORT_COLUMNS order, with already hashed passwords. Like the
+        postgresql storage, the last row wins on duplicated emails,
+        missing groups are created and imported groups replace the
+        user ones.
+        """
+        result = await self.db.write(_bulk_import, records, update_existing)
+        if result["updated"]:
+            # passwords and groups could have changed
+            await self.invalidate("all", None)
+        return result
+
+    async def update_user(self, user_id: int, data):
+        if "props" in data:
+            data["props"] = jsonable_encoder(data["props"])
+
+        user = await self.by_id(user_id)
+        groups = data.pop("groups", None)
+        if len(data) > 0:
+            await self.db.write(_update, user_id, data)
+            if user is not None and "password" in data:
+                await self.invalidate("password", user.password)
+            await self.invalidate("user", user_id)
+        if groups:
+            await self.update_groups(user, groups)
+        return models.PublicUser(**dict(await self.by_id(user_id)))
+
+    async def set_last_login(
+        self, user_id: int, last_login: datetime.datetime
+    ) -> Optional[models.PublicUser]:
+        row = await self.db.write(store_last_login, user_id, last_login)
+        return models.PublicUser(**row) if row else None
+
+    async def flush_last_login(
+        self,
+        user_ids: typing.List[int],
+        last_login: typing.List[datetime.datetime],
+    ):
+        """Stamps last_login of many users in one write"""
+        await self.db.write(_flush_last_login, user_ids, last_login)
+
+    async def update_groups(
+        self, user: models.User, groups: typing.List[str]
+    ) -> models.User:
+        await self.db.write(_set_groups, user.user_id, groups)
+        await self.invalidate("user", user.user_id)
+        return await self.by_id(user.user_id)
+
+    async def check_groups(self, *, repair: bool = False):
+        """Finds users whose denormalized groups don't match users_group,
+        and optionally rewrites them from users_group"""
+        if not repair:
+            return await self.db.read(fetch_all, "groups_drift")
+        drift = await self.db.write(_repair_groups)
+        for row in drift:
+            await self.invalidate("user", row["user_id"])
+        return drift
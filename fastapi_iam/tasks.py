@@ -0,0 +1,264 @@
+from .interfaces import ISessionStorage
+from .interfaces import IUsersStorage
+
+import asyncio
+import datetime
+import logging
+import random
+import time
+import typing
+
+logger = logging.getLogger("fastapi_iam")
+
+
+class BackgroundTask:
+    """
+    A long running coroutine bound to the application lifespan.
+    Tasks are registered with IAM.add_task, started on app startup
+    and stopped (cancelled) on shutdown.
+    """
+
+    name = "task"
+
+    def __init__(self):
+        self._task: typing.Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        try:
+            await self.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("background task %s crashed", self.name)
+
+    async def run(self):
+        raise NotImplementedError()
+
+
+class SessionReaper(BackgroundTask):
+    """
+    Deletes expired sessions (past refresh_token_expires) every
+    `interval` seconds, in batches of `batch_size` rows with a pause of
+    `batch_delay` between them, so it never holds long locks or
+    saturates the db. At most `max_batches` are run on every pass.
+    Every batch locks its rows with FOR UPDATE SKIP LOCKED, so it's
+    safe to run from several workers at once.
+    """
+
+    name = "session-reaper"
+
+    def __init__(
+        self,
+        iam,
+        *,
+        interval: float = 60,
+        batch_size: int = 500,
+        batch_delay: float = 0.1,
+        max_batches: int = 100,
+    ):
+        super().__init__()
+        self.iam = iam
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_batches = max_batches
+        self.runs = 0
+        self.errors = 0
+        self.reaped = 0
+        self.reaped_last_run = 0
+        self.last_run_time = 0.0
+
+    async def run(self):
+        while True:
+            # spread workers started at the same time
+            await asyncio.sleep(self.interval * random.uniform(0.5, 1.5))
+            try:
+                await self.reap()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("reaping sessions failed")
+
+    async def reap(self) -> int:
+        """Runs a pass, returns the number of deleted sessions"""
+        started = time.monotonic()
+        service = self.iam.get_service(ISessionStorage)
+        now = datetime.datetime.utcnow()
+        reaped = 0
+        for batch in range(self.max_batches):
+            if batch > 0:
+                await asyncio.sleep(self.batch_delay)
+            deleted = await service.reap_expired(now, self.batch_size)
+            reaped += deleted
+            if deleted < self.batch_size:
+                break
+        self.runs += 1
+        self.reaped += reaped
+        self.reaped_last_run = reaped
+        self.last_run_time = time.monotonic() - started
+        return reaped
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "reaped": self.reaped,
+            "reaped_last_run": self.reaped_last_run,
+            "last_run_time": self.last_run_time,
+            "running": self.running,
+        }
+
+
+class ActivityBuffer(BackgroundTask):
+    """
+    Write behind buffer of user last_login and session last_used
+    stamps. Logins and validations only record the stamp in memory,
+    repeated ones for the same user (or session) are coalesced, the
+    newest wins. Every `interval` seconds, or as soon as `max_entries`
+    are pending, they are written with one UPDATE ... FROM unnest()
+    statement per table. Pending stamps are flushed on shutdown.
+    Stamps are best effort, a crash loses up to `interval` seconds of
+    them, and a failed flush keeps them for the next one.
+    """
+
+    name = "activity-buffer"
+
+    def __init__(self, iam, *, interval: float = 0.5, max_entries: int = 1000):
+        super().__init__()
+        self.iam = iam
+        self.interval = interval
+        self.max_entries = max_entries
+        self.logins: typing.Dict[int, datetime.datetime] = {}
+        self.sessions: typing.Dict[str, datetime.datetime] = {}
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.errors = 0
+        self.pending_max = 0
+        self.last_flush_time = 0.0
+
+    @property
+    def pending(self) -> int:
+        return len(self.logins) + len(self.sessions)
+
+    def touch_login(self, user_id: int, when: datetime.datetime):
+        self.logins[user_id] = when
+        self.recorded += 1
+        self._check()
+
+    def touch_session(self, token: str, when: datetime.datetime):
+        self.sessions[token] = when
+        self.recorded += 1
+        self._check()
+
+    def _check(self):
+        pending = self.pending
+        if pending > self.pending_max:
+            self.pending_max = pending
+        if pending >= self.max_entries and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        # created on the running loop
+        self._wakeup = asyncio.Event()
+        await super().start()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("flushing activity stamps failed")
+
+    async def flush(self) -> int:
+        """Writes the pending stamps, returns how many"""
+        logins, self.logins = self.logins, {}
+        sessions, self.sessions = self.sessions, {}
+        if not logins and not sessions:
+            return 0
+        started = time.monotonic()
+        flushed = 0
+        try:
+            if logins:
+                # sorted, so concurrent flushes lock rows in the same order
+                user_ids = sorted(logins)
+                service = self.iam.get_service(IUsersStorage)
+                await service.flush_last_login(
+                    user_ids, [logins[u] for u in user_ids]
+                )
+                flushed, logins = len(logins), {}
+            if sessions:
+                tokens = sorted(sessions)
+                service = self.iam.get_service(ISessionStorage)
+                await service.flush_last_used(
+                    tokens, [sessions[t] for t in tokens]
+                )
+                flushed += len(sessions)
+        except BaseException:
+            # kept for the next flush, unless newer ones were recorded
+            self.merge(self.logins, logins)
+            self.merge(self.sessions, sessions)
+            self.flushed += flushed
+            raise
+        self.flushes += 1
+        self.flushed += flushed
+        self.last_flush_time = time.monotonic() - started
+        return flushed
+
+    @staticmethod
+    def merge(pending: dict, failed: dict):
+        for key, when in failed.items():
+            if key not in pending or pending[key] < when:
+                pending[key] = when
+
+    async def stop(self):
+        if self.running:
+            await super().stop()
+            try:
+                await self.flush()
+            except Exception:
+                self.errors += 1
+                logger.exception(
+                    "%d activity stamps lost on shutdown", self.pending
+                )
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "pending": self.pending,
+            "pending_max": self.pending_max,
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "errors": self.errors,
+            "last_flush_time": self.last_flush_time,
+            "running": self.running,
+        }
@@ -1,4 +1,7 @@
 """ Testing helpers """
+from .utils import auth_header
+from .utils import TRANSACTION_STATEMENTS
+from contextlib import contextmanager
 from functools import partial
 
 
@@ -11,10 +14,6 @@ async def login(client, username, password) -> "Client":
     return Client(client, res.json()["access_token"])
 
 
-def auth_header(token):
-    return {"Authorization": f"Bearer {token}"}
-
-
 class Client:
     def __init__(self, client, access_token):
         self.client = client
@@ -23,3 +22,30 @@ class Client:
     def __getattr__(self, name):
         func = getattr(self.client, name)
         return partial(func, headers=auth_header(self.token))
+
+
+class QueryCounter:
+    """asyncpg query logger that records executed queries,
+    transaction control statements are not counted"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, record):
+        query = record.query.strip()
+        if not query.upper().startswith(TRANSACTION_STATEMENTS):
+            self.queries.append(query)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+
+@contextmanager
+def count_queries(conn):
+    counter = QueryCounter()
+    conn.add_query_logger(counter)
+    try:
+        yield counter
+    finally:
+        conn.remove_query_logger(counter)
@@ -1,10 +1,12 @@
 from collections.abc import MutableMapping
-from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import Any
 
 import asyncio
 
+# transaction control statements, not counted as queries
+TRANSACTION_STATEMENTS = ("SAVEPOINT", "RELEASE", "ROLLBACK", "BEGIN", "COMMIT")
+
 
 def merge_dicts(d1: dict, d2: dict) -> dict:
     """
@@ -25,11 +27,14 @@ def merge_dicts(d1: dict, d2: dict) -> dict:
     return d3
 
 
+def auth_header(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
 async def run_in_threadpool(func, *args, **kwargs):
     curr = partial(func, *args, **kwargs)
     loop = asyncio.get_running_loop()
-    with ThreadPoolExecutor() as pool:
-        return await loop.run_in_executor(pool, curr)
+    return await loop.run_in_executor(None, curr)
 
 
 def resolve_dotted_name(name: str) -> Any:
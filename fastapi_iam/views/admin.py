@@ -1,12 +1,20 @@
 from .. import models
+from ..export import FORMATS
+from ..importer import PARSERS
+from ..importer import UserImporter
 from ..interfaces import IGroupsStorage
 from ..interfaces import IUsersStorage
 from ..provider import has_principal
 from ..provider import IAMProvider
 from fastapi import Depends
+from fastapi import File
+from fastapi import UploadFile
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 from typing import Optional
 
+import io
+
 
 async def query(
     q: Optional[str] = None,
@@ -15,6 +23,9 @@ async def query(
     is_staff: Optional[bool] = None,
     is_active: Optional[bool] = None,
     is_admin: Optional[bool] = None,
+    cursor: Optional[str] = None,
+    order_by: str = "user_id",
+    total: str = "exact",
 ):
     return {
         "q": q,
@@ -23,6 +34,9 @@ async def query(
         "is_staff": is_staff,
         "is_active": is_active,
         "is_admin": is_admin,
+        "cursor": cursor,
+        "order_by": order_by,
+        "total": total,
     }
 
 
@@ -32,7 +46,62 @@ async def get_users(
     principals=Depends(has_principal("admin")),
 ):
     users_service = iam.get_service(IUsersStorage)
-    return await users_service.search(**query)
+    try:
+        return await users_service.search(**query)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+
+async def export_users(
+    q: Optional[str] = None,
+    is_staff: Optional[bool] = None,
+    is_active: Optional[bool] = None,
+    is_admin: Optional[bool] = None,
+    format: str = "ndjson",
+    prefetch: int = 1000,
+    iam=Depends(IAMProvider),
+    principals=Depends(has_principal("admin")),
+):
+    if format not in FORMATS or prefetch < 1:
+        raise HTTPException(400, detail="invalid_export")
+    media_type, encoder = FORMATS[format]
+    # the export holds its own connection while streaming
+    ur = iam.get_service(IUsersStorage, db=iam.pool)
+    rows = ur.export(
+        q=q,
+        is_staff=is_staff,
+        is_active=is_active,
+        is_admin=is_admin,
+        prefetch=prefetch,
+    )
+    return StreamingResponse(
+        encoder(rows),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=users.{format}"},
+    )
+
+
+async def import_users(
+    file: UploadFile = File(...),
+    format: Optional[str] = None,
+    update_existing: bool = True,
+    batch_size: int = 1000,
+    iam=Depends(IAMProvider),
+    principals=Depends(has_principal("admin")),
+):
+    if format is None:
+        format = "csv" if file.filename.endswith(".csv") else "ndjson"
+    if format not in PARSERS or batch_size < 1:
+        raise HTTPException(400, detail="invalid_import")
+    lines = io.TextIOWrapper(file.file, encoding="utf-8")
+    importer = UserImporter(
+        iam.hasher, batch_size=batch_size, update_existing=update_existing
+    )
+    ur = iam.get_service(IUsersStorage, db=iam.pool)
+    try:
+        return await importer.run(ur, PARSERS[format](lines))
+    except ValueError as e:  # malformed json or csv
+        raise HTTPException(400, detail=str(e))
 
 
 async def get_user(
@@ -92,14 +161,23 @@ async def get_groups(
     return await gr.get_groups()
 
 
+async def get_stats(
+    iam=Depends(IAMProvider), principals=Depends(has_principal("admin"))
+):
+    return iam.stats()
+
+
 def setup_routes(router):
     router.add_api_route("/users", get_users)
     router.add_api_route(
         "/users", create_user, methods=["POST"], status_code=201
     )
+    router.add_api_route("/users/export", export_users)
+    router.add_api_route("/users/import", import_users, methods=["POST"])
     router.add_api_route("/users/{user_id:int}", get_user)
     router.add_api_route("/users/{user_id:int}", update_user, methods=["PATCH"])
     router.add_api_route(
         "/groups", create_group, methods=["POST"], status_code=201
     )
     router.add_api_route("/groups", get_groups, methods=["GET"])
+    router.add_api_route("/stats", get_stats, methods=["GET"])
@@ -2,26 +2,33 @@ from __future__ import annotations
 
 from .. import events
 from .. import models
+from ..metrics import PrometheusMetrics
+from ..metrics import render_stats
 from ..provider import get_current_user
 from ..provider import IAMProvider
 from fastapi import Cookie
 from fastapi import Depends
+from fastapi import Header
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
 from fastapi.requests import Request
 from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from random import randint
 from typing import Optional
 
 import asyncio
+import hmac
 
 NO_CACHE = {"cache-control": "no-store", "pargma": "no-cache"}
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
 
 async def status(request: Request, iam=Depends(IAMProvider)):
-    async with iam.db.pool.acquire() as db:
-        await db.fetch("select 1=1")
+    if iam.db is not None:
+        async with iam.db.pool.acquire() as db:
+            await db.fetch("select 1=1")
     return {"status": "ok"}
 
 
@@ -38,9 +45,13 @@ async def login(
     iam=Depends(IAMProvider),
 ):
     auth_manager = iam.get_security_policy()
-    user, user_session = await auth_manager.login(
-        form_data.username, form_data.password, request=request
-    )
+    timings = auth_manager.start_timing()
+    try:
+        user, user_session = await auth_manager.login(
+            form_data.username, form_data.password, request=request
+        )
+    finally:
+        await auth_manager.finish_timing(request, timings)
     await events.notify(events.UserLogin(user, user_session.token))
     data = {
         "access_token": user_session.token,
@@ -51,6 +62,7 @@ async def login(
         headers=NO_CACHE,
     )
     await auth_manager.remember(user_session, response, request=request)
+    auth_manager.server_timing(response, timings)
     return response
 
 
@@ -58,6 +70,15 @@ async def whoami(user=Depends(get_current_user)):
     return models.PublicUser(**user.dict())
 
 
+async def jwks(iam=Depends(IAMProvider)):
+    """Public keys to validate access tokens, cacheable by clients"""
+    max_age = iam.settings["jwks_max_age"]
+    return JSONResponse(
+        content=iam.keys.jwks(),
+        headers={"cache-control": f"public, max-age={max_age}"},
+    )
+
+
 async def logout(user=Depends(get_current_user), iam=Depends(IAMProvider)):
     token = getattr(user, "token", None)
     if not token:
@@ -74,7 +95,11 @@ async def renew(
     refresh: Optional[str] = Cookie(None),
 ):
     sm = iam.get_security_policy()
-    user_session = await sm.refresh(refresh)
+    timings = sm.start_timing()
+    try:
+        user_session = await sm.refresh(refresh)
+    finally:
+        await sm.finish_timing(request, timings)
     response = JSONResponse(
         jsonable_encoder(
             {
@@ -86,6 +111,7 @@ async def renew(
     )
     if iam.settings["rotate_refresh_tokens"] is True:
         await sm.remember(user_session, response, request=request)
+    sm.server_timing(response, timings)
     return response
 
 
@@ -95,3 +121,20 @@ async def reset_password():
 
 async def password_change():
     pass
+
+
+async def metrics(
+    iam=Depends(IAMProvider), authorization: Optional[str] = Header(None)
+):
+    """Prometheus text format, the recorded metrics and iam.stats().
+    Public unless settings["metrics_token"] is set, then it needs an
+    `Authorization: Bearer <metrics_token>` header"""
+    token = iam.settings["metrics_token"]
+    if token and not hmac.compare_digest(
+        authorization or "", f"Bearer {token}"
+    ):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    body = render_stats(iam.stats())
+    if isinstance(iam.metrics, PrometheusMetrics):
+        body = iam.metrics.render() + body
+    return PlainTextResponse(body, media_type=PROMETHEUS_CONTENT_TYPE)
@@ -25,7 +25,23 @@ setup(
         "python-multipart",
         "itsdangerous==1.1.0",
     ],
-    package_data={"fastapi_iam": ["py.typed"]},
+    package_data={
+        "fastapi_iam": [
+            "py.typed",
+            "schema/*.sql",
+            "schema/optional/*.sql",
+            "schema/sqlite/*.sql",
+        ]
+    },
+    entry_points={
+        "console_scripts": [
+            "fastapi-iam-create-user=fastapi_iam.commands.create_user:main",
+            "fastapi-iam-check-groups=fastapi_iam.commands.check_groups:main",
+            "fastapi-iam-export-users=fastapi_iam.commands.export_users:main",
+            "fastapi-iam-import-users=fastapi_iam.commands.import_users:main",
+            "fastapi-iam-loadtest=fastapi_iam.commands.loadtest:main",
+        ]
+    },
     extras_require={
         "dev": [
             "black",
@@ -34,6 +50,9 @@ setup(
             "tox",
         ],
         "docs": ["sphinx", "recommonmark"],
+        "bcrypt": ["bcrypt"],
+        "crypto": ["PyJWT[crypto]>=2.0.0"],
+        "loadtest": ["async_asgi_testclient", "httpx"],
         "test": [
             "pytest",
             "async_asgi_testclient",
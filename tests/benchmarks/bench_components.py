@@ -0,0 +1,202 @@
+"""
+Microbenchmarks of the auth hot paths, compared against a baseline
+
+    python -m tests.benchmarks.bench_components
+    python -m tests.benchmarks.bench_components --save
+    python -m tests.benchmarks.bench_components --only jwt --tolerance 0.5
+
+Users are realistic ones, many groups and a large props document.
+Results are compared with tests/benchmarks/baseline.json, the command
+exits with 1 when a case is slower than baseline * (1 + tolerance).
+Baselines are machine dependent, --save them again (on the same
+machine) before comparing an upgrade.
+"""
+
+from argparse import ArgumentParser
+from fastapi_iam import models
+from fastapi_iam.auth import ArgonPasswordHasher
+from fastapi_iam.auth import BearerAuthPolicy
+from fastapi_iam.auth import CredentialCache
+from fastapi_iam.auth import JWTToken
+from fastapi_iam.services.pg import UserStorage
+from starlette.requests import Request
+
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+parser = ArgumentParser()
+parser.add_argument("--baseline", default=BASELINE)
+parser.add_argument("--save", action="store_true", help="store as baseline")
+parser.add_argument("--only", help="run the cases containing this text")
+parser.add_argument("--rounds", type=int, default=5000)
+parser.add_argument("--groups", type=int, default=50)
+parser.add_argument("--props", type=int, default=200)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.25,
+    help="allowed slowdown of the median, 0.25 is 25%%",
+)
+
+settings = {
+    "jwt_expiration": 60 * 60,
+    "jwt_algorithm": "HS256",
+    "jwt_secret_key": "bench",
+    "session_expiration": 60 * 60,
+}
+
+
+def user_row(groups: int, props: int):
+    return {
+        "user_id": 1,
+        "email": "bench@test.com",
+        "username": "bench",
+        "password": "x" * 97,  # an argon2 hash
+        "is_active": True,
+        "is_staff": True,
+        "is_admin": False,
+        "date_joined": datetime.datetime.utcnow(),
+        "last_login": datetime.datetime.utcnow(),
+        "groups": [f"group-{i}" for i in range(groups)],
+        "props": {
+            f"prop-{i}": {"value": i, "tags": ["a", "b"]} for i in range(props)
+        },
+    }
+
+
+async def build_cases(args):
+    """name -> (rounds, async callable)"""
+    row = user_row(args.groups, args.props)
+    user = models.User(**row)
+    encoder = JWTToken(settings)
+    token, _ = await encoder.create_access_token(user)
+    request = Request(
+        {
+            "type": "http",
+            "headers": [(b"authorization", f"Bearer {token}".encode())],
+        }
+    )
+    extractor = BearerAuthPolicy()
+    repo = UserStorage(None)
+    hasher = ArgonPasswordHasher()
+    cached = ArgonPasswordHasher(cache=CredentialCache())
+    hashed = await hasher.hash_password("bench")
+    await cached.check_password(hashed, "bench")
+    # argon2 is slow on purpose, a few rounds are enough
+    slow = max(args.rounds // 250, 5)
+
+    async def to_model():
+        repo.to_model(row)
+
+    async def get_principals():
+        user.get_principals()
+
+    return {
+        "jwt_create_access_token": (
+            args.rounds,
+            lambda: encoder.create_access_token(user),
+        ),
+        "jwt_validate": (args.rounds, lambda: encoder.validate(token)),
+        "bearer_extract_token": (
+            args.rounds,
+            lambda: extractor.extract_token(request),
+        ),
+        "user_get_principals": (args.rounds, get_principals),
+        "storage_to_model": (args.rounds, to_model),
+        "hasher_hash_password": (slow, lambda: hasher.hash_password("b")),
+        "hasher_check_password": (
+            slow,
+            lambda: hasher.check_password(hashed, "bench"),
+        ),
+        "hasher_check_password_cached": (
+            args.rounds,
+            lambda: cached.check_password(hashed, "bench"),
+        ),
+    }
+
+
+async def measure(rounds, func):
+    # like timeit.repeat, samples of `number` calls, so fast cases are
+    # not dominated by the timer
+    number = max(rounds // 100, 1)
+    for _ in range(number):  # warm up
+        await func()
+    timings = []
+    for _ in range(max(rounds // number, 5)):
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        timings.append((time.perf_counter() - start) / number)
+    timings.sort()
+    return {
+        "rounds": len(timings) * number,
+        "mean": statistics.mean(timings) * 1e6,
+        "median": statistics.median(timings) * 1e6,
+        "p95": timings[int(len(timings) * 0.95)] * 1e6,
+    }
+
+
+def compare(name, result, baseline, tolerance):
+    if name not in baseline:
+        return "new", False
+    ratio = result["median"] / baseline[name]["median"]
+    regressed = ratio > 1 + tolerance
+    return f"{(ratio - 1) * 100:+.1f}%", regressed
+
+
+async def run():
+    args = parser.parse_args()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    cases = await build_cases(args)
+    results = {}
+    regressions = []
+    for name, (rounds, func) in cases.items():
+        if args.only and args.only not in name:
+            continue
+        result = results[name] = await measure(rounds, func)
+        delta, regressed = compare(name, result, baseline, args.tolerance)
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:30} median={result['median']:10.1f}us "
+            f"p95={result['p95']:10.1f}us {delta:>8}"
+            f"{' REGRESSION' if regressed else ''}"
+        )
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "machine": {
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "processor": platform.machine(),
+                    },
+                    "results": baseline,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
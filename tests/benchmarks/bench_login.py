@@ -0,0 +1,97 @@
+"""
+Compares the login write path, storage only (no password hashing)
+
+    python -m tests.benchmarks.bench_login --dsn postgresql://...
+
+    legacy: session insert + update_user(last_login)
+    single: SessionStorage.login, one statement
+"""
+
+from argparse import ArgumentParser
+from fastapi_iam import models
+from fastapi_iam.auth.encoders import JWTToken
+from fastapi_iam.initialize import initialize_db
+from fastapi_iam.services.pg import SessionStorage
+from fastapi_iam.services.pg import UserStorage
+from fastapi_iam.testing import count_queries
+
+import asyncio
+import asyncpg
+import datetime
+import statistics
+import time
+
+SCHEMA = "bench_login"
+
+parser = ArgumentParser()
+parser.add_argument("--dsn", default="postgresql://postgres@localhost/test_db")
+parser.add_argument("--rounds", type=int, default=500)
+
+settings = {
+    "db_schema": SCHEMA,
+    "jwt_expiration": 60 * 60,
+    "jwt_algorithm": "HS256",
+    "jwt_secret_key": "bench",
+    "session_expiration": 60 * 60,
+}
+
+
+async def legacy(users, sessions, us, email):
+    user = await users.by_email(email)
+    await sessions.create(us)
+    return await users.update_user(
+        user.user_id, {"last_login": datetime.datetime.utcnow()}
+    )
+
+
+async def single(users, sessions, us, email):
+    await users.by_email(email)
+    return await sessions.login(us, datetime.datetime.utcnow())
+
+
+async def measure(name, func, conn, rounds, user):
+    users = UserStorage(conn, SCHEMA)
+    sessions = SessionStorage(conn, SCHEMA)
+    encoder = JWTToken(settings)
+    timings = []
+    with count_queries(conn) as queries:
+        for _ in range(rounds):
+            token, expires = await encoder.create_access_token(user)
+            rt, rte = encoder.create_refresh_token()
+            us = models.UserSession(
+                user_id=user.user_id,
+                token=token,
+                expires=expires,
+                refresh_token=rt,
+                refresh_token_expires=rte,
+            )
+            start = time.perf_counter()
+            await func(users, sessions, us, user.email)
+            timings.append(time.perf_counter() - start)
+    print(
+        f"{name:8} queries/login={queries.count / rounds:.1f} "
+        f"mean={statistics.mean(timings) * 1000:.3f}ms "
+        f"p95={sorted(timings)[int(rounds * 0.95)] * 1000:.3f}ms"
+    )
+
+
+async def run():
+    args = parser.parse_args()
+    conn = await asyncpg.connect(dsn=args.dsn)
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    try:
+        await initialize_db(settings, conn)
+        user = await UserStorage(conn, SCHEMA).create(
+            models.UserCreate(email="bench@test.com", password="x")
+        )
+        user = await UserStorage(conn, SCHEMA).by_id(user.user_id)
+        await measure("legacy", legacy, conn, args.rounds, user)
+        await measure("single", single, conn, args.rounds, user)
+    finally:
+        await conn.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+"""
+Per request overhead of the auth pipeline, claims only validation of a
+bearer token (no db access)
+
+    python -m tests.benchmarks.bench_pipeline
+
+    rebuilt: policy, extractors, encoder and keys built on every request
+    compiled: the pipeline built by configure_iam, shared by all requests
+"""
+
+from argparse import ArgumentParser
+from fastapi_iam import configure_iam
+from fastapi_iam import models
+from fastapi_iam.auth import JWTSecurityPolicy
+from fastapi_iam.auth import KeyRing
+from starlette.requests import Request
+
+import asyncio
+import statistics
+import time
+
+parser = ArgumentParser()
+parser.add_argument("--rounds", type=int, default=20000)
+
+
+async def current_user(iam, request):
+    # what provider.get_current_user does per request
+    policy = iam.get_security_policy()
+    token = await policy.extract(request)
+    return await policy.validate(token)
+
+
+async def measure(name, iam, request, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        if name == "rebuilt":
+            iam.keys = KeyRing.from_settings(iam.settings)
+            iam.security_policy = JWTSecurityPolicy
+        await current_user(iam, request)
+        timings.append(time.perf_counter() - start)
+    print(
+        f"{name:8} mean={statistics.mean(timings) * 1e6:.1f}us "
+        f"p95={sorted(timings)[int(rounds * 0.95)] * 1e6:.1f}us"
+    )
+
+
+async def run():
+    args = parser.parse_args()
+    iam = configure_iam(
+        {"jwt_secret_key": "bench", "jwt_claims_only": True},
+        security_policy=JWTSecurityPolicy,
+    )
+    user = models.User(
+        user_id=1,
+        email="bench@test.com",
+        username="bench",
+        password="",
+        is_staff=False,
+        is_active=True,
+        is_admin=False,
+        groups=["bench"],
+    )
+    encoder = iam.get_security_policy().get_encoder()
+    token, _ = await encoder.create_access_token(user)
+    scope = {
+        "type": "http",
+        "headers": [(b"authorization", f"Bearer {token}".encode())],
+    }
+    request = Request(scope)
+    await measure("rebuilt", iam, request, args.rounds)
+    iam.security_policy = JWTSecurityPolicy
+    await measure("compiled", iam, request, args.rounds)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
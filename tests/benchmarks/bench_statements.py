@@ -0,0 +1,73 @@
+"""
+Per call latency of the user lookups
+
+    python -m tests.benchmarks.bench_statements --dsn postgresql://...
+
+    adhoc: query rebuilt and parsed on every call (no statement cache)
+    cached: query sent as sql, hitting the asyncpg statement cache
+    prepared: statements prepared once on the connection
+"""
+
+from argparse import ArgumentParser
+from fastapi_iam import models
+from fastapi_iam.initialize import initialize_db
+from fastapi_iam.services.pg import UserStorage
+from fastapi_iam.services.pg.statements import build_queries
+from fastapi_iam.services.pg.statements import Statements
+
+import asyncio
+import asyncpg
+import statistics
+import time
+
+SCHEMA = "bench_statements"
+
+parser = ArgumentParser()
+parser.add_argument("--dsn", default="postgresql://postgres@localhost/test_db")
+parser.add_argument("--rounds", type=int, default=2000)
+
+
+async def measure(name, conn, rounds, prepare=False):
+    statements = Statements(SCHEMA)
+    if prepare:
+        await statements.prepare(conn)
+    repo = UserStorage(conn, SCHEMA)
+    repo.statements = statements
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        if name == "adhoc":
+            # legacy behaviour, the query is built on every call
+            query = build_queries(f"{SCHEMA}.")["user_by_email"]
+            repo.to_model(await conn.fetchrow(query, "bench@test.com"))
+        else:
+            await repo.by_email("bench@test.com")
+        timings.append(time.perf_counter() - start)
+    print(
+        f"{name:8} mean={statistics.mean(timings) * 1e6:.1f}us "
+        f"p95={sorted(timings)[int(rounds * 0.95)] * 1e6:.1f}us"
+    )
+
+
+async def run():
+    args = parser.parse_args()
+    conn = await asyncpg.connect(dsn=args.dsn)
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    try:
+        await initialize_db({"db_schema": SCHEMA}, conn)
+        await UserStorage(conn, SCHEMA).create(
+            models.UserCreate(email="bench@test.com", password="x")
+        )
+        nocache = await asyncpg.connect(dsn=args.dsn, statement_cache_size=0)
+        await measure("adhoc", nocache, args.rounds)
+        await nocache.close()
+        await measure("cached", conn, args.rounds)
+        await measure("prepared", conn, args.rounds, prepare=True)
+    finally:
+        await conn.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
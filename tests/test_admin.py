@@ -1,5 +1,8 @@
 from fastapi_iam import testing
 
+import csv
+import io
+import json
 import pytest
 
 pytestmark = pytest.mark.asyncio
@@ -21,6 +24,14 @@ async def test_admin_routes(users):
     assert res.status_code == 200
     assert res.json()["total"] == 3
 
+    res = await logged.get("/auth/users?limit=2&total=none")
+    assert res.json()["total"] is None
+    cursor = res.json()["next_cursor"]
+    res = await logged.get(f"/auth/users?limit=2&cursor={cursor}")
+    assert len(res.json()["items"]) == 1
+    res = await logged.get("/auth/users?cursor=xxx")
+    assert res.status_code == 400
+
 
 async def test_create_user(users):
     client, _ = users
@@ -81,3 +92,20 @@ async def test_update_user(users):
         f"/auth/users/{user_id}", json={"groups": ["group1"]}
     )
     assert "group1" in res.json()["groups"]
+
+
+async def test_export_users(users):
+    client, _ = users
+    logged = await testing.login(client, "admin@test.com", "asdf1")
+    res = await logged.get("/auth/users/export")
+    assert res.status_code == 200
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert len(lines) == 3
+    assert "password" not in lines[0]
+
+    res = await logged.get("/auth/users/export?format=csv&is_active=false")
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert [r["email"] for r in rows] == ["inactive@test.com"]
+
+    res = await logged.get("/auth/users/export?format=xml")
+    assert res.status_code == 400
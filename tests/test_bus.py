@@ -0,0 +1,107 @@
+from fastapi import FastAPI
+from fastapi_asyncpg import configure_asyncpg
+from fastapi_iam import configure_iam
+from fastapi_iam.services.pg import InvalidationBus
+
+import asyncio
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeConnection:
+    def __init__(self):
+        self.listeners = {}
+        self.on_termination = []
+        self.executed = []
+        self.closed = False
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    async def remove_listener(self, channel, callback):
+        self.listeners.pop(channel, None)
+
+    def add_termination_listener(self, callback):
+        self.on_termination.append(callback)
+
+    def remove_termination_listener(self, callback):
+        self.on_termination.remove(callback)
+
+    def is_closed(self):
+        return self.closed
+
+    def terminate(self):
+        self.closed = True
+        for callback in self.on_termination:
+            callback(self)
+
+    async def execute(self, query, *args):
+        self.executed.append(args)
+        for callback in self.listeners.values():
+            callback(self, 1, args[0], args[1])
+
+    async def fetchval(self, query):
+        return 1
+
+
+class FakePool:
+    def __init__(self):
+        self.connections = []
+
+    async def acquire(self):
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+    async def release(self, conn):
+        pass
+
+
+class FakeIAM:
+    def __init__(self):
+        self.pool = FakePool()
+        self.invalidated = []
+
+    def invalidate(self, kind, key):
+        self.invalidated.append((kind, key))
+
+
+async def test_invalidation_bus():
+    iam = FakeIAM()
+    bus = InvalidationBus(iam, reconnect_delay=0)
+    other = InvalidationBus(iam)
+    await bus.start()
+    await asyncio.sleep(0)
+    conn = iam.pool.connections[0]
+    assert bus.channel in conn.listeners
+
+    # own messages are skipped, they are evicted when published
+    await bus.publish(conn, "user", 12)
+    assert iam.invalidated == []
+    await other.publish(conn, "user", 12)
+    await other.publish(conn, "token", "abcd")
+    await other.publish(conn, "password", "hash")
+    assert iam.invalidated == [("user", 12), ("token", "abcd")]
+
+    # when connection is lost, reconnect and flush everything
+    conn.terminate()
+    await asyncio.sleep(0.05)
+    assert len(iam.pool.connections) == 2
+    assert iam.invalidated[-1] == ("all", None)
+    assert bus.stats()["reconnects"] == 1
+    await bus.stop()
+    assert not bus.running
+
+
+async def test_invalidation_publish_evicts_local():
+    iam = configure_iam({"session_cache_size": 10})
+    iam.session_cache.set("key", "user", tags=(1,))
+    await iam.publish(None, "user", 1)
+    assert len(iam.session_cache) == 0
+
+
+async def test_tasks_stop_before_pool_closes():
+    app = FastAPI()
+    db = configure_asyncpg(app, "")
+    iam = configure_iam({}, fastapi_asyncpg=db)
+    assert app.router.on_shutdown == [iam.shutdown, db.on_disconnect]
@@ -0,0 +1,61 @@
+from fastapi_iam.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiration():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=10, clock=clock)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=5)
+    cache.set("c", 3, ttl=60)  # capped by cache ttl
+    assert cache.get("a") == 1
+    clock.now = 6
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    clock.now = 11
+    assert cache.get("a") is None
+    assert cache.get("c") is None
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["expirations"] == 3
+    assert len(cache) == 0
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_cache_tags():
+    cache = TTLCache(maxsize=10, ttl=10)
+    cache.set("a", 1, tags=("user:1",))
+    cache.set("b", 2, tags=("user:1",))
+    cache.set("c", 3, tags=("user:2",))
+    assert cache.invalidate_tag("user:1") == 2
+    assert "a" not in cache
+    assert "b" not in cache
+    assert cache.get("c") == 3
+    assert cache.invalidate("c") is True
+    assert cache.invalidate("c") is False
+    assert cache.invalidate_tag("user:1") == 0
+
+
+def test_ttl_cache_disabled():
+    cache = TTLCache(maxsize=0, ttl=10)
+    cache.set("a", 1)
+    assert cache.get("a") is None
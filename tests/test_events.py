@@ -1,4 +1,13 @@
+from async_asgi_testclient import TestClient
+from fastapi import FastAPI
+from fastapi_asyncpg import configure_asyncpg
+from fastapi_iam import configure_iam
 from fastapi_iam import events
+from fastapi_iam import models
+from fastapi_iam import testing
+from fastapi_iam.initialize import create_outbox
+
+import asyncio
 import pytest
 
 pytestmark = pytest.mark.asyncio
@@ -28,3 +37,148 @@ async def test_events():
     assert counter == 1
     await events.notify(AEvent(1))
     assert counter == 2
+
+
+class BEvent:
+    pass
+
+
+async def test_concurrent_dispatcher():
+    calls = []
+
+    async def slow(event):
+        await asyncio.sleep(0.2)
+        calls.append("slow")
+
+    async def broken(event):
+        raise ValueError()
+
+    async def fast(event):
+        calls.append("fast")
+
+    events.add_subscriber(BEvent, slow)
+    events.add_subscriber(BEvent, broken)
+    events.add_subscriber(BEvent, fast)
+    dispatcher = events.ConcurrentDispatcher(timeout=0.05)
+    events.set_dispatcher(dispatcher)
+    try:
+        await events.notify(BEvent())
+    finally:
+        events.set_dispatcher(events.SequentialDispatcher())
+    assert calls == ["fast"]
+    assert dispatcher.stats() == {"dispatched": 1, "errors": 1, "timeouts": 1}
+
+
+class CEvent:
+    pass
+
+
+async def test_queue_dispatcher():
+    received = []
+    release = asyncio.Event()
+
+    async def audit(event):
+        await release.wait()
+        received.append(event)
+
+    events.add_subscriber(CEvent, audit)
+    dispatcher = events.QueueDispatcher(maxsize=2, workers=1, timeout=1)
+    events.set_dispatcher(dispatcher)
+    await dispatcher.start()
+    try:
+        for _ in range(4):
+            # returns without waiting for the subscriber
+            await asyncio.wait_for(events.notify(CEvent()), 0.1)
+            await asyncio.sleep(0)
+        stats = dispatcher.stats()
+        # one being delivered, two queued, one dropped
+        assert stats["queue_depth"] == 2
+        assert stats["dropped"] == 1
+        release.set()
+        await dispatcher.stop()
+    finally:
+        events.set_dispatcher(events.SequentialDispatcher())
+    assert len(received) == 3
+    assert dispatcher.stats()["queue_depth"] == 0
+    assert not dispatcher.running
+    # without workers, events are delivered in place
+    await dispatcher.dispatch(CEvent(), [audit])
+    assert len(received) == 4
+    assert not dispatcher.running
+
+
+async def test_login_does_not_wait_for_subscribers(pool):
+    app = FastAPI()
+    db = configure_asyncpg(app, "", pool=pool)
+    iam = configure_iam({"events_dispatcher": "queue"}, fastapi_asyncpg=db)
+    app.include_router(iam.router, prefix="/auth")
+    done = []
+    release = asyncio.Event()
+
+    async def audit(event):
+        await release.wait()
+        done.append(event.user.email)
+        raise ValueError("the audit service is down")
+
+    events.add_subscriber(events.UserLogin, audit)
+    try:
+        async with TestClient(app) as client:
+            # workers are started by the app lifespan, not by requests
+            assert iam.events.running
+            await models.create_user(
+                iam, {"email": "e@test.com", "password": "e", "is_active": True}
+            )
+            await testing.login(client, "e@test.com", "e")
+            assert done == []
+            release.set()
+        # delivered on shutdown
+        assert done == ["e@test.com"]
+        assert iam.stats()["events"]["errors"] == 1
+    finally:
+        events.events[events.UserLogin].remove(audit)
+        events.set_dispatcher(events.SequentialDispatcher())
+
+
+async def test_outbox(pool):
+    app = FastAPI()
+    db = configure_asyncpg(app, "", pool=pool)
+    # relayed by hand, the test pool is a single connection
+    settings = {"outbox": True, "outbox_interval": 60}
+    iam = configure_iam(settings, fastapi_asyncpg=db)
+    app.include_router(iam.router, prefix="/auth")
+    async with pool.acquire() as conn:
+        await create_outbox(iam.settings, conn)
+    delivered = []
+
+    async def broken(events):
+        raise ValueError("the broker is down")
+
+    async def sink(events):
+        delivered.extend(events)
+
+    async with TestClient(app) as client:
+        await models.create_user(
+            iam, {"email": "o@test.com", "password": "o", "is_active": True}
+        )
+        user = await testing.login(client, "o@test.com", "o")
+        await user.post("/auth/logout")
+        await testing.login(client, "o@test.com", "o")
+
+        iam.outbox.add_sink(broken)
+        with pytest.raises(ValueError):
+            await iam.outbox.relay()
+        # rolled back, delivered again
+        iam.outbox.sinks = [sink]
+        assert await iam.outbox.relay() == 3
+        assert await iam.outbox.relay() == 0
+
+    assert [e["event"] for e in delivered] == [
+        "UserLogin",
+        "UserLogout",
+        "UserLogin",
+    ]
+    assert delivered[0]["data"]["email"] == "o@test.com"
+    # login and logout of the same session
+    assert delivered[0]["data"]["session"] == delivered[1]["data"]["session"]
+    assert delivered[0]["user_id"] == delivered[1]["user_id"]
+    assert iam.stats()["outbox"]["delivered"] == 3
@@ -0,0 +1,90 @@
+from fastapi_iam import testing
+from fastapi_iam.auth import hasher
+from fastapi_iam.importer import parse_ndjson
+from fastapi_iam.importer import UserImporter
+from fastapi_iam.interfaces import IUsersStorage
+
+import io
+import json
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_bulk_import(users):
+    bcrypt = pytest.importorskip("bcrypt")
+    client, iam = users
+    hashed = bcrypt.hashpw(b"legacy", bcrypt.gensalt(4)).decode()
+    rows = [
+        {"email": "new@test.com", "password": "first", "groups": ["g2"]},
+        {"email": "test@test.com", "password": "changed", "groups": ["g1"]},
+        {"email": "legacy@test.com", "password_hash": hashed},
+        {"password": "no email"},
+        {"email": "new@test.com", "password": "new", "groups": ["g1", "g2"]},
+    ]
+    lines = [json.dumps(row) for row in rows]
+    progress = []
+    importer = UserImporter(
+        iam.hasher, batch_size=10, on_progress=progress.append
+    )
+    repo = iam.get_service(IUsersStorage)
+    report = await importer.run(repo, parse_ndjson(lines))
+    assert report["rows"] == 5
+    assert report["created"] == 2
+    assert report["updated"] == 1
+    assert report["skipped"] == 2
+    assert report["hashed"] == 3
+    assert report["errors"] == [{"row": 4, "error": "missing email"}]
+    assert len(progress) == 1
+
+    user = await repo.by_email("new@test.com")
+    assert user.groups == ["g1", "g2"]
+    assert (await repo.by_email("test@test.com")).groups == ["g1"]
+    assert await repo.check_groups() == []
+
+    await testing.login(client, "new@test.com", "new")
+    await testing.login(client, "test@test.com", "changed")
+    await testing.login(client, "legacy@test.com", "legacy")
+
+
+async def test_import_email_case(users):
+    client, iam = users
+    rows = [
+        {"email": "Dup@x.com", "password": "first"},
+        {"email": "dup@x.com", "password": "second"},
+    ]
+    importer = UserImporter(iam.hasher)
+    repo = iam.get_service(IUsersStorage)
+    report = await importer.run(repo, rows)
+    assert report["created"] == 1
+    assert report["errors"] == []
+    await testing.login(client, "dup@x.com", "second")
+
+
+async def test_import_bcrypt_without_bcrypt(users, monkeypatch):
+    client, iam = users
+    monkeypatch.setattr(hasher, "bcrypt", None)
+    rows = [{"email": "legacy@test.com", "password_hash": "$2b$04$" + "x" * 53}]
+    importer = UserImporter(iam.hasher)
+    # leaves room on the hasher executor for logins
+    assert importer.concurrency == max(1, iam.hasher.executor.workers // 2)
+    report = await importer.run(iam.get_service(IUsersStorage), rows)
+    assert report["created"] == 0
+    assert report["errors"] == [
+        {"row": 1, "error": "bcrypt password_hash, install bcrypt"}
+    ]
+
+
+async def test_import_endpoint(users):
+    client, iam = users
+    logged = await testing.login(client, "admin@test.com", "asdf1")
+    data = b'email,password,is_active,groups\nimp@test.com,imp,true,"a,b"\n'
+    res = await logged.post(
+        "/auth/users/import?update_existing=false",
+        files={"file": ("users.csv", io.BytesIO(data), "text/csv")},
+    )
+    assert res.status_code == 200
+    assert res.json()["created"] == 1
+    await testing.login(client, "imp@test.com", "imp")
+    user = await iam.get_service(IUsersStorage).by_email("imp@test.com")
+    assert user.groups == ["a", "b"]
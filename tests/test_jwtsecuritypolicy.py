@@ -1,6 +1,9 @@
 from fastapi_iam.auth.policy import JWTSecurityPolicy
 from fastapi_iam.auth.policy import InvalidRefreshToken
 from fastapi_iam import models
+from fastapi_iam import testing
+from fastapi_iam.fixtures import pg_only
+from fastapi_iam.interfaces import IUsersStorage
 
 import pytest
 import jwt
@@ -51,6 +54,7 @@ def auth_header(token):
     return {"Authorization": f"Bearer {token}"}
 
 
+@pg_only
 async def test_JWTSecurityPolicy(users):
     client, iam = users
     iam.security_policy = JWTSecurityPolicy
@@ -103,3 +107,43 @@ async def test_JWTSecurityPolicy(users):
     nt = renew.json()["access_token"]
     res = await client.get("/auth/whoami", headers=auth_header(nt))
     assert res.status_code == 200
+
+
+@pg_only
+async def test_claims_only_validation(users):
+    client, iam = users
+    iam.security_policy = JWTSecurityPolicy
+    iam.settings["jwt_claims_only"] = True
+    logged = await testing.login(client, "test@test.com", "asdf")
+
+    with testing.count_queries(iam.pool) as queries:
+        res = await logged.get("/auth/whoami")
+    assert res.status_code == 200
+    assert res.json()["email"] == "test@test.com"
+    assert res.json()["is_staff"] is True
+    assert queries.count == 0
+
+    # old tokens are checked on the db, disabled users are rejected
+    iam.settings["jwt_claims_max_age"] = -1
+    user_id = res.json()["user_id"]
+    await iam.get_service(IUsersStorage).update_user(
+        user_id, {"is_active": False}
+    )
+    res = await logged.get("/auth/whoami")
+    assert res.status_code == 403
+
+
+async def test_policy_is_built_once(users):
+    client, iam = users
+    iam.security_policy = JWTSecurityPolicy
+    policy = iam.get_security_policy()
+    assert iam.get_security_policy() is policy
+    encoder = policy.get_encoder()
+    logged = await testing.login(client, "test@test.com", "asdf")
+    res = await logged.get("/auth/whoami")
+    assert res.status_code == 200
+    assert iam.get_security_policy() is policy
+    assert policy.get_encoder() is encoder
+    # replacing the policy class drops the built pipeline
+    iam.security_policy = JWTSecurityPolicy
+    assert iam.get_security_policy() is not policy
@@ -0,0 +1,91 @@
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi_iam import testing
+from fastapi_iam.auth import KeyRing
+from fastapi_iam.auth import SigningKey
+
+import jwt
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+def rsa_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+def ed25519_key():
+    return ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+def validate_with_jwks(token, jwks):
+    kid = jwt.get_unverified_header(token)["kid"]
+    key = jwt.PyJWKSet.from_dict(jwks)[kid]
+    return jwt.decode(token, key.key, algorithms=[key.algorithm_name])
+
+
+async def test_keyring_rotation(users):
+    client, iam = users
+    iam.keys = KeyRing([SigningKey("k1", "RS256", private_key=rsa_key())])
+
+    res = await client.get("/auth/.well-known/jwks.json")
+    assert res.status_code == 200
+    assert "max-age" in res.headers["cache-control"]
+    jwks = res.json()
+    assert [k["kid"] for k in jwks["keys"]] == ["k1"]
+    assert "d" not in jwks["keys"][0]  # no private parts
+
+    old = await testing.login(client, "test@test.com", "asdf")
+    claims = validate_with_jwks(old.token, jwks)
+    assert claims["email"] == "test@test.com"
+
+    # publish the next key, and start signing with it
+    iam.keys.add(SigningKey("k2", "EdDSA", private_key=ed25519_key()))
+    jwks = (await client.get("/auth/.well-known/jwks.json")).json()
+    assert {k["kid"] for k in jwks["keys"]} == {"k1", "k2"}
+    iam.keys.activate("k2")
+    new = await testing.login(client, "test@test.com", "asdf")
+    assert jwt.get_unverified_header(new.token)["kid"] == "k2"
+    validate_with_jwks(new.token, jwks)
+
+    # tokens signed with the old key are valid until it's removed
+    assert (await old.get("/auth/whoami")).status_code == 200
+    iam.keys.remove("k1")
+    assert (await old.get("/auth/whoami")).status_code == 403
+    assert (await new.get("/auth/whoami")).status_code == 200
+
+
+async def test_keyring_rejects_unknown_keys():
+    ring = KeyRing.from_settings(
+        {"jwt_algorithm": "HS256", "jwt_secret_key": "secret"}
+    )
+    token = ring.sign({"sub": "1"})
+    assert "kid" not in jwt.get_unverified_header(token)
+    assert ring.decode(token) == {"sub": "1"}
+    assert ring.jwks() == {"keys": []}
+
+    other = KeyRing([SigningKey("k1", "HS256", secret="secret")])
+    with pytest.raises(jwt.DecodeError):
+        ring.decode(other.sign({"sub": "1"}))
+
+
+async def test_keyring_needs_signing_key():
+    public = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048
+    ).public_key()
+    pem = public.public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    with pytest.raises(ValueError, match="no signing key"):
+        KeyRing([SigningKey("k1", "RS256", public_key=pem)])
@@ -0,0 +1,57 @@
+from fastapi_iam.fixtures import pg_only
+from fastapi_iam.interfaces import IUsersStorage
+from fastapi_iam.loadtest import ASGIClient
+from fastapi_iam.loadtest import delete_seeded
+from fastapi_iam.loadtest import LoadTest
+from fastapi_iam.loadtest import parse_mix
+from fastapi_iam.loadtest import RouteQueries
+from fastapi_iam.loadtest import seed_users
+
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+@pg_only
+async def test_loadtest(users, conn):
+    _, iam = users
+    repo = iam.get_service(IUsersStorage)
+    hashed = await iam.hasher.hash_password("load")
+    emails = await seed_users(repo, 3, hashed, groups=2)
+    assert (await repo.by_email(emails[0])).groups == [
+        "loadtest-0",
+        "loadtest-1",
+    ]
+
+    queries = RouteQueries()
+    conn.add_query_logger(queries)
+    try:
+        report = await LoadTest(
+            ASGIClient(iam.db.app),
+            [(email, "load") for email in emails],
+            mix=parse_mix("login=1,whoami=4,renew=1,logout=1"),
+            concurrency=1,  # the testing pool is a single connection
+            requests=40,
+            queries=queries,
+        ).run()
+    finally:
+        conn.remove_query_logger(queries)
+
+    assert report["requests"] == 40
+    assert report["errors"] == 0
+    routes = report["routes"]
+    assert sum(r["requests"] for r in routes.values()) == 40
+    assert routes["login"]["requests"] >= 1
+    assert routes["login"]["queries"] > 0
+    assert routes["login"]["p50"] <= routes["login"]["p99"]
+
+    assert await delete_seeded(conn) == 3
+    assert await repo.by_email(emails[0]) is None
+
+
+def test_parse_mix():
+    assert parse_mix("login=1,whoami") == {"login": 1.0, "whoami": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("status=1")
+    with pytest.raises(ValueError):
+        parse_mix("login=0")
@@ -1,3 +1,13 @@
+from fastapi_iam import testing
+from fastapi_iam.auth import BasicAuthPolicy
+from fastapi_iam.auth import BearerAuthPolicy
+from fastapi_iam.cache import TTLCache
+from fastapi_iam.fixtures import pg_only
+from fastapi_iam.interfaces import IUsersStorage
+from fastapi_iam.tasks import ActivityBuffer
+from fastapi_iam.tasks import SessionReaper
+
+import base64
 import pytest
 import jwt
 
@@ -68,6 +78,7 @@ async def test_invalid_token(users):
     assert res.status_code == 403
 
 
+@pg_only
 async def test_disable_user(users):
     client, iam = users
     res = await client.post(
@@ -128,3 +139,202 @@ async def test_refresh_token(users):
     nt = renew.json()["access_token"]
     res = await client.get("/auth/whoami", headers=auth_header(nt))
     assert res.status_code == 200
+
+
+def basic_header(username, password):
+    value = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {"Authorization": f"Basic {value}"}
+
+
+async def test_basic_auth(users):
+    client, iam = users
+    policy = iam.security_policy
+    policy.extractors = [BearerAuthPolicy, BasicAuthPolicy]
+    try:
+        headers = basic_header("test@test.com", "asdf")
+        res = await client.get("/auth/whoami", headers=headers)
+        assert res.status_code == 200
+        assert res.json()["email"] == "test@test.com"
+        user_id = res.json()["user_id"]
+        res = await client.get("/auth/whoami", headers=headers)
+        assert res.status_code == 200
+        assert iam.hasher.cache.stats()["hits"] == 1
+
+        res = await client.get(
+            "/auth/whoami", headers=basic_header("test@test.com", "xxx")
+        )
+        assert res.status_code == 403
+
+        # changing the password drops cached verifications
+        await iam.get_service(IUsersStorage).update_user(
+            user_id, {"password": await iam.hasher.hash_password("new")}
+        )
+        assert iam.hasher.cache.stats()["size"] == 0
+        res = await client.get("/auth/whoami", headers=headers)
+        assert res.status_code == 403
+    finally:
+        policy.extractors = [BearerAuthPolicy]
+
+
+async def test_session_cache(users):
+    client, iam = users
+    iam.session_cache = TTLCache(maxsize=10, ttl=60)
+    res = await client.post(
+        "/auth/login",
+        form={"username": "test@test.com", "password": "asdf"},
+    )
+    token = res.json()["access_token"]
+    for _ in range(3):
+        res = await client.get("/auth/whoami", headers=auth_header(token))
+        assert res.status_code == 200
+    stats = iam.session_cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+
+    # updating the user drops its sessions
+    user_id = res.json()["user_id"]
+    await iam.get_service(IUsersStorage).update_user(
+        user_id, {"username": "changed"}
+    )
+    assert len(iam.session_cache) == 0
+    res = await client.get("/auth/whoami", headers=auth_header(token))
+    assert res.json()["username"] == "changed"
+
+    # logout evicts the session
+    res = await client.get("/auth/logout", headers=auth_header(token))
+    assert len(iam.session_cache) == 0
+    res = await client.get("/auth/whoami", headers=auth_header(token))
+    assert res.status_code == 403
+
+
+@pg_only
+async def test_login_query_count(users):
+    client, iam = users
+    with testing.count_queries(iam.pool) as queries:
+        res = await client.post(
+            "/auth/login",
+            form={"username": "test@test.com", "password": "asdf"},
+        )
+    assert res.status_code == 200
+    # by_email + session insert with last_login stamp
+    assert queries.count == 2
+    async with iam.pool.acquire() as db:
+        last_login = await db.fetchval(
+            "SELECT last_login FROM users WHERE email=$1", "test@test.com"
+        )
+    assert last_login is not None
+
+
+@pg_only
+async def test_activity_buffer(users):
+    client, iam = users
+    iam.activity = ActivityBuffer(iam)
+    iam.settings["session_last_used"] = True
+    query = "SELECT last_login FROM users WHERE email=$1"
+    with testing.count_queries(iam.pool) as queries:
+        res = await client.post(
+            "/auth/login",
+            form={"username": "test@test.com", "password": "asdf"},
+        )
+    assert res.status_code == 200
+    # by_email + session insert, last_login is buffered
+    assert queries.count == 2
+    assert await iam.pool.fetchval(query, "test@test.com") is None
+    logged = await testing.login(client, "test@test.com", "asdf")
+    for _ in range(3):
+        res = await logged.get("/auth/whoami")
+        assert res.status_code == 200
+
+    # coalesced, one user and one session
+    assert iam.activity.stats()["pending"] == 2
+    assert await iam.activity.flush() == 2
+    assert iam.activity.stats()["pending"] == 0
+    assert await iam.pool.fetchval(query, "test@test.com") is not None
+    last_used = await iam.pool.fetchval(
+        "SELECT last_used FROM users_session WHERE token=$1", logged.token
+    )
+    assert last_used is not None
+
+
+@pg_only
+async def test_session_reaper(users):
+    client, iam = users
+    for _ in range(5):
+        await testing.login(client, "test@test.com", "asdf")
+    logged = await testing.login(client, "admin@test.com", "asdf1")
+    await iam.pool.execute(
+        """UPDATE users_session
+        SET refresh_token_expires = now() - '1 day'::interval
+        WHERE user_id = (SELECT user_id FROM users WHERE email=$1)""",
+        "test@test.com",
+    )
+    reaper = SessionReaper(iam, batch_size=2, batch_delay=0)
+    assert await reaper.reap() == 5
+    assert reaper.stats()["reaped_last_run"] == 5
+    assert await iam.pool.fetchval("SELECT count(*) FROM users_session") == 1
+    # sessions not expired still work
+    res = await logged.get("/auth/whoami")
+    assert res.status_code == 200
+
+
+async def test_reaper_and_activity(users):
+    # on every storage
+    client, iam = users
+    iam.activity = ActivityBuffer(iam)
+    iam.settings["session_last_used"] = True
+    expiration = iam.settings["session_expiration"]
+    # sessions created already expired
+    iam.settings["session_expiration"] = -60
+    for _ in range(3):
+        await testing.login(client, "test@test.com", "asdf")
+    iam.settings["session_expiration"] = expiration
+    logged = await testing.login(client, "admin@test.com", "asdf1")
+    res = await logged.get("/auth/whoami")
+    assert res.status_code == 200
+    users = iam.get_service(IUsersStorage)
+    assert (await users.by_email("test@test.com")).last_login is None
+    # two users and one session
+    assert await iam.activity.flush() == 3
+    assert (await users.by_email("test@test.com")).last_login is not None
+    assert (await users.by_email("admin@test.com")).last_login is not None
+
+    reaper = SessionReaper(iam, batch_size=2, batch_delay=0)
+    assert await reaper.reap() == 3
+    assert await reaper.reap() == 0
+    res = await logged.get("/auth/whoami")
+    assert res.status_code == 200
+
+
+async def test_server_timing(users):
+    client, iam = users
+    policy = iam.get_security_policy()
+    traces = []
+
+    async def hook(request, timings):
+        traces.append((request.url.path, dict(timings)))
+
+    policy.add_timing_hook(hook)
+    res = await client.post(
+        "/auth/login",
+        form={"username": "test@test.com", "password": "asdf"},
+    )
+    assert res.status_code == 200
+    # hooks only, no header
+    assert "server-timing" not in res.headers
+    path, timings = traces[-1]
+    assert path == "/auth/login"
+    assert {"db", "hash", "encode", "total"} <= set(timings)
+
+    iam.settings["server_timing"] = True
+    token = res.json()["access_token"]
+    cookies = {"refresh": res.cookies["refresh"]}
+    res = await client.get("/auth/whoami", headers=auth_header(token))
+    assert res.status_code == 200
+    stages = [p.split(";")[0] for p in res.headers["server-timing"].split(", ")]
+    assert stages == ["extract", "decode", "db", "total"]
+    assert traces[-1][0] == "/auth/whoami"
+
+    res = await client.post("/auth/renew", cookies=cookies)
+    assert res.status_code == 200
+    assert "server-timing" in res.headers
+    assert len(traces) == 3
@@ -0,0 +1,103 @@
+from async_asgi_testclient import TestClient
+from fastapi import FastAPI
+from fastapi_iam import configure_iam
+from fastapi_iam import models
+from fastapi_iam import testing
+from fastapi_iam.services.memory import MemoryStore
+from fastapi_iam.services.memory import SnapshotTask
+from fastapi_iam.tasks import SessionReaper
+
+import datetime
+import os
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+user = {"email": "test@test.com", "password": "asdf", "is_active": True}
+
+
+def memory_app(settings=None):
+    app = FastAPI()
+    iam = configure_iam({"storage": "memory", **(settings or {})})
+    app.include_router(iam.router, prefix="/auth")
+    return iam, app
+
+
+async def test_store_reap():
+    store = MemoryStore()
+    user_id = store.add_user(
+        {"email": "Test@Test.com", "password": "x"}
+    ).user_id
+    assert store.emails["test@test.com"].user_id == user_id
+    now = datetime.datetime.utcnow()
+    for i in range(4):
+        store.add_session(
+            {
+                "token": f"t{i}",
+                "user_id": user_id,
+                "refresh_token": f"r{i}",
+                "refresh_token_expires": now + datetime.timedelta(days=i - 2),
+            }
+        )
+    # rotating t0 moves it after now, its old heap entry is skipped
+    store.update_session(
+        store.sessions["t0"],
+        "t4",
+        now,
+        "r4",
+        now + datetime.timedelta(days=1),
+    )
+    assert store.reap(now, limit=10) == 1
+    assert set(store.sessions) == {"t2", "t3", "t4"}
+    assert "r1" not in store.refresh_tokens
+    assert len(store.user_sessions[user_id]) == 3
+    store.compact()
+    assert len(store.expiry) == 3
+
+
+async def test_snapshot(tmp_path):
+    path = str(tmp_path / "iam.json")
+    iam, app = memory_app({"memory_snapshot": path})
+    async with TestClient(app) as client:
+        await models.create_user(iam, user.copy())
+        logged = await testing.login(client, "test@test.com", "asdf")
+    # saved on shutdown
+    assert iam.stats()["memory_snapshot"]["snapshots"] == 1
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    iam, app = memory_app({"memory_snapshot": path})
+    async with TestClient(app) as client:
+        assert iam.store.stats()["users"] == 1
+        res = await client.get(
+            "/auth/whoami", headers=testing.auth_header(logged.token)
+        )
+        assert res.status_code == 200
+        assert res.json()["email"] == "test@test.com"
+        # ids keep growing after a restore
+        await models.create_user(iam, {"email": "a@test.com", "password": "a"})
+        assert iam.store.emails["a@test.com"].user_id == 2
+
+    task = SnapshotTask(MemoryStore(), path)
+    await task.start()
+    assert task.store.stats()["users"] == 2
+    await task.stop()
+
+
+async def test_shared_access_tokens():
+    iam, app = memory_app()
+    async with TestClient(app) as client:
+        await models.create_user(iam, user.copy())
+        # same second logins share the access token, not the session
+        for _ in range(3):
+            await testing.login(client, "test@test.com", "asdf")
+        assert len(list(iam.store.all_sessions())) == 3
+        record = iam.store.emails["test@test.com"]
+        expired = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        for session in iam.store.user_sessions[record.user_id].copy():
+            iam.store.update_session(
+                session, session.token, expired, session.refresh_token, expired
+            )
+        reaper = SessionReaper(iam, batch_size=2, batch_delay=0)
+        assert await reaper.reap() == 3
+        assert record.user_id not in iam.store.user_sessions
+        assert iam.store.sessions == {}
@@ -0,0 +1,102 @@
+from async_asgi_testclient import TestClient
+from fastapi import FastAPI
+from fastapi_asyncpg import configure_asyncpg
+from fastapi_iam import configure_iam
+from fastapi_iam import models
+from fastapi_iam import testing
+from fastapi_iam.metrics import Histogram
+from fastapi_iam.metrics import MetricsSink
+
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+def test_histogram():
+    histogram = Histogram("h", "help", "stage", buckets=(0.1, 1))
+    histogram.observe(0.05, "db")
+    histogram.observe(0.5, "db")
+    histogram.observe(5, "db")
+    samples = {(n, labels): v for n, labels, v in histogram.samples()}
+    assert samples[("h_bucket", '{stage="db",le="0.1"}')] == 1
+    assert samples[("h_bucket", '{stage="db",le="1"}')] == 2
+    assert samples[("h_bucket", '{stage="db",le="+Inf"}')] == 3
+    assert samples[("h_count", '{stage="db"}')] == 3
+    assert samples[("h_sum", '{stage="db"}')] == 5.55
+
+
+async def test_metrics_route(pool):
+    app = FastAPI()
+    db = configure_asyncpg(app, "", pool=pool)
+    iam = configure_iam({"metrics_route": True}, fastapi_asyncpg=db)
+    app.include_router(iam.router, prefix="/auth")
+    async with TestClient(app) as client:
+        await models.create_user(
+            iam, {"email": "m@test.com", "password": "m", "is_active": True}
+        )
+        logged = await testing.login(client, "m@test.com", "m")
+        assert (await logged.get("/auth/whoami")).status_code == 200
+        res = await client.post(
+            "/auth/login", form={"username": "m@test.com", "password": "x"}
+        )
+        assert res.status_code == 400
+        res = await client.get("/auth/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = res.text
+    assert 'iam_logins_total{outcome="success"} 1' in text
+    assert 'iam_logins_total{outcome="invalid_password"} 1' in text
+    for stage in ("extract", "decode", "db", "hash", "encode"):
+        assert f'iam_auth_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'iam_hasher_seconds_count{op="verify"} 2' in text
+    assert 'iam_hasher_queue_wait_seconds_count{op="hash"} 1' in text
+    assert 'iam_storage_seconds_count{method="UserStorage.by_token"} 1' in text
+    assert "iam_credential_cache_hit_ratio " in text
+    assert "iam_hasher_completed 3" in text
+
+
+async def test_custom_sink(users):
+    client, iam = users
+
+    class Sink(MetricsSink):
+        def __init__(self):
+            self.observed = []
+
+        def observe(self, name, value, label=""):
+            self.observed.append((name, label))
+
+    iam.metrics = sink = Sink()
+    await testing.login(client, "test@test.com", "asdf")
+    assert ("iam_auth_stage_seconds", "hash") in sink.observed
+    # storage metrics are taken from the iam when services are built
+    assert ("iam_storage_seconds", "UserStorage.by_email") in sink.observed
+    # without the route there's no /metrics
+    assert (await client.get("/auth/metrics")).status_code == 404
+
+
+async def test_metrics_route_custom_sink(pool):
+    sink = MetricsSink()
+    app = FastAPI()
+    db = configure_asyncpg(app, "", pool=pool)
+    settings = {
+        "metrics": sink,
+        "metrics_route": True,
+        "metrics_token": "scrape",
+    }
+    iam = configure_iam(settings, fastapi_asyncpg=db)
+    app.include_router(iam.router, prefix="/auth")
+    # a sink of its own is kept, /metrics only renders the stats
+    assert iam.metrics is sink
+    async with TestClient(app) as client:
+        res = await client.get("/auth/metrics")
+        assert res.status_code == 401
+        res = await client.get(
+            "/auth/metrics", headers={"Authorization": "Bearer nope"}
+        )
+        assert res.status_code == 401
+        res = await client.get(
+            "/auth/metrics", headers={"Authorization": "Bearer scrape"}
+        )
+    assert res.status_code == 200
+    assert "iam_logins_total" not in res.text
+    assert "iam_hasher_completed 0" in res.text
@@ -5,4 +5,4 @@ pytestmark = pytest.mark.asyncio
 
 async def testing_migrations(conn):
     val = await conn.fetchval("SELECT value from users_version")
-    assert val == 1
+    assert val == 4
@@ -1,4 +1,6 @@
+import asyncio
 import pytest
+import threading
 from fastapi_iam import auth
 
 pytestmark = pytest.mark.asyncio
@@ -10,3 +12,60 @@ async def test_password_argon_hasher():
     token = await service.hash_password(password)
     check_pass = await service.check_password(token, password)
     assert check_pass is True
+
+
+async def test_hashing_executor_sheds_load():
+    executor = auth.HashingExecutor(workers=1, queue_size=1)
+    service = auth.ArgonPasswordHasher(executor=executor)
+    release = threading.Event()
+
+    def block():
+        release.wait()
+
+    loop = asyncio.get_running_loop()
+    running = loop.create_task(executor.run(block))
+    queued = loop.create_task(service.hash_password("1qaz2wsx"))
+    await asyncio.sleep(0.1)
+    assert executor.queue_depth == 1
+
+    with pytest.raises(auth.HasherOverloaded) as exc:
+        await service.hash_password("1qaz2wsx")
+    assert exc.value.status_code == 503
+    assert int(exc.value.headers["Retry-After"]) >= 1
+
+    release.set()
+    await running
+    await queued
+    stats = executor.stats()
+    assert stats["completed"] == 2
+    assert stats["rejected"] == 1
+    assert stats["queue_depth"] == 0
+    executor.shutdown()
+
+
+def test_hashing_executor_memory_budget():
+    executor = auth.HashingExecutor(
+        workers=8,
+        memory_budget=2 * auth.ArgonPasswordHasher.memory_cost,
+        memory_cost=auth.ArgonPasswordHasher.memory_cost,
+    )
+    assert executor.workers == 2
+
+
+async def test_credential_cache():
+    cache = auth.CredentialCache(maxsize=10, ttl=60)
+    service = auth.ArgonPasswordHasher(cache=cache)
+    password = "1qaz2wsx"
+    token = await service.hash_password(password)
+
+    assert await service.check_password(token, "invalid") is False
+    assert cache.stats()["size"] == 0
+    assert await service.check_password(token, password) is True
+    assert cache.verified(token, password)
+    # plain passwords never reach the cache
+    for key, (_, _, tags) in cache.cache._data.items():
+        assert password.encode() not in key
+        assert token.encode() not in key
+
+    service.invalidate(token)
+    assert not cache.verified(token, password)
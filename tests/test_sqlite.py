@@ -0,0 +1,112 @@
+from async_asgi_testclient import TestClient
+from fastapi import FastAPI
+from fastapi_iam import configure_iam
+from fastapi_iam import models
+from fastapi_iam import testing
+from fastapi_iam.interfaces import IGroupsStorage
+from fastapi_iam.interfaces import IUsersStorage
+from fastapi_iam.services.sqlite import SQLiteDatabase
+
+import asyncio
+import pytest
+import sqlite3
+
+pytestmark = pytest.mark.asyncio
+
+user = {"email": "Test@test.com", "password": "asdf", "is_active": True}
+
+
+def sqlite_app(path):
+    app = FastAPI()
+    iam = configure_iam({"storage": "sqlite", "sqlite_path": str(path)})
+    app.include_router(iam.router, prefix="/auth")
+    return iam, app
+
+
+def test_requires_path():
+    with pytest.raises(ValueError):
+        configure_iam({"storage": "sqlite"})
+
+
+async def test_batched_writes(tmp_path):
+    db = SQLiteDatabase(str(tmp_path / "iam.sqlite3"), readers=2)
+    await db.start()
+    assert db.version == 4
+    mode = await db.read(
+        lambda conn: conn.execute("PRAGMA journal_mode").fetchone()[0]
+    )
+    assert mode == "wal"
+
+    def insert(conn, email):
+        conn.execute(
+            "INSERT INTO users (email, password) VALUES (?, 'x')", (email,)
+        )
+
+    # a duplicated email only fails its own write
+    emails = [f"u{i}@test.com" for i in range(50)] + ["u0@test.com"]
+    results = await asyncio.gather(
+        *(db.write(insert, e) for e in emails), return_exceptions=True
+    )
+    assert isinstance(results[-1], sqlite3.IntegrityError)
+    assert all(r is None for r in results[:-1])
+    stats = db.stats()
+    assert stats["writes"] == 51
+    assert stats["errors"] == 1
+    assert stats["batches"] < 51
+    count = await db.read(
+        lambda conn: conn.execute("SELECT count(*) FROM users").fetchone()[0]
+    )
+    assert count == 50
+    await db.stop()
+
+    # migrations are only applied once
+    db = SQLiteDatabase(str(tmp_path / "iam.sqlite3"))
+    await db.start()
+    assert db.version == 4
+    await db.stop()
+
+
+async def test_groups(tmp_path):
+    iam, app = sqlite_app(tmp_path / "iam.sqlite3")
+    async with TestClient(app):
+        created = await models.create_user(iam, user.copy())
+        assert created.email == "test@test.com"
+        users = iam.get_service(IUsersStorage)
+        groups = iam.get_service(IGroupsStorage)
+        for name in ("staff", "admin", "mkt"):
+            await groups.add_group(name)
+        u = await users.by_email("test@test.com")
+        u = await users.update_groups(u, ["staff", "mkt", "nope"])
+        assert u.groups == ["mkt", "staff"]
+
+        # removing a group updates users
+        await iam.sqlite.write(
+            lambda conn: conn.execute("DELETE FROM groups WHERE name='mkt'")
+        )
+        assert (await users.by_id(u.user_id)).groups == ["staff"]
+        assert await users.check_groups() == []
+
+        await iam.sqlite.write(
+            lambda conn: conn.execute("DELETE FROM users_group")
+        )
+        drift = await users.check_groups(repair=True)
+        assert drift[0]["stored"] == ["staff"]
+        assert drift[0]["expected"] == []
+        assert (await users.by_id(u.user_id)).groups == []
+
+
+async def test_sessions_survive_restart(tmp_path):
+    path = tmp_path / "iam.sqlite3"
+    iam, app = sqlite_app(path)
+    async with TestClient(app) as client:
+        await models.create_user(iam, user.copy())
+        logged = await testing.login(client, "test@test.com", "asdf")
+    assert iam.sqlite.stats()["running"] is False
+
+    iam, app = sqlite_app(path)
+    async with TestClient(app) as client:
+        res = await client.get(
+            "/auth/whoami", headers=testing.auth_header(logged.token)
+        )
+        assert res.status_code == 200
+        assert res.json()["email"] == "test@test.com"
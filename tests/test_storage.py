@@ -1,7 +1,27 @@
+from async_asgi_testclient import TestClient
+from contextlib import asynccontextmanager
+from fastapi import Depends
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from fastapi_asyncpg import configure_asyncpg
 from fastapi_asyncpg import sql
+from fastapi_iam.initialize import initialize_db
+from fastapi_iam.interfaces import ISessionStorage
+from fastapi_iam.interfaces import IUsersStorage
+from fastapi_iam.provider import bind_connection
 from fastapi_iam.services.pg import UserStorage
 from fastapi_iam.services.pg import GroupStorage
+from fastapi_iam.services.pg import SessionStorage
+from fastapi_iam.services.pg import create_partitions
+from fastapi_iam.services.pg import drop_partitions
+from fastapi_iam.services.pg import partitions_until
+from fastapi_iam.services.base import encode_cursor
+from fastapi_iam.services.pg import get_statements
+from fastapi_iam import configure_iam
+from fastapi_iam import events
 from fastapi_iam import models
+import asyncpg
+import datetime
 import pytest
 
 
@@ -38,7 +58,7 @@ async def test_base_model_service_storage(conn):
 
 async def test_users_search(users):
     _, ins = users
-    storage = UserStorage(ins.pool)
+    storage = ins.get_service(IUsersStorage)
     result = await storage.search()
     assert result["total"] == 3
     emails = set([r.email for r in result["items"]])
@@ -48,6 +68,13 @@ async def test_users_search(users):
     assert result["total"] == 1
     assert result["items"][0].email == "test@test.com"
 
+    result = await storage.search(q="")
+    assert result["total"] == 3
+
+    # emails are matched as stored, lowercased, on every storage
+    assert await storage.by_email("TEST@test.com") is None
+    assert (await storage.by_email("test@test.com")).email == "test@test.com"
+
     result = await storage.search(is_active=False)
     assert result["total"] == 1
     assert result["items"][0].email == "inactive@test.com"
@@ -58,3 +85,416 @@ async def test_users_search(users):
 
     result = await storage.search(is_staff=True)
     assert result["total"] == 3
+
+
+async def test_users_search_keyset(users):
+    _, ins = users
+    storage = ins.get_service(IUsersStorage)
+    seen = []
+    cursor = None
+    while True:
+        result = await storage.search(
+            limit=2, order_by="email", cursor=cursor, total="none"
+        )
+        assert result["total"] is None
+        seen += [r.email for r in result["items"]]
+        cursor = result["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == ["admin@test.com", "inactive@test.com", "test@test.com"]
+
+    result = await storage.search(limit=2, total="estimate", is_staff=True)
+    assert result["total"] == 3
+    result = await storage.search(limit=2, order_by="email")
+    with pytest.raises(ValueError):
+        await storage.search(order_by="user_id", cursor=result["next_cursor"])
+    with pytest.raises(ValueError):
+        await storage.search(cursor="not a cursor")
+    # the value type is checked, it is compared with the key column
+    cursor = encode_cursor("user_id", "1")
+    with pytest.raises(ValueError, match="invalid cursor"):
+        await storage.search(cursor=cursor)
+    cursor = encode_cursor("email", 1)
+    with pytest.raises(ValueError, match="invalid cursor"):
+        await storage.search(order_by="email", cursor=cursor)
+
+
+async def test_users_export(users):
+    _, ins = users
+    storage = ins.get_service(IUsersStorage)
+    rows = [r async for r in storage.export(prefetch=1)]
+    assert [r["email"] for r in rows] == [
+        "test@test.com",
+        "admin@test.com",
+        "inactive@test.com",
+    ]
+    assert "password" not in rows[0]
+    rows = [r async for r in storage.export(is_active=False)]
+    assert len(rows) == 1
+    rows = [r async for r in storage.export(q="")]
+    assert len(rows) == 3
+
+
+async def test_request_bound_connection(pool):
+    app = FastAPI()
+    db = configure_asyncpg(app, "", pool=pool)
+    iam = configure_iam(
+        {"request_connection": "transaction"}, fastapi_asyncpg=db
+    )
+
+    bound = {}
+    steps = []
+    connection = iam.connection
+
+    @asynccontextmanager
+    async def tracked(*, transaction=False):
+        async with connection(transaction=transaction) as db:
+            yield db
+        steps.append("commit")
+
+    iam.connection = tracked
+
+    class TrackedResponse(JSONResponse):
+        async def __call__(self, scope, receive, send):
+            steps.append("send")
+            await super().__call__(scope, receive, send)
+
+    @iam.router.get("/bound", response_class=TrackedResponse)
+    async def bound_view(conn=Depends(bind_connection)):
+        bound["conn"] = conn
+        bound["users"] = iam.get_service(IUsersStorage).db
+        bound["sessions"] = iam.get_service(ISessionStorage).db
+        return {}
+
+    app.include_router(iam.router, prefix="/auth")
+    async with TestClient(app) as client:
+        res = await client.get("/auth/bound")
+        assert res.status_code == 200
+        # committed before the response is sent
+        assert steps == ["commit", "send"]
+        # routes without db access are not bound
+        res = await client.get("/auth/status")
+        assert res.status_code == 200
+        assert steps == ["commit", "send"]
+    assert bound["users"] is bound["sessions"] is bound["conn"]
+    assert bound["users"] is not iam.pool
+    # outside the request, services use the pool
+    assert iam.get_service(IUsersStorage).db is iam.pool
+    assert iam.stats()["pool"]["acquired"] >= 1
+
+
+async def test_prepared_statements(conn):
+    statements = get_statements(None)
+    await statements.prepare(conn)
+    assert statements.prepared(conn, "user_by_email") is not None
+
+    repo = UserStorage(conn)
+    await repo.create(user1)
+    user = await repo.by_email("test@test.com")
+    assert user.email == "test@test.com"
+    result = await repo.search(q="test%", is_active=False)
+    assert result["total"] == 1
+    assert result["items"][0].email == "test@test.com"
+
+
+async def test_denormalized_groups(conn):
+    repo = UserStorage(conn)
+    grepo = GroupStorage(conn)
+    user = await repo.create(user1)
+    for group in groups:
+        await grepo.add_group(group)
+    user = await repo.update_groups(user, groups)
+    assert user.groups == sorted(groups)
+    assert await repo.check_groups() == []
+
+    # removing a group updates users
+    await conn.execute("DELETE FROM groups WHERE name='mkt'")
+    user = await repo.by_id(user.user_id)
+    assert user.groups == ["admin", "staff"]
+
+    # drift, when memberships are edited by hand
+    await conn.execute("DELETE FROM users_group WHERE user_id=$1", user.user_id)
+    drift = await repo.check_groups()
+    assert len(drift) == 1
+    assert drift[0]["user_id"] == user.user_id
+    drift = await repo.check_groups(repair=True)
+    assert len(drift) == 1
+    assert (await repo.by_id(user.user_id)).groups == []
+    assert await repo.check_groups() == []
+
+
+@pytest.fixture
+async def parts(pg):
+    # a schema of its own, initialize_db can't run on the test transaction
+    host, port = pg
+    conn = await asyncpg.connect(f"postgresql://postgres@{host}:{port}/test_db")
+    await conn.execute("DROP SCHEMA IF EXISTS parts CASCADE")
+    await conn.execute("CREATE SCHEMA parts")
+    yield conn
+    await conn.execute("DROP SCHEMA parts CASCADE")
+    await conn.close()
+
+
+async def test_prepared_after_migration(pg, parts):
+    host, port = pg
+    app = FastAPI()
+    iam = configure_iam({"db_schema": "parts"})
+    db = configure_asyncpg(
+        app,
+        f"postgresql://postgres@{host}:{port}/test_db",
+        init_db=iam.initialize_iam_db,
+        init=iam.init_connection,
+        min_size=1,
+        max_size=1,
+    )
+    iam.set_asyncpg(db)
+    app.include_router(iam.router, prefix="/auth")
+    statements = get_statements("parts")
+    async with TestClient(app):
+        # the connection was created before the tables
+        async with iam.connection() as conn:
+            assert statements.prepared(conn, "user_by_email") is not None
+        assert statements.unprepared == 0
+
+
+async def test_activity_flushed_on_shutdown(pg, parts):
+    host, port = pg
+    app = FastAPI()
+    settings = {
+        "db_schema": "parts",
+        "activity_buffer": True,
+        "activity_buffer_interval": 60,
+    }
+    iam = configure_iam(settings)
+    db = configure_asyncpg(
+        app,
+        f"postgresql://postgres@{host}:{port}/test_db",
+        init_db=iam.initialize_iam_db,
+        min_size=1,
+        max_size=1,
+    )
+    iam.set_asyncpg(db)
+    app.include_router(iam.router, prefix="/auth")
+    async with TestClient(app) as client:
+        await models.create_user(
+            iam, {"email": "a@test.com", "password": "a", "is_active": True}
+        )
+        res = await client.post(
+            "/auth/login", form={"username": "a@test.com", "password": "a"}
+        )
+        assert res.status_code == 200
+        assert iam.activity.pending == 1
+    # the last flush runs before the pool is closed
+    assert iam.activity.stats()["errors"] == 0
+    assert iam.activity.pending == 0
+    last_login = await parts.fetchval(
+        "SELECT last_login FROM parts.users WHERE email='a@test.com'"
+    )
+    assert last_login is not None
+
+
+async def test_concurrent_subscribers_unbound(pg, parts):
+    host, port = pg
+    app = FastAPI()
+    settings = {
+        "db_schema": "parts",
+        "request_connection": "transaction",
+        "events_dispatcher": "concurrent",
+    }
+    iam = configure_iam(settings)
+    db = configure_asyncpg(
+        app,
+        f"postgresql://postgres@{host}:{port}/test_db",
+        init_db=iam.initialize_iam_db,
+        min_size=3,
+        max_size=3,
+    )
+    iam.set_asyncpg(db)
+    app.include_router(iam.router, prefix="/auth")
+    found = []
+
+    async def audit(event):
+        users = iam.get_service(IUsersStorage)
+        # not the request connection, nor the other subscriber one
+        await users.db.execute("SELECT pg_sleep(0.05)")
+        found.append((await users.by_id(event.user.user_id)).email)
+
+    events.add_subscriber(events.UserLogin, audit)
+    events.add_subscriber(events.UserLogin, audit)
+    try:
+        async with TestClient(app) as client:
+            await models.create_user(
+                iam, {"email": "a@test.com", "password": "a", "is_active": True}
+            )
+            res = await client.post(
+                "/auth/login", form={"username": "a@test.com", "password": "a"}
+            )
+            assert res.status_code == 200
+        assert found == ["a@test.com", "a@test.com"]
+        assert iam.stats()["events"]["errors"] == 0
+    finally:
+        del events.events[events.UserLogin][-2:]
+        events.set_dispatcher(events.SequentialDispatcher())
+
+
+async def test_prepared_statements_schema_change(parts):
+    conn = parts
+    await initialize_db({"db_schema": "parts"}, conn)
+    statements = get_statements("parts")
+    repo = UserStorage(conn, "parts")
+    await repo.create(user1)
+    await statements.prepare(conn)
+    await conn.execute("ALTER TABLE parts.users ADD COLUMN extra1 integer")
+    # falls back to the plain query
+    assert (await repo.by_email(user1.email)).email == user1.email
+    assert statements.prepared(conn, "user_by_email") is None
+
+    await statements.prepare(conn)
+    with pytest.raises(asyncpg.exceptions.InvalidCachedStatementError):
+        async with conn.transaction():
+            await conn.execute(
+                "ALTER TABLE parts.users ADD COLUMN extra2 integer"
+            )
+            # the transaction is aborted, the error is raised as is
+            await repo.by_email(user1.email)
+    assert statements.prepared(conn, "user_by_email") is None
+
+
+async def test_partitioned_sessions(parts):
+    conn = parts
+    settings = {
+        "db_schema": "parts",
+        "session_partitions": True,
+        "session_expiration": 60 * 60 * 24 * 90,
+    }
+    await initialize_db(settings, conn)
+    partitions = await conn.fetchval(
+        "SELECT count(*) FROM pg_inherits "
+        "WHERE inhparent = 'parts.users_session'::regclass"
+    )
+    assert partitions >= 3
+
+    repo = UserStorage(conn, "parts")
+    sessions = SessionStorage(conn, "parts")
+    user = await repo.create(user1)
+    now = datetime.datetime.utcnow()
+    session = models.UserSession(
+        user_id=user.user_id,
+        token="token",
+        expires=now + datetime.timedelta(hours=1),
+        refresh_token="refresh",
+        refresh_token_expires=now + datetime.timedelta(days=60),
+    )
+    await sessions.login(session, now)
+    assert (await repo.by_token(token="token")).email == user1.email
+    assert await sessions.is_expired("refresh") is False
+    # rotating moves the session to another partition
+    await sessions.update_token(
+        "refresh",
+        "token2",
+        now + datetime.timedelta(hours=1),
+        new_rt="refresh2",
+        new_rte=now + datetime.timedelta(days=1),
+    )
+    assert (await repo.by_token(token="token2")).email == user1.email
+    plan = await conn.fetchval(
+        "EXPLAIN SELECT * FROM parts.users_session "
+        "WHERE token='token2' and refresh_token_expires>$1",
+        now + datetime.timedelta(days=40),
+    )
+    assert f"users_session_{now:%Y_%m}" not in plan
+
+    next_month = now + datetime.timedelta(days=32)
+    assert await drop_partitions(conn, "parts.", next_month) == 1
+    assert await repo.by_token(token="token2") is None
+    await sessions.delete("token2")
+
+
+async def test_partitions_coverage_edge(parts):
+    conn = parts
+    expiration = 60 * 60 * 24 * 90
+    settings = {
+        "db_schema": "parts",
+        "session_partitions": True,
+        "session_expiration": expiration,
+    }
+    await initialize_db(settings, conn)
+    user = await UserStorage(conn, "parts").create(user1)
+    sessions = SessionStorage(conn, "parts")
+    now = datetime.datetime.utcnow()
+    until = partitions_until(now, expiration)
+    # the first month without a partition
+    start = (until.replace(day=1) + datetime.timedelta(days=32)).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    partition = """SELECT c.relname FROM parts.users_session s
+        INNER JOIN pg_class c ON c.oid = s.tableoid WHERE token=$1"""
+    for name, expires in (
+        ("edge", start - datetime.timedelta(microseconds=1)),
+        ("past", start),
+    ):
+        session = models.UserSession(
+            user_id=user.user_id,
+            token=name,
+            expires=now + datetime.timedelta(hours=1),
+            refresh_token=name,
+            refresh_token_expires=expires,
+        )
+        await sessions.login(session, now)
+    assert await conn.fetchval(partition, "edge") == (
+        f"users_session_{until:%Y_%m}"
+    )
+    # a late maintenance, stored on the default partition
+    assert await conn.fetchval(partition, "past") == (
+        "users_session_default"
+    )
+    # and moved to its own partition when created
+    until = start + datetime.timedelta(days=1)
+    assert await create_partitions(conn, "parts.", now, until) == 1
+    assert await conn.fetchval(partition, "past") == (
+        f"users_session_{start:%Y_%m}"
+    )
+    assert await drop_partitions(conn, "parts.", now) == 0
+
+    # tables partitioned without a default partition get one
+    await conn.execute("DROP TABLE parts.users_session_default")
+    await initialize_db(settings, conn)
+    assert await conn.fetchval(
+        "SELECT to_regclass('parts.users_session_default')"
+    )
+
+
+async def test_partitioned_reap(parts):
+    conn = parts
+    settings = {
+        "db_schema": "parts",
+        "session_partitions": True,
+        "session_expiration": 60 * 60 * 24 * 90,
+    }
+    await initialize_db(settings, conn)
+    indexes = await conn.fetchval(
+        "SELECT count(*) FROM pg_indexes WHERE schemaname='parts' "
+        "AND indexname='users_session_expires_idx'"
+    )
+    assert indexes == 1
+    user = await UserStorage(conn, "parts").create(user1)
+    sessions = SessionStorage(conn, "parts")
+    now = datetime.datetime.utcnow()
+    month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    # first rows of two partitions, both with the same ctid
+    for name, expires in (
+        ("expired", month + datetime.timedelta(seconds=1)),
+        ("live", now + datetime.timedelta(days=40)),
+    ):
+        session = models.UserSession(
+            user_id=user.user_id,
+            token=name,
+            expires=expires,
+            refresh_token=name,
+            refresh_token_expires=expires,
+        )
+        await sessions.login(session, now)
+    before = month + datetime.timedelta(seconds=2)
+    assert await sessions.reap_expired(before) == 1
+    tokens = await conn.fetch("SELECT token FROM parts.users_session")
+    assert [r["token"] for r in tokens] == ["live"]